@@ -0,0 +1,68 @@
+"""
+Deferred imports of heavy dependencies
+
+hyperspy, temmeta, scipy, PIL and numba together take seconds to import,
+which is paid by every CLI call and every worker process even when it only
+writes config files or reads Q2bz files. The modules of jnrr therefore bind
+these dependencies with lazy_import, which returns a placeholder module that
+imports the real module on the first attribute access.
+
+>>> hs = lazy_import("hyperspy.api")  # nothing is imported yet
+>>> hs.signals.Signal2D  # hyperspy is imported here
+"""
+import importlib
+import sys
+import types
+
+# modules that should not be loaded by importing jnrr, checked by
+# jnrr.benchmark
+HEAVY_MODULES = ("hyperspy", "temmeta", "scipy", "PIL", "numba", "dask",
+                 "distributed", "h5py")
+
+
+class _LazyModule(types.ModuleType):
+    """Placeholder that imports the module it stands for on first use"""
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        module = self.__dict__["_module"]
+        if module is None:
+            module = importlib.import_module(self.__name__)
+            self.__dict__["_module"] = module
+            # later lookups go straight to the module
+            self.__dict__.update(module.__dict__)
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        if self.__dict__["_module"] is None:
+            return f"<lazy module '{self.__name__}'>"
+        return repr(self.__dict__["_module"])
+
+
+def lazy_import(name):
+    """
+    Return the module name, imported on the first attribute access
+
+    If the module is already imported it is returned directly.
+
+    Parameters
+    ----------
+    name : str
+        full name of the module, e.g. "scipy.ndimage"
+
+    Returns
+    -------
+    module : module
+        the module or a placeholder for it
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    return _LazyModule(name)
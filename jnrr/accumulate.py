@@ -0,0 +1,159 @@
+"""
+Compact integer accumulators for count data
+
+EDS counts per pixel and channel in a frame rarely exceed a few hundred,
+so summing spectrum frames in 64 bit integers wastes memory and bandwidth.
+CountAccumulator keeps the sum in the smallest unsigned integer type that
+is safe for the frames added so far, estimated from the number of frames
+and the observed maxima, and only promotes to a larger type when the next
+frame could overflow. Dense arrays and CSR matrices are both supported.
+
+>>> total = CountAccumulator(frames=len(frames))
+>>> for frame in frames:
+...     total.add(frame)
+>>> total.result()
+"""
+import os
+from pathlib import Path
+import numpy as np
+from ._imports import lazy_import
+
+sparse = lazy_import("scipy.sparse")
+
+UNSIGNED = (np.uint8, np.uint16, np.uint32, np.uint64)
+
+
+def smallest_dtype(max_value):
+    """Smallest unsigned integer dtype that can hold max_value"""
+    for dtype in UNSIGNED:
+        if max_value <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise OverflowError(f"{max_value} does not fit in any integer type")
+
+
+def _is_sparse(frame):
+    return hasattr(frame, "tocsr")
+
+
+def _frame_max(frame):
+    values = frame.data if _is_sparse(frame) else frame
+    if values.size == 0:
+        return 0
+    maximum = values.max()
+    if maximum < 0 or (np.issubdtype(values.dtype, np.floating) and
+                       np.any(values != np.round(values))):
+        raise ValueError("Only non-negative integer counts can be "
+                         "accumulated")
+    return int(maximum)
+
+
+class CountAccumulator(object):
+    """
+    Sum of count frames in the smallest safe unsigned integer type
+
+    The sum is sparse if the first frame is sparse and dense otherwise.
+    Sparse frames can also be added to a dense sum.
+
+    Parameters
+    ----------
+    frames : int, optional
+        expected number of frames. The initial type is chosen so that the
+        sum of this many frames with the maximum of the first frame fits.
+    shape : tuple, optional
+        shape of a dense sum, allocated before the first frame
+    dtype : numpy.dtype, optional
+        initial type of the sum, chosen automatically by default
+
+    Attributes
+    ----------
+    data : numpy.ndarray or scipy.sparse.csr_matrix
+        the sum
+    frames : int
+        number of frames added
+    bound : int
+        upper bound of the largest value in the sum
+    """
+    def __init__(self, frames=None, shape=None, dtype=None):
+        self.expected = frames
+        self.frames = 0
+        self.bound = 0
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.data = None
+        if shape is not None:
+            self.dtype = self.dtype or np.dtype(np.uint8)
+            self.data = np.zeros(shape, dtype=self.dtype)
+
+    def _initial_dtype(self, frame_max):
+        remaining = max((self.expected or 1) - self.frames, 1)
+        return smallest_dtype(self.bound + frame_max*remaining)
+
+    def _promote(self, frame_max):
+        """Switch to a larger type if the next frame could overflow"""
+        if self.bound + frame_max <= np.iinfo(self.dtype).max:
+            return
+        # the bound may be pessimistic, check the actual maximum first
+        self.bound = _frame_max(self.data)
+        if self.bound + frame_max <= np.iinfo(self.dtype).max:
+            return
+        self.dtype = self._initial_dtype(frame_max)
+        self.data = self.data.astype(self.dtype)
+
+    def add(self, frame):
+        """Add a dense array or sparse matrix of counts"""
+        frame_max = _frame_max(frame)
+        if self.data is None:
+            if self.dtype is None:
+                self.dtype = self._initial_dtype(frame_max)
+            if _is_sparse(frame):
+                self.data = frame.tocsr().astype(self.dtype)
+            else:
+                self.data = np.array(frame, dtype=self.dtype)
+        else:
+            self._promote(frame_max)
+            if _is_sparse(self.data):
+                if not _is_sparse(frame):
+                    # sparse + dense would be a dense numpy.matrix
+                    frame = sparse.csr_matrix(frame)
+                self.data = (self.data + frame.astype(self.dtype)).tocsr()
+            elif _is_sparse(frame):
+                frame = frame.tocsr()
+                frame.sum_duplicates()
+                rows = np.repeat(np.arange(frame.shape[0]),
+                                 np.diff(frame.indptr))
+                # the indices of a canonical csr matrix are unique
+                self.data[rows, frame.indices] += \
+                    frame.data.astype(self.dtype)
+            else:
+                np.add(self.data, frame, out=self.data, casting="unsafe")
+        self.bound += frame_max
+        self.frames += 1
+
+    def result(self):
+        """The sum, None if nothing was added"""
+        return self.data
+
+
+def total_spectrum(folder, frames=None):
+    """
+    Sum the sparse spectrum frames (.npz) in a folder
+
+    Parameters
+    ----------
+    folder : str
+        folder with the frames, e.g. written by export_streamframes
+    frames : list of int, optional
+        positions in the sorted file list to sum, by default all
+
+    Returns
+    -------
+    total : scipy.sparse.csr_matrix
+        the (pixels, channels) sum in the smallest safe integer type
+    """
+    paths = sorted(i for i in os.listdir(folder)
+                   if i.endswith(".npz") and not i.startswith("."))
+    if frames is not None:
+        paths = [paths[i] for i in frames]
+    total = CountAccumulator(frames=len(paths))
+    for path in paths:
+        total.add(sparse.load_npz(str(Path(f"{folder}/{path}"))))
+    return total.result()
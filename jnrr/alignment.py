@@ -0,0 +1,141 @@
+"""
+Rigid pre-alignment of image stacks before non-rigid registration
+
+The translation of every frame with respect to a reference frame is
+estimated with FFT cross-correlation, for a chunk of frames at a time. The
+frames exported for match-series are shifted by the (integer) translations,
+so the non-rigid registration only has to deal with the residual
+distortions. The shifts are saved next to the exported frames and composed
+with the non-rigid deformations when the original data is corrected.
+"""
+import json
+import os
+from pathlib import Path
+import numpy as np
+from ._imports import lazy_import
+
+ndimage = lazy_import("scipy.ndimage")
+
+RIGID_SHIFTS_FILE = "rigid_shifts.json"
+
+
+def estimate_shifts(data, reference_index=0, chunk=64):
+    """
+    Estimate the translation of each frame with respect to a reference
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        (frames, height, width) image stack
+    reference_index : int, optional
+        index of the reference frame
+    chunk : int, optional
+        number of frames of which the FFT is calculated at once
+
+    Returns
+    -------
+    shifts : numpy.ndarray
+        (frames, 2) integer (dy, dx) positions of the frame content with
+        respect to the reference, i.e. frame(y, x) = ref(y - dy, x - dx)
+    """
+    frames, h, w = data.shape
+    ref = data[reference_index].astype(np.float32)
+    reffft = np.conj(np.fft.rfft2(ref - ref.mean()))
+    shifts = np.zeros((frames, 2), dtype=np.int64)
+    for a in range(0, frames, chunk):
+        block = data[a:a+chunk].astype(np.float32)
+        block -= block.mean(axis=(1, 2), keepdims=True)
+        xcorr = np.fft.irfft2(np.fft.rfft2(block)*reffft, s=(h, w))
+        maxinx = xcorr.reshape(block.shape[0], -1).argmax(axis=1)
+        dy, dx = np.unravel_index(maxinx, (h, w))
+        shifts[a:a+chunk, 0] = np.where(dy > h//2, dy - h, dy)
+        shifts[a:a+chunk, 1] = np.where(dx > w//2, dx - w, dx)
+    return shifts
+
+
+def apply_shifts(data, shifts):
+    """
+    Shift each frame back onto the reference
+
+    Pixels that enter the frame are set to the mean of the frame.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        (frames, height, width) image stack
+    shifts : numpy.ndarray
+        (frames, 2) integer (dy, dx) shifts from estimate_shifts
+
+    Returns
+    -------
+    aligned : numpy.ndarray
+        the aligned stack, aligned(y, x) = frame(y + dy, x + dx)
+    """
+    aligned = np.empty_like(data)
+    for i, (dy, dx) in enumerate(shifts):
+        aligned[i] = ndimage.shift(data[i], (-dy, -dx), order=0,
+                                   mode="constant", cval=data[i].mean())
+    return aligned
+
+
+def common_region(shifts, shape):
+    """
+    Region that holds data in every frame aligned with apply_shifts
+
+    Parameters
+    ----------
+    shifts : numpy.ndarray
+        (frames, 2) integer (dy, dx) shifts from estimate_shifts
+    shape : tuple
+        (height, width) of the frames
+
+    Returns
+    -------
+    region : tuple of slices or None
+        (rows, columns) of the region without filled borders, None if the
+        shifts leave no common region
+    """
+    shifts = np.asarray(shifts)
+    region = []
+    for length, d in zip(shape, shifts.T):
+        start = max(0, -int(d.min()))
+        stop = length - max(0, int(d.max()))
+        if stop <= start:
+            return None
+        region.append(slice(start, stop))
+    return tuple(region)
+
+
+def write_shifts(folder, shifts, reference_index=0):
+    """Save the shifts applied to the frames in folder"""
+    with open(str(Path(f"{folder}/{RIGID_SHIFTS_FILE}")), "w") as f:
+        json.dump({"reference_frame": reference_index,
+                   "frame_shifts": np.asarray(shifts).tolist()}, f, indent=4)
+
+
+def read_shifts(folder):
+    """
+    Return the (frames, 2) shifts applied to the frames in folder
+
+    Returns None if the frames in the folder were not pre-aligned.
+    """
+    path = str(Path(f"{folder}/{RIGID_SHIFTS_FILE}"))
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return np.array(json.load(f)["frame_shifts"])
+
+
+def compose_shift(defX, defY, shift):
+    """
+    Add a rigid shift to match-series deformations
+
+    The deformations are normalized by the largest image dimension - 1, so
+    the (dy, dx) shift in pixels is normalized in the same way. Warping the
+    original frame with the result equals warping the aligned frame with
+    the original deformations.
+    """
+    h, w = defX.shape
+    scale = max(h, w) - 1
+    dy, dx = shift
+    return defX + dx/scale, defY + dy/scale
@@ -0,0 +1,206 @@
+"""
+Batch extraction of many emd files
+
+All emd files of a directory, glob pattern or list of paths are extracted
+with extract_emd on a process pool, each into its own folder named after
+the file. A consolidated index of what was extracted where is written as
+json next to the output folders and updated after every file, so a whole
+session can be prepared for registration in one go and an interrupted
+batch continues with the files that are not done yet.
+
+>>> index = extract_batch("/share/session/*.emd", "/data/session",
+...                       workers=4, memory_limit="32GB")
+>>> index["files"]["/share/session/sample_1.emd"]["datasets"][0]
+{'image_folder': '/data/session/sample_1/images_000', ...}
+"""
+import concurrent.futures as cf
+import glob
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from .io_tools import dataset_spectra
+from .memory import parse_memory_limit
+from .progress import ProgressTracker
+from .sharedmem import process_context
+
+logger = logging.getLogger("Batch")
+
+INDEX_FILE = "extraction_index.json"
+
+
+def find_emd_files(inputs, pattern="*.emd"):
+    """
+    Sorted absolute paths of the emd files in directories or glob patterns
+
+    Parameters
+    ----------
+    inputs : str or list of str
+        directories, glob patterns or file paths
+    pattern : str, optional
+        pattern of the files in a directory
+    """
+    if isinstance(inputs, (str, os.PathLike)):
+        inputs = [inputs]
+    paths = set()
+    for inp in inputs:
+        inp = str(inp)
+        if os.path.isdir(inp):
+            matches = glob.glob(str(Path(f"{inp}/{pattern}")))
+        else:
+            matches = glob.glob(inp)
+        paths.update(os.path.abspath(i) for i in matches
+                     if os.path.isfile(i))
+    return sorted(paths)
+
+
+def _output_folders(paths, output_folder):
+    """One output folder per file named after it, unique within the batch"""
+    folders = {}
+    used = set()
+    for path in paths:
+        stem = os.path.splitext(os.path.basename(path))[0].replace(" ", "_")
+        name, n = stem, 1
+        while name in used:
+            name = f"{stem}_{n}"
+            n += 1
+        used.add(name)
+        folders[path] = str(Path(f"{output_folder}/{name}"))
+    return folders
+
+
+def _signature(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def _index_entry(paths):
+    """Index entry of a file from the paths returned by extract_emd"""
+    tiling = paths.get("tiling_file_paths") or []
+    spectra = dataset_spectra(paths)
+    datasets = []
+    for j, config in enumerate(paths["config_file_paths"]):
+        datasets.append({
+            "image_folder": paths["image_folder_paths"][j],
+            "result_folder": paths["output_folder_paths"][j],
+            "config_file": config,
+            "tiling_file": tiling[j] if j < len(tiling) else None,
+            "spectrum_folder": spectra[j]})
+    return {"datasets": datasets,
+            "spectrum_folders": paths["spectrum_folder_paths"] or []}
+
+
+def _extract_file(path, output_folder, options):
+    """Extract one file in a worker process, return its index entry"""
+    from .io_tools import extract_emd
+    start = time.perf_counter()
+    if not os.path.isdir(output_folder):
+        os.makedirs(output_folder)
+    paths = extract_emd(path, output_folder=output_folder, **options)
+    return {**_index_entry(paths), "seconds": time.perf_counter() - start}
+
+
+def read_index(output_folder):
+    """Read the index of a batch, empty if there is none yet"""
+    index_file = str(Path(f"{output_folder}/{INDEX_FILE}"))
+    if not os.path.isfile(index_file):
+        return {"files": {}}
+    with open(index_file) as f:
+        return json.load(f)
+
+
+def _write_index(index, output_folder):
+    index_file = str(Path(f"{output_folder}/{INDEX_FILE}"))
+    index["files"] = dict(sorted(index["files"].items()))
+    with open(index_file + ".tmp", "w") as f:
+        json.dump(index, f, indent=4)
+    os.replace(index_file + ".tmp", index_file)
+
+
+def extract_batch(inputs, output_folder, pattern="*.emd", workers=None,
+                  memory_limit=None, overwrite=False, progress=None,
+                  **options):
+    """
+    Extract many emd files on a process pool and index the results
+
+    Parameters
+    ----------
+    inputs : str or list of str
+        directories, glob patterns or paths of the emd files
+    output_folder : str
+        folder in which a folder per emd file and the index are created
+    pattern : str, optional
+        pattern of the files in input directories
+    workers : int, optional
+        number of files extracted concurrently, defaults to the number of
+        processors
+    memory_limit : int or str, optional
+        memory budget of the whole batch, every file gets an equal share
+        as the memory_limit of extract_emd
+    overwrite : bool, optional
+        also extract files that the index lists as extracted and that did
+        not change since
+    progress : callable or list of callables, optional
+        receive progress reports counting the files, see
+        progress.ProgressTracker
+
+    Additional parameters
+    ---------------------
+    See the parameters of io_tools.extract_emd
+
+    Returns
+    -------
+    index : dict
+        per emd file in "files" the "output_folder", the "status" ("done"
+        or "failed"), the "error" if it failed, and the "datasets" with
+        their image folder, result folder, config file, tiling file and
+        spectrum folder, and all "spectrum_folders"
+    """
+    output_folder = os.path.abspath(output_folder)
+    if not os.path.isdir(output_folder):
+        os.makedirs(output_folder)
+    paths = find_emd_files(inputs, pattern)
+    if not paths:
+        raise ValueError(f"No emd files found in {inputs}")
+    index = read_index(output_folder)
+    folders = _output_folders(paths, output_folder)
+    todo = []
+    for path in paths:
+        entry = index["files"].get(path)
+        if (not overwrite and entry is not None and
+                entry["status"] == "done" and
+                entry.get("signature") == _signature(path)):
+            logger.info(f"{path} was already extracted")
+            continue
+        todo.append(path)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(todo)))
+    if memory_limit is not None:
+        options["memory_limit"] = parse_memory_limit(memory_limit)//workers
+    tracker = ProgressTracker("batch", len(todo), progress,
+                              label=output_folder)
+    if not todo:
+        tracker.finish()
+        return index
+    logger.info(f"Extracting {len(todo)} files on {workers} processes")
+    with cf.ProcessPoolExecutor(max_workers=workers,
+                                mp_context=process_context()) as pool:
+        futures = {pool.submit(_extract_file, path, folders[path],
+                               options): path for path in todo}
+        for future in cf.as_completed(futures):
+            path = futures[future]
+            entry = {"output_folder": folders[path],
+                     "signature": _signature(path)}
+            try:
+                entry.update(future.result(), status="done")
+                logger.info(f"Extracted {path} to {folders[path]}")
+            except Exception as e:
+                entry.update(status="failed", error=str(e))
+                logger.warning(f"{path} was not extracted: {e}")
+            index["files"][path] = entry
+            _write_index(index, output_folder)
+            tracker.update()
+    tracker.finish()
+    return index
@@ -0,0 +1,112 @@
+"""
+Import time benchmark of the jnrr modules
+
+Every module is imported in a fresh interpreter, the time is measured and
+the heavy dependencies (see _imports.HEAVY_MODULES) that were loaded by the
+import are listed. Run it after changing imports:
+
+    python -m jnrr.benchmark
+"""
+import json
+import os
+import subprocess
+import sys
+from ._imports import HEAVY_MODULES
+
+# modules that must import fast, lazy needs dask by design
+LIGHT_MODULES = ("jnrr", "jnrr.io_tools", "jnrr.processing", "jnrr.alignment",
+                 "jnrr.screening", "jnrr.kernels", "jnrr.tiling",
+                 "jnrr.watcher", "jnrr.stackfile", "jnrr.memory",
+                 "jnrr.progress", "jnrr.convergence", "jnrr.sharedmem",
+                 "jnrr.accumulate", "jnrr.stats",
+                 "jnrr.batch", "jnrr.tiffwriter",
+                 "jnrr.eventstream", "jnrr.pipeline",
+                 "jnrr.subseries", "jnrr.registration",
+                 "jnrr.workqueue", "jnrr.cli")
+
+_PROBE = """
+import json, sys, time
+t = time.perf_counter()
+import {module}
+t = time.perf_counter() - t
+print(json.dumps([t, sorted({{m.split(".")[0] for m in sys.modules}})]))
+"""
+
+
+def import_time(module, repeat=3):
+    """
+    Time the import of a module in a fresh interpreter
+
+    Parameters
+    ----------
+    module : str
+        name of the module
+    repeat : int, optional
+        number of imports, the fastest is returned
+
+    Returns
+    -------
+    seconds : float
+        the fastest import time
+    heavy : list of str
+        heavy dependencies that were loaded by the import
+    """
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(
+        [root] + [i for i in [env.get("PYTHONPATH")] if i])
+    times = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c",
+                              _PROBE.format(module=module)],
+                             capture_output=True, text=True, env=env,
+                             check=True)
+        seconds, loaded = json.loads(out.stdout.strip().splitlines()[-1])
+        times.append(seconds)
+    return min(times), [i for i in HEAVY_MODULES if i in loaded]
+
+
+def check_import_times(modules=LIGHT_MODULES, budget=0.5, repeat=3):
+    """
+    Benchmark the imports and report modules that are too slow
+
+    Parameters
+    ----------
+    modules : list of str, optional
+        the modules to import
+    budget : float, optional
+        maximum import time in seconds
+    repeat : int, optional
+        see import_time
+
+    Returns
+    -------
+    results : dict
+        module name : (seconds, heavy modules loaded)
+    problems : list of str
+        description of every module that exceeds the budget or loads heavy
+        dependencies
+    """
+    results = {}
+    problems = []
+    for module in modules:
+        seconds, heavy = import_time(module, repeat=repeat)
+        results[module] = (seconds, heavy)
+        if seconds > budget:
+            problems.append(f"{module} takes {seconds:.3f} s to import")
+        if heavy:
+            problems.append(f"{module} imports {', '.join(heavy)}")
+    return results, problems
+
+
+def main():
+    results, problems = check_import_times()
+    for module, (seconds, heavy) in results.items():
+        print(f"{module:20s} {seconds:8.3f} s  {' '.join(heavy)}")
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,595 @@
+"""
+Command line interface to extract, register and correct Velox emd files
+
+All stages run in a single python process, so the heavy dependencies are
+only imported once and the stages of the run command share their data in
+memory. Use it as python -m jnrr <command> or through the main function.
+
+    jnrr extract data.emd --output out/
+    jnrr register out/matchSeries_000.par --workers 4
+    jnrr apply out/nonrigid_results_000 --spectra out/spectra_000
+    jnrr run data.emd --output out/ --workers 4 --memory-limit 8GB
+    jnrr batch /share/session/ --output out/ --workers 4
+    jnrr stats out/nonrigid_results_000/deformedImages_000 --output stats/
+    jnrr submit /share/session/ --output /share/out --queue /share/queue
+    jnrr worker /share/queue --slots 2
+"""
+import argparse
+import concurrent.futures as cf
+import json
+import logging
+import os
+import sys
+
+
+def _add_extract_arguments(parser, batch=False):
+    if batch:
+        parser.add_argument("input", nargs="+",
+                            help="folders, glob patterns or paths of emd "
+                            "files")
+        parser.add_argument("-o", "--output", required=True,
+                            help="output folder, a folder per emd file is "
+                            "created in it")
+    else:
+        parser.add_argument("input", help="path to the emd file")
+        parser.add_argument("-o", "--output", default=None,
+                            help="output folder, defaults to the folder of "
+                            "the emd file")
+    parser.add_argument("--prefix", default="frame",
+                        help="name of the exported frames")
+    parser.add_argument("--image-dataset", type=int, nargs="+", default=None,
+                        help="indexes of the image datasets to extract")
+    parser.add_argument("--spectrum-dataset", type=int, nargs="+",
+                        default=None,
+                        help="indexes of the spectrum streams to extract")
+    parser.add_argument("--extension", default="tiff",
+                        help="file format of the exported frames, "
+                        "rawtiff writes tiff files without PIL")
+    parser.add_argument("--tile-size", type=int, default=None,
+                        help="also export tiles of this size")
+    parser.add_argument("--skip-bad-frames", action="store_true",
+                        help="skip outlier frames in the registration")
+    parser.add_argument("--prealign", action="store_true",
+                        help="rigidly pre-align the frames")
+
+
+def _add_apply_arguments(parser):
+    parser.add_argument("--energy-window", type=float, nargs=2,
+                        action="append", metavar=("START", "END"),
+                        default=None,
+                        help="only correct this energy window in keV, can "
+                        "be repeated")
+    parser.add_argument("--memory-limit", default=None,
+                        help="memory budget for the spectrum correction, "
+                        "e.g. 8GB")
+    parser.add_argument("--output-format", choices=("frames", "hdf5"),
+                        default="frames",
+                        help="write the corrected frames as individual "
+                        "files or as one HDF5 file")
+    parser.add_argument("--compression", default=None,
+                        help="compression of the HDF5 output, e.g. gzip")
+
+
+def _add_common_arguments(parser):
+    parser.add_argument("--workers", type=int, default=None,
+                        help="maximum number of concurrent registrations "
+                        "and corrections, defaults to the number of "
+                        "processors")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="print progress information")
+    parser.add_argument("--progress", action="store_true",
+                        help="show progress bars, requires tqdm")
+    parser.add_argument("--progress-file", default=None,
+                        help="append progress reports as json lines to "
+                        "this file")
+
+
+def _progress(args):
+    """Progress callbacks selected on the command line"""
+    from . import progress
+    callbacks = []
+    if args.progress:
+        callbacks.append(progress.TqdmProgress())
+    if args.progress_file is not None:
+        callbacks.append(progress.JsonLinesProgress(args.progress_file))
+    return callbacks or None
+
+
+def _dataset_index(indexes):
+    if indexes is None or len(indexes) > 1:
+        return indexes
+    return indexes[0]
+
+
+def _extract_options(args):
+    return {"prefix": args.prefix,
+            "image_dataset_index": _dataset_index(args.image_dataset),
+            "spectrum_dataset_index": _dataset_index(args.spectrum_dataset),
+            "extension": args.extension, "tile_size": args.tile_size,
+            "skip_bad_frames": args.skip_bad_frames,
+            "prealign": args.prealign}
+
+
+def _extract(args, keep_stacks=False):
+    from . import io_tools
+    return io_tools.extract_emd(
+        args.input, output_folder=args.output, memory_limit=args.memory_limit,
+        progress=_progress(args), keep_stacks=keep_stacks,
+        **_extract_options(args))
+
+
+def _apply_options(args):
+    return {"energy_windows": args.energy_window,
+            "memory_limit": args.memory_limit,
+            "output_format": args.output_format,
+            "compression": args.compression,
+            "progress": _progress(args)}
+
+
+def _plan_apply(result_folders, spectra_folders, memory_limit, workers):
+    """
+    Number of datasets corrected concurrently and the budget of each
+
+    Every dataset is planned with memory.plan_dataset, at most as many
+    datasets as fit in the budget next to each other are corrected at the
+    same time and they share the budget evenly.
+
+    Returns
+    -------
+    concurrent : int
+        number of datasets corrected at the same time
+    worker_memory : int or None
+        memory budget of each of them, None without memory_limit
+    plans : dict
+        the plan of every result folder with that budget
+    """
+    from .memory import plan_dataset, parse_memory_limit
+    workers = workers or os.cpu_count() or 1
+    concurrent = max(1, min(workers, len(result_folders)))
+    if memory_limit is None:
+        return concurrent, None, {}
+    for r, s in zip(result_folders, spectra_folders):
+        plan = plan_dataset(r, s, memory_limit=memory_limit,
+                            workers=concurrent)
+        concurrent = min(concurrent, plan["workers"])
+    worker_memory = parse_memory_limit(memory_limit)//concurrent
+    plans = {r: plan_dataset(r, s, memory_limit=worker_memory, workers=1)
+             for r, s in zip(result_folders, spectra_folders)}
+    return concurrent, worker_memory, plans
+
+
+def _apply_all(result_folders, image_folders, spectra_folders, options,
+               workers, datasets=None):
+    """
+    Apply the deformations of several registrations concurrently
+
+    With a memory limit, the datasets corrected at the same time share it,
+    see _plan_apply. The workers are shared by the concurrent datasets as
+    well, the rest go to the image warping processes of every dataset. The
+    stacks of datasets are released once they are corrected.
+    """
+    from . import processing
+    if datasets is None:
+        datasets = [None]*len(result_folders)
+    workers = workers or os.cpu_count() or 1
+    concurrent, worker_memory, _ = _plan_apply(
+        result_folders, spectra_folders, options.get("memory_limit"),
+        workers)
+    options = dict(options, workers=max(1, workers//concurrent))
+    if worker_memory is not None:
+        options["memory_limit"] = worker_memory
+        logging.info(f"Correcting {concurrent} datasets at a time with "
+                     f"{worker_memory} bytes each")
+
+    def correct(result_folder, image_folder, spectra_folder, dataset):
+        try:
+            return processing.apply_deformations(
+                result_folder, image_folder, spectra_folder, dataset=dataset,
+                **options)
+        finally:
+            # the stack of a corrected dataset is not needed anymore
+            if dataset is not None:
+                dataset.release()
+
+    with cf.ThreadPoolExecutor(max_workers=concurrent) as pool:
+        futures = [pool.submit(correct, r, i, s, d)
+                   for r, i, s, d in zip(result_folders, image_folders,
+                                         spectra_folders, datasets)]
+        return [f.result() for f in futures]
+
+
+def _keep_stacks(datasets, memory_limit):
+    """
+    Release the extracted stacks that do not fit in the memory limit
+
+    The stacks are kept in the order of the datasets, the released ones are
+    read from the emd file again when they are corrected.
+    """
+    from .memory import parse_memory_limit
+    budget = parse_memory_limit(memory_limit)
+    kept = 0
+    for dataset in datasets:
+        if dataset.stack is None:
+            continue
+        size = dataset.stack.data.nbytes
+        if kept + size > budget:
+            logging.info(f"Released the stack of {dataset.image_folder}, "
+                         "it is read again for the correction")
+            dataset.release()
+        else:
+            kept += size
+
+
+def extract_command(args):
+    paths = _extract(args)
+    print(json.dumps(paths, indent=4))
+
+
+def batch_command(args):
+    from .batch import extract_batch
+    index = extract_batch(args.input, args.output, pattern=args.pattern,
+                          workers=args.workers,
+                          memory_limit=args.memory_limit,
+                          overwrite=args.overwrite, progress=_progress(args),
+                          **_extract_options(args))
+    print(json.dumps(index, indent=4))
+
+
+def register_command(args):
+    from . import processing
+    if args.chunk_size is not None:
+        from .subseries import run_subseries_registration
+        result_folders = [run_subseries_registration(
+            i, args.chunk_size, overlap=args.overlap, workers=args.workers,
+            progress=_progress(args), backend=args.backend)
+            for i in args.config]
+        print("\n".join(result_folders))
+        return
+    if args.backend == "numpy":
+        from .registration import register_configs
+        result_folders = register_configs(args.config, workers=args.workers,
+                                          progress=_progress(args))
+    else:
+        result_folders = processing.calculate_non_rigid_registrations(
+            args.config, workers=args.workers, progress=_progress(args))
+    print("\n".join(result_folders))
+
+
+def apply_command(args):
+    if args.spectra is not None and args.spectra_emd is not None:
+        raise ValueError("--spectra and --spectra-emd write the same maps, "
+                         "use one of them")
+    _apply_all(args.result_folder, [args.images]*len(args.result_folder),
+               [args.spectra]*len(args.result_folder), _apply_options(args),
+               args.workers)
+    if args.spectra_emd is not None:
+        from .eventstream import correct_emd_spectra
+        for result_folder in args.result_folder:
+            correct_emd_spectra(result_folder, args.spectra_emd,
+                                dataset_index=args.spectrum_dataset,
+                                output_folder=result_folder,
+                                progress=_progress(args))
+
+
+def run_command(args):
+    from . import processing
+    # the extracted stacks are corrected without reading the frames again
+    paths = _extract(args, keep_stacks=True)
+    if args.memory_limit is not None:
+        _keep_stacks(paths["datasets"], args.memory_limit)
+    result_folders = processing.calculate_non_rigid_registrations(
+        paths["config_file_paths"], workers=args.workers,
+        progress=_progress(args))
+    from .io_tools import dataset_spectra
+    spectra = dataset_spectra(paths)
+    if args.no_spectra:
+        spectra = [None]*len(spectra)
+    _apply_all(result_folders, paths["image_folder_paths"], spectra,
+               _apply_options(args), args.workers,
+               datasets=paths["datasets"])
+    print("\n".join(result_folders))
+
+
+def plan_command(args):
+    spectra = [args.spectra]*len(args.result_folder)
+    concurrent, worker_memory, plans = _plan_apply(
+        args.result_folder, spectra, args.memory_limit, args.workers)
+    if worker_memory is None:
+        # without a limit the plans use the available memory
+        from .memory import plan_dataset
+        plans = {r: plan_dataset(r, s, workers=args.workers)
+                 for r, s in zip(args.result_folder, spectra)}
+    print(json.dumps({"concurrent": concurrent,
+                      "worker_memory": worker_memory, "plans": plans},
+                     indent=4, default=str))
+
+
+def tune_command(args):
+    from . import convergence
+    report = convergence.analyze(args.config, log_file=args.log,
+                                 tolerance=args.tolerance)
+    print(json.dumps(report, indent=4))
+    if args.apply is not None:
+        for config in args.apply:
+            convergence.apply_recommendation(config,
+                                             report["recommendation"],
+                                             force=args.force)
+
+
+def stats_command(args):
+    from . import stats
+    result = stats.frame_statistics(
+        args.folder, statistics=args.statistics or stats.STATISTICS,
+        sigma=args.sigma,
+        iterations=args.iterations, memory_limit=args.memory_limit,
+        workers=args.workers)
+    paths = stats.save_statistics(result, args.output or args.folder,
+                                  prefix=args.prefix)
+    print(json.dumps(paths, indent=4))
+
+
+def watch_command(args):
+    from .watcher import FolderWatcher
+    workers = args.workers or 1
+    watcher = FolderWatcher(args.folder, args.output,
+                            settle_time=args.settle_time,
+                            workers={"extract": workers,
+                                     "register": workers,
+                                     "apply": workers},
+                            options={"apply": {
+                                "memory_limit": args.memory_limit}})
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        watcher.stop()
+
+
+def submit_command(args):
+    from . import workqueue
+    queue = workqueue.open_queue(args.queue)
+    apply_options = {"energy_windows": args.energy_window,
+                     "memory_limit": args.memory_limit,
+                     "output_format": args.output_format,
+                     "compression": args.compression,
+                     "spectra": not args.no_spectra}
+    register_options = {"backend": args.backend}
+    if args.chunk_size is not None:
+        register_options.update(chunk_size=args.chunk_size,
+                                overlap=args.overlap)
+    task_ids = workqueue.submit_files(
+        queue, args.input, args.output,
+        extract_options={"memory_limit": args.memory_limit,
+                         **_extract_options(args)},
+        register_options=register_options, apply_options=apply_options,
+        max_attempts=args.max_attempts)
+    print("\n".join(task_ids))
+
+
+def worker_command(args):
+    from . import workqueue
+    queue = workqueue.open_queue(args.queue, lease=args.lease)
+    worker = workqueue.QueueWorker(queue, slots=args.slots, kinds=args.kinds,
+                                   poll_interval=args.poll_interval)
+    try:
+        worker.run(until_idle=args.until_idle)
+    except KeyboardInterrupt:
+        worker.stop()
+    print(json.dumps(queue.counts(), indent=4))
+
+
+def broker_command(args):
+    from . import workqueue
+    if args.queue_folder is not None:
+        queue = workqueue.FileQueue(args.queue_folder, lease=args.lease)
+    else:
+        queue = workqueue.MemoryQueue(lease=args.lease)
+    broker = workqueue.QueueBroker(queue, host=args.host, port=args.port)
+    host, port = broker.address
+    print(f"tcp://{host}:{port}", flush=True)
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        broker.shutdown()
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog="jnrr",
+        description="Non-rigid registration of Velox emd datasets")
+    sub = parser.add_subparsers(dest="command")
+    sub.required = True
+
+    extract = sub.add_parser("extract", help="export the frames and create "
+                             "the match-series config files")
+    _add_extract_arguments(extract)
+    extract.add_argument("--memory-limit", default=None,
+                         help="memory budget of the extraction, e.g. 8GB")
+    _add_common_arguments(extract)
+    extract.set_defaults(func=extract_command)
+
+    batch = sub.add_parser("batch", help="extract many emd files on a "
+                           "process pool and write an index")
+    _add_extract_arguments(batch, batch=True)
+    batch.add_argument("--pattern", default="*.emd",
+                       help="pattern of the files in input folders")
+    batch.add_argument("--overwrite", action="store_true",
+                       help="also extract files that were already extracted")
+    batch.add_argument("--memory-limit", default=None,
+                       help="memory budget of the whole batch, e.g. 32GB")
+    _add_common_arguments(batch)
+    batch.set_defaults(func=batch_command)
+
+    register = sub.add_parser("register", help="run match-series on config "
+                              "files")
+    register.add_argument("config", nargs="+", help="config files")
+    register.add_argument("--chunk-size", type=int, default=None,
+                          help="register long series in overlapping chunks "
+                          "of this many frames concurrently")
+    register.add_argument("--overlap", type=int, default=8,
+                          help="number of frames shared by consecutive "
+                          "chunks")
+    register.add_argument("--backend", choices=["matchseries", "numpy"],
+                          default="matchseries",
+                          help="register with the match-series binary or "
+                          "in-process with numpy (small and medium frames)")
+    _add_common_arguments(register)
+    register.set_defaults(func=register_command)
+
+    apply = sub.add_parser("apply", help="apply calculated deformations")
+    apply.add_argument("result_folder", nargs="+",
+                       help="folders with the match-series results")
+    apply.add_argument("--images", default=None,
+                       help="folder with the images to correct, defaults "
+                       "to the registered images")
+    apply.add_argument("--spectra", default=None,
+                       help="folder with the spectrum stream frames")
+    apply.add_argument("--spectra-emd", default=None,
+                       help="correct the spectrum stream directly from the "
+                       "events in this emd file instead of --spectra, the "
+                       "maps are saved as .hspy in the result folders")
+    apply.add_argument("--spectrum-dataset", type=int, default=0,
+                       help="index of the spectrum stream in --spectra-emd")
+    _add_apply_arguments(apply)
+    _add_common_arguments(apply)
+    apply.set_defaults(func=apply_command)
+
+    plan = sub.add_parser("plan", help="show how apply would use the memory")
+    plan.add_argument("result_folder", nargs="+",
+                      help="folders with the match-series results")
+    plan.add_argument("--spectra", default=None,
+                      help="folder with the spectrum stream frames")
+    plan.add_argument("--memory-limit", default=None,
+                      help="memory budget, defaults to the available memory")
+    _add_common_arguments(plan)
+    plan.set_defaults(func=plan_command)
+
+    tune = sub.add_parser("tune", help="analyze the convergence of a "
+                          "registration and recommend iteration settings")
+    tune.add_argument("config", help="config file of a finished registration")
+    tune.add_argument("--log", default=None,
+                      help="match-series output, defaults to the .log file "
+                      "next to the config file")
+    tune.add_argument("--tolerance", type=float, default=1e-3,
+                      help="allowed final energy difference relative to the "
+                      "total energy decrease")
+    tune.add_argument("--apply", nargs="+", default=None, metavar="CONFIG",
+                      help="write the recommendation to these config files")
+    tune.add_argument("--force", action="store_true",
+                      help="also apply a recommendation that does not agree "
+                      "with the config, e.g. from an unrecognized log")
+    tune.set_defaults(func=tune_command, verbose=False)
+
+    run = sub.add_parser("run", help="extract, register and apply")
+    _add_extract_arguments(run)
+    _add_apply_arguments(run)
+    run.add_argument("--no-spectra", action="store_true",
+                     help="do not correct the spectrum stream")
+    _add_common_arguments(run)
+    run.set_defaults(func=run_command)
+
+    stats = sub.add_parser("stats", help="per pixel statistics over a "
+                           "folder of frames")
+    stats.add_argument("folder", help="folder with the frames")
+    stats.add_argument("-o", "--output", default=None,
+                       help="output folder, defaults to the frame folder")
+    stats.add_argument("--statistics", nargs="+", default=None,
+                       choices=("mean", "variance", "clipped_mean",
+                                "median"),
+                       help="statistics to calculate, defaults to all")
+    stats.add_argument("--sigma", type=float, default=3.,
+                       help="clipping threshold in standard deviations")
+    stats.add_argument("--iterations", type=int, default=1,
+                       help="number of clipping iterations")
+    stats.add_argument("--prefix", default="",
+                       help="prefix of the written image names")
+    stats.add_argument("--memory-limit", default=None,
+                       help="memory budget, e.g. 2GB")
+    _add_common_arguments(stats)
+    stats.set_defaults(func=stats_command)
+
+    watch = sub.add_parser("watch", help="process emd files as they appear "
+                           "in a folder")
+    watch.add_argument("folder", help="folder to watch")
+    watch.add_argument("-o", "--output", default=None,
+                       help="output folder, defaults to the watched folder")
+    watch.add_argument("--settle-time", type=float, default=10.,
+                       help="seconds a file must be unchanged to be "
+                       "processed")
+    watch.add_argument("--memory-limit", default=None,
+                       help="memory budget for the spectrum correction")
+    _add_common_arguments(watch)
+    watch.set_defaults(func=watch_command)
+
+    submit = sub.add_parser("submit", help="queue emd files for processing "
+                            "by workers")
+    _add_extract_arguments(submit, batch=True)
+    _add_apply_arguments(submit)
+    submit.add_argument("--queue", required=True,
+                        help="folder of a file queue on shared storage or "
+                        "tcp://host:port of a broker")
+    submit.add_argument("--backend", choices=["matchseries", "numpy"],
+                        default="matchseries",
+                        help="registration backend of the workers")
+    submit.add_argument("--chunk-size", type=int, default=None,
+                        help="register long series in overlapping chunks "
+                        "of this many frames")
+    submit.add_argument("--overlap", type=int, default=8,
+                        help="number of frames shared by consecutive "
+                        "chunks")
+    submit.add_argument("--no-spectra", action="store_true",
+                        help="do not correct the spectrum stream")
+    submit.add_argument("--max-attempts", type=int, default=3,
+                        help="number of times a task is tried")
+    submit.add_argument("-v", "--verbose", action="store_true",
+                        help="print progress information")
+    submit.set_defaults(func=submit_command)
+
+    worker = sub.add_parser("worker", help="run the tasks of a queue")
+    worker.add_argument("queue", help="folder of a file queue on shared "
+                        "storage or tcp://host:port of a broker")
+    worker.add_argument("--slots", type=int, default=1,
+                        help="number of tasks run at the same time")
+    worker.add_argument("--kinds", nargs="+", default=None,
+                        choices=["extract", "register", "apply"],
+                        help="only run these kinds of tasks")
+    worker.add_argument("--lease", type=float, default=300.,
+                        help="seconds without heartbeat after which the "
+                        "tasks of a lost worker are taken over, for file "
+                        "queues")
+    worker.add_argument("--poll-interval", type=float, default=1.,
+                        help="seconds between checks of the queue")
+    worker.add_argument("--until-idle", action="store_true",
+                        help="stop when no task is pending or running")
+    worker.add_argument("-v", "--verbose", action="store_true",
+                        help="print progress information")
+    worker.set_defaults(func=worker_command)
+
+    broker = sub.add_parser("broker", help="serve a work queue over TCP")
+    broker.add_argument("--host", default="127.0.0.1",
+                        help="address to listen on, 0.0.0.0 for all "
+                        "interfaces")
+    broker.add_argument("--port", type=int, default=5555,
+                        help="port to listen on")
+    broker.add_argument("--queue-folder", default=None,
+                        help="keep the tasks in this folder instead of "
+                        "memory, so they survive a restart")
+    broker.add_argument("--lease", type=float, default=300.,
+                        help="seconds without heartbeat after which the "
+                        "tasks of a lost worker are taken over")
+    broker.add_argument("-v", "--verbose", action="store_true",
+                        help="print progress information")
+    broker.set_defaults(func=broker_command)
+    return parser
+
+
+def main(argv=None):
+    """Entry point of the jnrr command"""
+    args = get_parser().parse_args(argv)
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO)
+    args.func(args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
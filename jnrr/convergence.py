@@ -0,0 +1,369 @@
+"""
+Convergence analysis of match-series runs
+
+calculate_non_rigid_registration writes the output of match-series to a
+.log file next to the config file. The energies of the gradient descent
+iterations in that log, and in energy dump files in the result folder, are
+parsed into runs: the iterations of one frame on one level of one stage.
+From the runs the smallest maxGDIterations and the largest stopEpsilon
+that still reach the same final energy are recommended, and can be written
+to the config file of the next acquisition of a similar sample.
+
+The patterns that recognize iterations, levels, stages and frames are
+collected in PATTERNS, adapt them if the match-series build prints its
+progress differently. analyze checks the parsed runs against the config
+file and apply_recommendation refuses to rewrite a config from runs that
+did not pass, e.g. when the log was not recognized.
+
+>>> report = analyze("matchSeries_000.par")
+>>> report["recommendation"]
+{'maxGDIterations': 120, 'stopEpsilon': 3.2e-05, ...}
+>>> apply_recommendation("next/matchSeries_000.par", report["recommendation"])
+"""
+import glob
+import os
+import re
+from pathlib import Path
+import numpy as np
+from .io_tools import read_config_file
+
+_FLOAT = r"([-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?)"
+
+PATTERNS = {
+    # "12: E = 1.234e-02, tau = 0.5" or "Step 12 energy = 1.2"
+    "iteration": re.compile(r"^\s*(?:[Ss]tep|[Ii]ter(?:ation)?)?\s*"
+                            r"([0-9]+)\s*[:,)]?\s.*?\b(?:E|[Ee]nergy)\s*"
+                            rf"[=:]\s*{_FLOAT}"),
+    "level": re.compile(r"\b[Ll]evel\s*[:=]?\s*([0-9]+)"),
+    "stage": re.compile(r"\b[Ss]tage\s*[:=]?\s*([0-9]+)"),
+    "frame": re.compile(r"\b(?:[Tt]emplate|[Ff]rame|[Ii]mage)\s*"
+                        r"(?:no\.?|nr\.?|number|#)?\s*[:=]?\s*([0-9]+)"),
+}
+
+
+def _new_run(context):
+    return {"stage": context["stage"], "level": context["level"],
+            "frame": context["frame"], "energies": []}
+
+
+def parse_log(path):
+    """
+    Parse the gradient descent energies from a match-series log
+
+    Parameters
+    ----------
+    path : str
+        path to the log file
+
+    Returns
+    -------
+    runs : list of dict
+        one dict per gradient descent with the "stage", "level" and "frame"
+        it belongs to (None if unknown) and the "energies" per iteration
+    """
+    runs = []
+    context = {"stage": None, "level": None, "frame": None}
+    run = None
+    last = None
+    with open(path, errors="replace") as f:
+        for line in f:
+            mt = PATTERNS["iteration"].search(line)
+            if mt:
+                iteration = int(mt.group(1))
+                if run is None or last is None or iteration <= last:
+                    run = _new_run(context)
+                    runs.append(run)
+                run["energies"].append(float(mt.group(2)))
+                last = iteration
+                continue
+            for key in ("stage", "level", "frame"):
+                mt = PATTERNS[key].search(line)
+                if mt:
+                    context[key] = int(mt.group(1))
+                    run = None
+    return [i for i in runs if i["energies"]]
+
+
+def parse_energy_dumps(result_folder):
+    """
+    Parse energy dump files in a match-series result folder
+
+    Files stage{s}/{frame}[-r]/*energy*.txt with one line per iteration
+    are read, the energy is the last column and the level is the last
+    number in the file name.
+
+    Parameters
+    ----------
+    result_folder : str
+        path to the folder where non rigid registration saved its result
+
+    Returns
+    -------
+    runs : list of dict
+        see parse_log
+    """
+    runs = []
+    pattern = str(Path(f"{result_folder}/stage*/*/*energy*.txt"))
+    for path in sorted(glob.glob(pattern)):
+        folder, name = os.path.split(path)
+        stagefolder, framefolder = os.path.split(folder)
+        stage = re.findall(r"([0-9]+)$", stagefolder)
+        frame = re.findall(r"^([0-9]+)", framefolder)
+        level = re.findall(r"([0-9]+)", name)
+        try:
+            energies = np.loadtxt(path, ndmin=2)[:, -1]
+        except ValueError:
+            continue
+        runs.append({"stage": int(stage[0]) if stage else None,
+                     "level": int(level[-1]) if level else None,
+                     "frame": int(frame[0]) if frame else None,
+                     "energies": energies.tolist()})
+    return runs
+
+
+def needed_iterations(energies, tolerance=1e-3):
+    """
+    Iterations after which the energy is within tolerance of the final one
+
+    The tolerance is relative to the total decrease of the energy.
+    """
+    energies = np.asarray(energies, dtype=float)
+    drop = energies[0] - energies[-1]
+    if len(energies) < 2 or drop <= 0:
+        return 1
+    close = np.nonzero(energies - energies[-1] <= tolerance*drop)[0]
+    return max(int(close[0]), 1)
+
+
+def _step_decrease(energies, iterations):
+    """Smallest relative energy decrease of the first iterations"""
+    energies = np.asarray(energies[:iterations + 1], dtype=float)
+    if len(energies) < 2:
+        return None
+    decrease = -np.diff(energies)/np.maximum(np.abs(energies[1:]), 1e-300)
+    decrease = decrease[decrease > 0]
+    return float(decrease.min()) if len(decrease) else None
+
+
+def summarize(runs, gditer=None, tolerance=1e-3):
+    """
+    Summarize the convergence per stage and level
+
+    Parameters
+    ----------
+    runs : list of dict
+        from parse_log or parse_energy_dumps
+    gditer : int, optional
+        maxGDIterations of the run, to count the frames that hit it
+    tolerance : float, optional
+        see needed_iterations
+
+    Returns
+    -------
+    summary : list of dict
+        per stage and level the number of "frames", the mean and maximum
+        "iterations" done and "needed", the number of runs that were
+        "capped" by gditer and the mean "final_energy"
+    """
+    groups = {}
+    for run in runs:
+        groups.setdefault((run["stage"], run["level"]), []).append(run)
+    summary = []
+    for (stage, level), group in sorted(
+            groups.items(), key=lambda i: tuple(-1 if j is None else j
+                                                for j in i[0])):
+        done = np.array([len(i["energies"]) - 1 for i in group])
+        needed = np.array([needed_iterations(i["energies"], tolerance)
+                           for i in group])
+        summary.append({
+            "stage": stage, "level": level, "frames": len(group),
+            "iterations_mean": float(done.mean()),
+            "iterations_max": int(done.max()),
+            "needed_mean": float(needed.mean()),
+            "needed_max": int(needed.max()),
+            "capped": int((done >= gditer).sum()) if gditer else 0,
+            "final_energy": float(np.mean([i["energies"][-1]
+                                           for i in group]))})
+    return summary
+
+
+def recommend(runs, gditer=None, epsilon=None, tolerance=1e-3, margin=1.2):
+    """
+    Recommend maxGDIterations and stopEpsilon from the convergence of runs
+
+    The iteration count is the largest number of iterations any run needed
+    to get within tolerance of its final energy, times a safety margin.
+    stopEpsilon is the smallest relative energy decrease per iteration seen
+    before that point in any run, so that no run stops earlier. Runs that
+    hit gditer did not converge; they keep needing gditer iterations.
+
+    Parameters
+    ----------
+    runs : list of dict
+        from parse_log or parse_energy_dumps
+    gditer : int, optional
+        maxGDIterations of the analyzed run, the recommendation is not
+        larger
+    epsilon : float, optional
+        stopEpsilon of the analyzed run, the recommendation is not smaller
+    tolerance : float, optional
+        see needed_iterations
+    margin : float, optional
+        factor applied to the needed iterations
+
+    Returns
+    -------
+    recommendation : dict
+        "maxGDIterations", "stopEpsilon", the number of analyzed "runs" and
+        of runs that were "capped"
+    """
+    if not runs:
+        raise ValueError("No gradient descent iterations were found")
+    needed = []
+    decrease = []
+    capped = 0
+    for run in runs:
+        n = needed_iterations(run["energies"], tolerance)
+        if gditer and len(run["energies"]) - 1 >= gditer:
+            capped += 1
+            n = gditer
+        needed.append(n)
+        d = _step_decrease(run["energies"], n)
+        if d is not None:
+            decrease.append(d)
+    iterations = int(np.ceil(max(needed)*margin))
+    if gditer:
+        iterations = min(iterations, int(gditer))
+    eps = min(decrease) if decrease else epsilon
+    if epsilon is not None and (eps is None or eps < epsilon):
+        eps = epsilon
+    return {"maxGDIterations": iterations, "stopEpsilon": eps,
+            "runs": len(runs), "capped": capped}
+
+
+def check_runs(runs, conf):
+    """
+    Check that runs parsed from a log agree with the config of the run
+
+    Every run must belong to a known stage and level of the config and no
+    stage can have more frames than were registered.
+
+    Parameters
+    ----------
+    runs : list of dict
+        from parse_log or parse_energy_dumps
+    conf : dict
+        the config file, see io_tools.read_config_file
+
+    Returns
+    -------
+    problems : list of str
+        empty if the runs are consistent with the config
+    """
+    if not runs:
+        return ["no gradient descent iterations were found"]
+    problems = []
+    unknown = sum(i["stage"] is None or i["level"] is None for i in runs)
+    if unknown:
+        problems.append(f"{unknown} of {len(runs)} runs have no stage or "
+                        "level, the log format was not recognized")
+    stages = int(conf.get("numExtraStages", 0)) + 1
+    levels = [int(conf[i]) for i in ("startLevel", "refineStartLevel",
+                                     "stopLevel", "refineStopLevel")
+              if i in conf]
+    frames = int(conf.get("numTemplates", 0))
+    for run in runs:
+        if run["stage"] is not None and not 1 <= run["stage"] <= stages:
+            problems.append(f"stage {run['stage']} is not one of the "
+                            f"{stages} stages of the config")
+            break
+    for run in runs:
+        if run["level"] is not None and levels and \
+                not min(levels) <= run["level"] <= max(levels):
+            problems.append(f"level {run['level']} is outside of the "
+                            f"levels {min(levels)} to {max(levels)}")
+            break
+    counted = {}
+    for run in runs:
+        if run["frame"] is not None:
+            counted.setdefault(run["stage"], set()).add(run["frame"])
+    for stage, found in counted.items():
+        if frames and len(found) > frames:
+            problems.append(f"stage {stage} has {len(found)} frames, the "
+                            f"config registers {frames}")
+    return problems
+
+
+def analyze(config_file, log_file=None, tolerance=1e-3, margin=1.2):
+    """
+    Analyze the convergence of a finished match-series run
+
+    Parameters
+    ----------
+    config_file : str
+        path to the config file of the run
+    log_file : str, optional
+        path to the match-series output. Defaults to the .log file next to
+        the config file, as written by calculate_non_rigid_registration.
+    tolerance : float, optional
+        see needed_iterations
+    margin : float, optional
+        see recommend
+
+    Returns
+    -------
+    report : dict
+        the current "maxGDIterations" and "stopEpsilon", the "summary" per
+        stage and level, the "problems" found by check_runs and the
+        "recommendation", which is "verified" if there are none
+    """
+    conf = read_config_file(config_file)
+    gditer = int(conf["maxGDIterations"]) if "maxGDIterations" in conf \
+        else None
+    epsilon = float(conf["stopEpsilon"]) if "stopEpsilon" in conf else None
+    if log_file is None:
+        log_file = os.path.splitext(config_file)[0] + ".log"
+    runs = []
+    if os.path.isfile(log_file):
+        runs = parse_log(log_file)
+    if "saveDirectory" in conf:
+        runs += parse_energy_dumps(conf["saveDirectory"].strip())
+    problems = check_runs(runs, conf)
+    recommendation = recommend(runs, gditer, epsilon, tolerance, margin)
+    recommendation["verified"] = not problems
+    return {"maxGDIterations": gditer, "stopEpsilon": epsilon,
+            "summary": summarize(runs, gditer, tolerance),
+            "problems": problems, "recommendation": recommendation}
+
+
+def apply_recommendation(config_file, recommendation, output_file=None,
+                         force=False):
+    """
+    Write the recommended maxGDIterations and stopEpsilon to a config file
+
+    Parameters
+    ----------
+    config_file : str
+        path to the config file
+    recommendation : dict
+        from analyze, or from recommend with force
+    output_file : str, optional
+        path of the updated config file. By default config_file is updated.
+    force : bool, optional
+        also write recommendations that are not verified
+    """
+    if not force and not recommendation.get("verified", False):
+        raise ValueError("The recommendation is not verified against the "
+                         "config of the analyzed run, see analyze")
+    with open(config_file) as f:
+        text = f.read()
+    for key in ("maxGDIterations", "stopEpsilon"):
+        value = recommendation[key]
+        if value is None:
+            continue
+        line = f"{key} {value}"
+        text, n = re.subn(rf"^{key}\s+.*$", line, text, flags=re.MULTILINE)
+        if n == 0:
+            text = text.rstrip("\n") + f"\n{line}\n"
+    with open(output_file or config_file, "w") as f:
+        f.write(text)
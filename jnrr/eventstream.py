@@ -0,0 +1,154 @@
+"""
+Fused spectrum correction from the event stream of a Velox emd file
+
+The regular path exports every spectrum stream frame to an .npz file,
+imports them again as a spectrum stream and warps every frame as a
+(channels, height, width) array. Here the raw stream of each frame is read
+from the emd file once and decoded into events, the source pixel and
+energy channel of every detected X-ray. Because the nearest neighbor warp
+of a frame only copies source pixels to output pixels, each event is
+counted directly into the output pixels that take their value from its
+pixel. No per-frame spectrum files and no dense frames are created. The
+sums are saved as SpectrumMap .hspy files with the axes of the stream, like
+apply_deformations saves them.
+
+In the Velox stream every pixel of a frame is terminated by PIXEL_MARKER,
+all other values are the energy channels of the events in that pixel.
+
+>>> maps = correct_emd_spectra("out/nonrigid_results_000", "data.emd")
+>>> maps["spectrumDeformed"].data.shape
+(4096, 512, 512)
+"""
+import os
+from pathlib import Path
+import numpy as np
+from .io_tools import read_config_file, _getNameCounterFrames
+from .alignment import read_shifts, compose_shift
+from .kernels import (_get_coordinates, displacement_statistics,
+                      inverse_warp_plan, scatter_events)
+from .processing import (load_deformation, _get_warp_plan,
+                         _create_spectrum_map)
+from .accumulate import smallest_dtype
+from .progress import ProgressTracker
+from ._imports import lazy_import
+
+dio = lazy_import("temmeta.data_io")
+
+PIXEL_MARKER = 65535
+
+
+def stream_events(stream, pixels, channels):
+    """
+    Decode the raw stream of one frame into events
+
+    Parameters
+    ----------
+    stream : numpy.ndarray
+        the raw stream values of the frame
+    pixels, channels : int
+        number of pixels of a frame and of energy channels, events outside
+        of them are dropped
+
+    Returns
+    -------
+    pixel, channel : numpy.ndarray
+        flat source pixel index and energy channel of every event
+    """
+    stream = np.asarray(stream).ravel()
+    markers = stream == PIXEL_MARKER
+    events = ~markers
+    # the pixel of an event is the number of markers before it
+    pixel = np.cumsum(markers)[events]
+    channel = stream[events].astype(np.intp)
+    keep = (pixel < pixels) & (channel < channels)
+    return pixel[keep], channel[keep]
+
+
+def correct_emd_spectra(result_folder, emd_path, dataset_index=0,
+                        output_folder=None, progress=None):
+    """
+    Sum the spectrum stream of an emd file with and without deformations
+
+    The spectra of the frames that were registered are corrected with the
+    deformations in result_folder, composed with the rigid shifts if the
+    frames were pre-aligned by extract_emd, like in apply_deformations.
+
+    Parameters
+    ----------
+    result_folder : str
+        path to the folder where non rigid registration saved its result
+    emd_path : str
+        path to the emd file the registered frames were extracted from
+    dataset_index : int, optional
+        index of the spectrum stream dataset
+    output_folder : str, optional
+        if given, the maps are saved there as spectrumUndeformed.hspy and
+        spectrumDeformed.hspy
+    progress : callable or list of callables, optional
+        receive progress reports, see progress.ProgressTracker
+
+    Returns
+    -------
+    maps : dict
+        "spectrumUndeformed" and "spectrumDeformed", temmeta.SpectrumMap
+        objects with the (channels, height, width) sums over the registered
+        frames
+    """
+    config_file = str(Path(result_folder + "/parameter-dump.txt"))
+    conf = read_config_file(config_file)
+    imfolder, _ = os.path.split(conf["templateNamePattern"])
+    rigid_shifts = read_shifts(imfolder)
+    (_, _, _, frames, skipframes, bznumber,
+        stage) = _getNameCounterFrames(config_file)
+    indexes = [i for i in range(frames) if i not in skipframes]
+    emd_path = str(Path(emd_path).absolute())
+    with dio.EMDFile(emd_path) as f:
+        uuid = f._get_ds_uuid("SpectrumStream", dataset_index)
+        # the stream without data, only for its axes and metadata
+        specstr = dio.SpectrumStream(
+            None, f._create_simple_metadata("SpectrumStream", uuid))
+        w, h, channels, _ = f._get_spectrum_stream_dim(uuid)
+        flut = f._get_spectrum_stream_flut(uuid)
+        raw = f.get_raw_data("SpectrumStream", uuid)
+        npix = h*w
+        # no bin can count more events than there are values in the stream
+        dtype = smallest_dtype(raw.shape[0])
+        undeformed = np.zeros((npix, channels), dtype=dtype)
+        deformed = np.zeros((npix, channels), dtype=dtype)
+        identity = inverse_warp_plan(np.arange(npix))
+        tracker = ProgressTracker("apply", len(indexes), progress,
+                                  label=result_folder)
+        for pos, i in enumerate(indexes):
+            ix1, ix2 = dio.EMDFile._get_frame_limits(i, flut)
+            stream = np.asarray(raw[ix1:ix2])
+            pixel, channel = stream_events(stream, npix, channels)
+            scatter_events(pixel, channel, *identity, undeformed)
+            defX, defY = load_deformation(result_folder, stage, bznumber, i,
+                                          pos == 0)
+            if defX.shape != (h, w):
+                raise ValueError(f"The deformations of shape {defX.shape} "
+                                 "do not match the spectrum stream of shape "
+                                 f"{(h, w)}")
+            if rigid_shifts is not None:
+                defX, defY = compose_shift(defX, defY, rigid_shifts[i])
+            if displacement_statistics(defX, defY)["identity"]:
+                inverse = identity
+            else:
+                inverse = inverse_warp_plan(
+                    _get_warp_plan(_get_coordinates(defX, defY)))
+            scatter_events(pixel, channel, *inverse, deformed)
+            tracker.update(1, stream.nbytes)
+        tracker.finish()
+    # (pixels, channels) to (channels, height, width) views
+    maps = {"spectrumUndeformed": _create_spectrum_map(
+                undeformed.T.reshape(channels, h, w), specstr,
+                "Sum of all frames"),
+            "spectrumDeformed": _create_spectrum_map(
+                deformed.T.reshape(channels, h, w), specstr,
+                "Applied non rigid registration, sum of all frames")}
+    if output_folder is not None:
+        if not os.path.isdir(output_folder):
+            os.makedirs(output_folder)
+        for key, value in maps.items():
+            value.to_hspy(str(Path(f"{output_folder}/{key}.hspy")))
+    return maps
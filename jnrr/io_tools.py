@@ -2,15 +2,35 @@
 Module that includes tools for converting experimental data into the
 file structure required for match-series
 """
-from temmeta import data_io as dio
-from PIL import Image
 import concurrent.futures as cf
+import functools
+import json
 import logging
 from pathlib import Path
 import os
 import numpy as np
 import re
 import bz2
+from .screening import find_bad_frames
+from .alignment import (estimate_shifts, apply_shifts, write_shifts,
+                        common_region)
+from .memory import plan_extraction
+from .progress import ProgressTracker
+from .sharedmem import SharedArray, imap_indexes
+from .tiffwriter import RawTiffWriter
+from .pipeline import ExtractedDataset
+from ._imports import lazy_import
+
+dio = lazy_import("temmeta.data_io")
+Image = lazy_import("PIL.Image")
+
+# data formats of export_frames that are not the file extension
+FRAME_EXTENSIONS = {"rawtiff": "tiff"}
+
+
+def frame_extension(data_format):
+    """File extension of frames exported with data_format"""
+    return FRAME_EXTENSIONS.get(data_format, data_format)
 
 
 def export_frame(frame, path):
@@ -19,32 +39,69 @@ def export_frame(frame, path):
     img.save(path)
 
 
-def _save_frame_to_file(i, data, path, name, counter, data_format="tiff"):
+def _save_frame_to_file(i, data, path, name, counter, data_format="tiff",
+                        writer_options=None):
     """Helper function for multithreading, saving frame i of stack"""
     c = str(i).zfill(counter)
-    fp = str(Path(f"{path}/{name}_{c}.{data_format}"))
+    fp = str(Path(f"{path}/{name}_{c}.{frame_extension(data_format)}"))
     frm = data[i]
+    if data_format == "rawtiff":
+        _raw_tiff_writer(frm.shape, frm.dtype.str,
+                         **(writer_options or {})).write(fp, frm)
+        return
     img = Image.fromarray(frm)
     img.save(fp)
 
 
+@functools.lru_cache(maxsize=16)
+def _raw_tiff_writer(shape, dtype, tile=None, compression=None,
+                     compression_level=6):
+    """Writer shared by all frames of a stack, also in worker processes"""
+    return RawTiffWriter(shape, dtype, tile=tile, compression=compression,
+                         compression_level=compression_level)
+
+
 class FrameByFrame(object):
-    """A pickle-able wrapper for doing a function on all frames of a stack"""
-    def __init__(self, do_in_loop, stack, *args, **kwargs):
+    """
+    A pickle-able wrapper for doing a function on all frames of a stack
+
+    The progress tracker holds a lock and is not pickled, a copy in another
+    process does not report progress.
+    """
+    def __init__(self, do_in_loop, stack, *args, tracker=None, **kwargs):
         self.func = do_in_loop
         self.stack = stack
         self.args = args
+        self.tracker = tracker
         self.kwargs = kwargs
 
     def __call__(self, index):
         self.func(index, self.stack, *self.args, **self.kwargs)
+        if self.tracker is not None:
+            self.tracker.update(1, self.stack[index].nbytes)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["tracker"] = None
+        return state
 
 
 def export_frames(stack, output_folder=None, prefix="frame",
                   digits=None, frames=None, multithreading=True,
-                  data_format="tiff"):
+                  data_format="tiff", workers=None, progress=None,
+                  use_processes=False, writer_options=None):
     """
     Export a 3D data array as individual images
+
+    workers limits the number of threads when multithreading is used.
+    progress receives progress reports, see progress.ProgressTracker.
+    With use_processes the frames are written by a process pool that reads
+    them from a copy of the stack in shared memory.
+
+    data_format "rawtiff" writes .tiff files directly from the frame
+    buffers with tiffwriter.RawTiffWriter instead of converting them with
+    PIL. writer_options are passed to it, e.g. {"tile": 256,
+    "compression": "deflate"}.
     """
     if frames is None:
         toloop = range(stack.frames)
@@ -52,21 +109,37 @@ def export_frames(stack, output_folder=None, prefix="frame",
         toloop = frames
     else:
         raise TypeError("Argument frames must be a list")
+    tracker = ProgressTracker("export", len(toloop), progress,
+                              label=output_folder)
+    if use_processes:
+        with SharedArray.from_array(stack.data) as data:
+            for _ in imap_indexes(_save_frame_to_file, toloop, [data],
+                                  output_folder, prefix, digits, data_format,
+                                  writer_options, workers=workers):
+                tracker.update(1, data.array[0].nbytes)
+        tracker.finish()
+        return
+    save = FrameByFrame(_save_frame_to_file, stack.data, output_folder,
+                        prefix, digits, data_format, writer_options,
+                        tracker=tracker)
     if multithreading:
-        with cf.ThreadPoolExecutor() as pool:
-            pool.map(FrameByFrame(_save_frame_to_file, stack.data,
-                                  output_folder, prefix, digits, data_format),
-                     toloop)
+        with cf.ThreadPoolExecutor(max_workers=workers) as pool:
+            # consume the results to raise errors of the workers
+            list(pool.map(save, toloop))
     else:
         for i in toloop:
-            _save_frame_to_file(i, stack.data, output_folder, prefix, digits,
-                                data_format)
+            save(i)
+    tracker.finish()
 
 
 def extract_emd(input_path, output_folder=None, prefix="frame",
                 image_dataset_index=None, spectrum_dataset_index=None,
                 digits=None, image_post_processing=None, frames=None,
-                extension="tiff", multithreading=True, **kwargs):
+                extension="tiff", multithreading=True, tile_size=None,
+                tile_overlap=32, skip_bad_frames=False,
+                bad_frame_threshold=5., prealign=False, memory_limit=None,
+                progress=None, use_processes=False, writer_options=None,
+                keep_stacks=False, **kwargs):
     """
     Extract images and spectrum data from Velox emd files using TEMMETA.
 
@@ -97,9 +170,47 @@ def extract_emd(input_path, output_folder=None, prefix="frame",
     frames: list, optional
         a list of indexes of frames that should be exported if not all.
     extension: str, optional
-        extension of the exported images
+        extension of the exported images, or "rawtiff" to write .tiff files
+        directly from the frame buffers, see export_frames
     multithreading : bool, optional
         whether to use multithreading to export
+    tile_size : int, optional
+        if given, the frames are also exported as overlapping square tiles
+        of this power of 2 size, with a config file per tile. See
+        tiling.run_tiled_registration to register the tiles and stitch the
+        deformations into the regular result folder.
+    tile_overlap : int, optional
+        minimum overlap between the tiles in pixels
+    skip_bad_frames : bool, optional
+        screen the frames for outliers in intensity, sharpness and
+        correlation with their neighbors and add them to the skipped frames
+        in the config file. The statistics are saved to
+        frame_statistics.json in the image folder.
+    bad_frame_threshold : float, optional
+        robust z-score above which a frame is considered bad
+    prealign : bool, optional
+        estimate the translation of each frame with respect to the first
+        with FFT cross-correlation and export the shifted frames. The shifts
+        are saved to rigid_shifts.json in the image folder, and are
+        composed with the non-rigid deformations by
+        processing.apply_deformations.
+    memory_limit : int or str, optional
+        memory budget like "8GB". If given, the number of export threads and
+        the number of frames per batch of the screening and pre-alignment
+        are chosen with memory.plan_extraction to stay within the budget.
+    progress : callable or list of callables, optional
+        receive progress reports of the export of every dataset, see
+        progress.ProgressTracker
+    use_processes : bool, optional
+        export the frames on a process pool that reads them from shared
+        memory instead of on threads
+    writer_options : dict, optional
+        tiling and compression options of the "rawtiff" extension, see
+        export_frames
+    keep_stacks : bool, optional
+        keep the exported image stacks in memory and return them as
+        pipeline.ExtractedDataset objects under "datasets", to be passed
+        to processing.apply_deformations
 
     Additional parameters
     ---------------------
@@ -118,6 +229,8 @@ def extract_emd(input_path, output_folder=None, prefix="frame",
         os.makedirs(output_folder)
     # remove spaces in the prefix if any
     prefix = prefix.replace(" ", "")
+    # frames to skip can be extended per dataset by the screening
+    skipframes = list(kwargs.pop("skipframes", []))
     # read the file
     try:
         f = dio.EMDFile(input_path)
@@ -139,10 +252,21 @@ def extract_emd(input_path, output_folder=None, prefix="frame",
     image_paths = []
     output_paths = []
     config_paths = []
+    tiling_paths = []
+    datasets = []
     for j, k in dsets:
         try:
             ima = f.get_dataset("Image", k)
             logging.debug(f"Succesfully read dataset {k}")
+            chunk, workers = 64, None
+            if memory_limit is not None:
+                plan = plan_extraction(ima.height, ima.width, ima.frames,
+                                       ima.data.dtype, memory_limit)
+                logging.info(f"Extraction plan of dataset {k}: {plan}")
+                if not plan["fits"]:
+                    logging.warning(f"Dataset {k} does not fit in the "
+                                    "memory limit")
+                chunk, workers = plan["chunk"], plan["workers"]
             # apply filter function to image stack if given
             if image_post_processing is not None:
                 try:
@@ -153,6 +277,17 @@ def extract_emd(input_path, output_folder=None, prefix="frame",
             opath = str(Path(f"{output_folder}/images_{c}/"))
             if not os.path.isdir(opath):
                 os.makedirs(opath)
+            screened = ima.data
+            if prealign:
+                shifts = estimate_shifts(ima.data, chunk=chunk)
+                ima.data = apply_shifts(ima.data, shifts)
+                write_shifts(opath, shifts)
+                logging.debug(f"Pre-aligned the frames of dataset {k}")
+                # the filled borders would bias the frame statistics, the
+                # raw frames are screened if no region is common to all
+                region = common_region(shifts, ima.data.shape[1:])
+                if region is not None:
+                    screened = ima.data[(slice(None),) + region]
             if digits is None:
                 digits = dio._get_counter(ima.frames)
             else:
@@ -161,13 +296,29 @@ def extract_emd(input_path, output_folder=None, prefix="frame",
                           prefix=prefix,
                           digits=digits, frames=frames,
                           multithreading=multithreading,
-                          data_format=extension)
+                          data_format=extension, workers=workers,
+                          progress=progress, use_processes=use_processes,
+                          writer_options=writer_options)
             ima.metadata.to_file(f"{opath}/metadata_images.json")
+            dset_skipframes = skipframes
+            if skip_bad_frames:
+                bad, stats = find_bad_frames(screened,
+                                             threshold=bad_frame_threshold,
+                                             chunk=chunk)
+                with open(str(Path(f"{opath}/frame_statistics.json")),
+                          "w") as sf:
+                    json.dump({"bad_frames": bad,
+                               **{n: v.tolist() for n, v in stats.items()}},
+                              sf, indent=4)
+                logging.info(f"Frames {bad} of dataset {k} were flagged as "
+                             "bad and will be skipped")
+                dset_skipframes = sorted(set(skipframes) | set(bad))
             # also create a config file for all datasets
             # construct the config file
             filename = str(Path(output_folder+f"/matchSeries_{c}.par"))
             pathpattern = str(Path(
-              output_folder+f"/images_{c}/{prefix}_%0{digits}d.{extension}"))
+              output_folder+f"/images_{c}/{prefix}_%0{digits}d."
+              f"{frame_extension(extension)}"))
             abspath = str(Path(output_folder))
             # already create the folder for the output
             outputpath = str(Path(f"{abspath}/nonrigid_results_{c}/"))
@@ -177,12 +328,30 @@ def extract_emd(input_path, output_folder=None, prefix="frame",
             write_config_file(filename, pathpattern=pathpattern,
                               savedir=outputpath,
                               preclevel=outlevel, num_frames=ima.frames,
-                              **kwargs)
+                              skipframes=dset_skipframes, **kwargs)
             print(f"Dataset {k} was exported to {opath}. A config file "
                   f"{filename} was created.")
+            if tile_size is not None:
+                from .tiling import export_tiles
+                tilefolder = str(Path(f"{output_folder}/tiles_{c}/"))
+                layout_file = export_tiles(
+                    ima, tilefolder, tile_size, overlap=tile_overlap,
+                    prefix=prefix, digits=digits, pathpattern=pathpattern,
+                    result_folder=outputpath, skipframes=dset_skipframes,
+                    multithreading=multithreading, extension=extension,
+                    **kwargs)
+                print(f"Dataset {k} was split in tiles, the layout is in "
+                      f"{layout_file}.")
+                tiling_paths.append(layout_file)
             image_paths.append(opath)
             output_paths.append(outputpath)
             config_paths.append(filename)
+            if keep_stacks:
+                datasets.append(ExtractedDataset(
+                    input_path, k, opath, filename, outputpath, stack=ima,
+                    prealigned=prealign,
+                    image_post_processing=image_post_processing,
+                    frames=frames))
         except Exception as e:
             logging.warning(f"Dataset {k} was not exported: {e}")
     # Spectrumstreams
@@ -194,7 +363,9 @@ def extract_emd(input_path, output_folder=None, prefix="frame",
         return {"image_folder_paths": image_paths,
                 "output_folder_paths": output_paths,
                 "spectrum_folder_paths": None,
-                "config_file_paths": config_paths}
+                "config_file_paths": config_paths,
+                "tiling_file_paths": tiling_paths,
+                "datasets": datasets}
     spectrum_paths = []
     # if no dataset is given we extract all of them
     if spectrum_dataset_index is None:
@@ -222,7 +393,22 @@ def extract_emd(input_path, output_folder=None, prefix="frame",
     return {"image_folder_paths": image_paths,
             "output_folder_paths": output_paths,
             "spectrum_folder_paths": spectrum_paths,
-            "config_file_paths": config_paths}
+            "config_file_paths": config_paths,
+            "tiling_file_paths": tiling_paths,
+            "datasets": datasets}
+
+
+def dataset_spectra(paths):
+    """
+    Spectrum folder of each image dataset in the paths of extract_emd
+
+    The spectrum streams are paired with the image datasets in order, so
+    every stream is corrected with the deformations of one dataset. Image
+    datasets without a stream of their own get None.
+    """
+    spectra = paths["spectrum_folder_paths"] or []
+    return [spectra[j] if j < len(spectra) else None
+            for j in range(len(paths["image_folder_paths"]))]
 
 
 def write_dict_to_config_file(filename, dic):
@@ -409,6 +595,33 @@ def loadFromQ2bz(path):
     return img
 
 
+def saveToQ2bz(path, img):
+    """
+    Write a 2D array as a bz2 compressed QuOcMesh file readable by
+    loadFromQ2bz and match-series
+    """
+    img = np.ascontiguousarray(img)
+    if img.dtype == np.float64:
+        magic = "P9"
+        typename = "RAW DOUBLE"
+    elif img.dtype == np.float32:
+        magic = "P8"
+        typename = "RAW FLOAT"
+    else:
+        raise NotImplementedError(
+            f"Invalid data type ({img.dtype}), only float and "
+            "double are supported currently")
+    height, width = img.shape
+    header = (f"{magic}\n"
+              f"# This is a QuOcMesh file of type {magic[1]} (={typename}) "
+              "written by jnrr\n"
+              f"{width} {height}\n"
+              "255\n")
+    with bz2.open(path, "wb") as fid:
+        fid.write(header.encode("ascii"))
+        fid.write(img.tobytes())
+
+
 def _getNameCounterFrames(path):
     """
     Extract relevant information from the config file for processing
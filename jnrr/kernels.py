@@ -0,0 +1,253 @@
+"""
+Compiled kernels for applying the deformations
+
+The nearest neighbor warp used to correct images and spectra is a simple
+gather: every output pixel takes the value of the rounded deformed position
+in the input, or a constant when that position lies outside of the frame.
+If numba is installed this gather is compiled and run in parallel directly
+on the deformation fields, without building coordinate arrays. Otherwise
+the functions fall back to scipy.ndimage.map_coordinates, which gives
+identical results.
+"""
+import functools
+import importlib.util
+import numpy as np
+from ._imports import lazy_import
+
+ndimage = lazy_import("scipy.ndimage")
+
+# numba is only imported when the first kernel is compiled
+HAS_NUMBA = importlib.util.find_spec("numba") is not None
+
+
+def _get_coordinates(defX, defY):
+    """Sampling coordinates (2, h, w) for map_coordinates from deformations"""
+    h, w = defX.shape
+    return np.mgrid[0:h, 0:w] + np.multiply([defY, defX], (np.max([h, w])-1))
+
+
+def displacement_statistics(defX, defY):
+    """
+    Displacement of the pixels of a frame by the deformations
+
+    Parameters
+    ----------
+    defX, defY : numpy.ndarray
+        the deformations normalized by the largest image dimension - 1
+
+    Returns
+    -------
+    statistics : dict
+        "max_shift" and "rms_shift" the largest and the root mean square
+        length of the displacements in pixels, and "identity" whether the
+        nearest neighbor warp returns the frame unchanged: every position
+        rounds to its own pixel and none lies outside of the frame
+    """
+    h, w = defX.shape
+    scale = max(h, w) - 1
+    rows = np.arange(h)[:, None]
+    cols = np.arange(w)[None, :]
+    cy = rows + defY*scale
+    cx = cols + defX*scale
+    squares = (cy - rows)**2 + (cx - cols)**2
+    identity = bool(np.all(np.floor(cy + 0.5) == rows) and
+                    np.all(np.floor(cx + 0.5) == cols) and
+                    np.all(cy[0] >= 0) and np.all(cy[-1] <= h-1) and
+                    np.all(cx[:, 0] >= 0) and np.all(cx[:, -1] <= w-1))
+    return {"max_shift": float(np.sqrt(squares.max())),
+            "rms_shift": float(np.sqrt(squares.mean())),
+            "identity": identity}
+
+
+@functools.lru_cache(maxsize=None)
+def _kernels():
+    """Import numba and define the kernels, once per process"""
+    from numba import njit, prange
+
+    @njit(parallel=True, cache=True)
+    def _nearest_image(image, defX, defY, cval, out):
+        h, w = image.shape
+        scale = max(h, w) - 1
+        for y in prange(h):
+            for x in range(w):
+                cy = y + defY[y, x]*scale
+                cx = x + defX[y, x]*scale
+                if cy >= 0 and cy <= h-1 and cx >= 0 and cx <= w-1:
+                    out[y, x] = image[int(np.floor(cy + 0.5)),
+                                      int(np.floor(cx + 0.5))]
+                else:
+                    out[y, x] = cval
+        return out
+
+    @njit(parallel=True, cache=True)
+    def _nearest_rows(cube, defX, defY, out):
+        channels, h, w = cube.shape
+        scale = max(h, w) - 1
+        for y in prange(h):
+            for x in range(w):
+                cy = y + defY[y, x]*scale
+                cx = x + defX[y, x]*scale
+                if cy >= 0 and cy <= h-1 and cx >= 0 and cx <= w-1:
+                    iy = int(np.floor(cy + 0.5))
+                    ix = int(np.floor(cx + 0.5))
+                    for c in range(channels):
+                        out[c, y, x] = cube[c, iy, ix]
+                else:
+                    for c in range(channels):
+                        out[c, y, x] = 0
+        return out
+
+    @njit(parallel=True, cache=True)
+    def _nearest_channels(cube, defX, defY, out):
+        channels, h, w = cube.shape
+        scale = max(h, w) - 1
+        for c in prange(channels):
+            for y in range(h):
+                for x in range(w):
+                    cy = y + defY[y, x]*scale
+                    cx = x + defX[y, x]*scale
+                    if cy >= 0 and cy <= h-1 and cx >= 0 and cx <= w-1:
+                        out[c, y, x] = cube[c, int(np.floor(cy + 0.5)),
+                                            int(np.floor(cx + 0.5))]
+                    else:
+                        out[c, y, x] = 0
+        return out
+
+    @njit(cache=True)
+    def _scatter_events(pixels, channels, starts, outputs, out):
+        for e in range(pixels.shape[0]):
+            s = pixels[e]
+            for k in range(starts[s], starts[s+1]):
+                out[outputs[k], channels[e]] += 1
+        return out
+
+    return {"image": _nearest_image, "rows": _nearest_rows,
+            "channels": _nearest_channels, "events": _scatter_events}
+
+
+def _fill_value(cval, dtype):
+    """The fill value as map_coordinates stores it in an array of dtype"""
+    if not np.issubdtype(dtype, np.integer):
+        return np.array(cval).astype(dtype)
+    # rounded half away from zero and saturated, in exact integers
+    info = np.iinfo(dtype)
+    rounded = int(np.copysign(np.floor(abs(float(cval)) + 0.5), cval))
+    return np.array(min(max(rounded, info.min), info.max), dtype=dtype)
+
+
+def warp_image(image, defX, defY, cval=0.):
+    """
+    Nearest neighbor warp of a 2D image with the match-series deformations
+
+    Parameters
+    ----------
+    image : numpy.ndarray
+        (height, width) image
+    defX, defY : numpy.ndarray
+        the deformations normalized by the largest image dimension - 1
+    cval : float, optional
+        value of the pixels that map outside of the image
+
+    Returns
+    -------
+    deformed : numpy.ndarray
+        the warped image with the same dtype as image
+    """
+    if HAS_NUMBA:
+        out = np.empty_like(image)
+        fill = _fill_value(cval, image.dtype)
+        return _kernels()["image"](image, defX, defY, fill, out)
+    return ndimage.map_coordinates(image, _get_coordinates(defX, defY),
+                                   order=0, mode="constant", cval=cval)
+
+
+def warp_channels(cube, defX, defY, parallel_channels=False):
+    """
+    Nearest neighbor warp of all channels of a (channels, h, w) array
+
+    Pixels that map outside of the frame are set to 0.
+
+    Parameters
+    ----------
+    cube : numpy.ndarray
+        (channels, height, width) array, e.g. a dense spectrum frame
+    defX, defY : numpy.ndarray
+        the deformations normalized by the largest image dimension - 1
+    parallel_channels : bool, optional
+        parallelize over the channels instead of over the rows. Only has an
+        effect with numba, it is faster when there are many channels and
+        few rows.
+
+    Returns
+    -------
+    deformed : numpy.ndarray
+        the warped array with the same dtype as cube
+    """
+    if HAS_NUMBA:
+        out = np.empty_like(cube)
+        if parallel_channels:
+            return _kernels()["channels"](cube, defX, defY, out)
+        return _kernels()["rows"](cube, defX, defY, out)
+    coords = _get_coordinates(defX, defY)
+    return np.array([ndimage.map_coordinates(i, coords, order=0,
+                                             mode="constant")
+                     for i in cube])
+
+
+def inverse_warp_plan(plan, pixels=None):
+    """
+    Output pixels of each source pixel of a nearest neighbor warp plan
+
+    Parameters
+    ----------
+    plan : numpy.ndarray
+        flat source pixel index of each output pixel, -1 for none
+    pixels : int, optional
+        number of source pixels, defaults to the number of output pixels
+
+    Returns
+    -------
+    starts, outputs : numpy.ndarray
+        the output pixels of source pixel s are
+        outputs[starts[s]:starts[s+1]]
+    """
+    if pixels is None:
+        pixels = plan.shape[0]
+    valid = np.nonzero(plan >= 0)[0]
+    sources = plan[valid]
+    outputs = valid[np.argsort(sources, kind="stable")]
+    starts = np.zeros(pixels + 1, dtype=np.int64)
+    starts[1:] = np.cumsum(np.bincount(sources, minlength=pixels))
+    return starts, outputs
+
+
+def scatter_events(pixels, channels, starts, outputs, out):
+    """
+    Count events into the output pixels of their source pixel
+
+    Every event (pixels[e], channels[e]) adds one count to
+    out[o, channels[e]] for each output pixel o that the warp takes from
+    its pixel, see inverse_warp_plan.
+
+    Parameters
+    ----------
+    pixels, channels : numpy.ndarray
+        source pixel and energy channel of every event
+    starts, outputs : numpy.ndarray
+        the inverse warp plan
+    out : numpy.ndarray
+        (pixels, channels) counts that are added to in place
+
+    Returns
+    -------
+    out : numpy.ndarray
+    """
+    if HAS_NUMBA:
+        return _kernels()["events"](pixels, channels, starts, outputs, out)
+    multiplicity = starts[pixels + 1] - starts[pixels]
+    event = np.repeat(np.arange(pixels.shape[0]), multiplicity)
+    first = np.repeat(np.cumsum(multiplicity) - multiplicity, multiplicity)
+    target = outputs[starts[pixels][event] + np.arange(event.shape[0]) -
+                     first]
+    np.add.at(out, (target, channels[event]), 1)
+    return out
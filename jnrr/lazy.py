@@ -0,0 +1,380 @@
+"""
+Lazy versions of the extraction, correction and averaging steps using dask
+
+The image stack, the deformation fields and the spectrum stream are
+represented as dask arrays with one chunk per frame (and optionally a number
+of energy channels). Warping is a blockwise per-frame task, averages and
+spectrum maps are reductions. Nothing is computed or written to disk until
+compute is called, so the same code runs on the threaded or process
+scheduler or on a (local) distributed cluster:
+
+>>> stack = lazy.emd_image_stack("data.emd", 2)
+>>> frames, fields = lazy.deformation_fields("nonrigid_results_002")
+>>> corrected = lazy.warp_images(stack[frames], fields)
+>>> avg, = dask.compute(lazy.average(corrected), scheduler="processes")
+
+The blocks only hold file paths and frame indexes, never open file handles,
+so the graphs can be sent to worker processes.
+"""
+import os
+from pathlib import Path
+import numpy as np
+from .io_tools import read_config_file, _getNameCounterFrames
+from .processing import load_deformation
+from .alignment import read_shifts, compose_shift
+from .kernels import warp_image, warp_channels
+from .accumulate import smallest_dtype
+from ._imports import lazy_import
+
+dio = lazy_import("temmeta.data_io")
+
+try:
+    import dask
+    import dask.array as da
+except ImportError:
+    dask = None
+    da = None
+
+
+def _require_dask():
+    if da is None:
+        raise ImportError("The lazy API requires dask, install it with "
+                          "`pip install dask[array]`")
+
+
+def _read_image_frame(path, uuid, index):
+    """Read frame index of an image dataset from an emd file"""
+    with dio.EMDFile(path) as f:
+        return np.array(f.get_raw_data("Image", uuid)[:, :, index])
+
+
+def emd_image_stack(path, dataset_index=0):
+    """
+    Image dataset of an emd file as (frames, height, width) dask array
+
+    Parameters
+    ----------
+    path : str
+        path to the emd file
+    dataset_index : int, optional
+        index of the image dataset
+
+    Returns
+    -------
+    stack : dask.array.Array
+        lazy image stack, one chunk per frame
+    """
+    _require_dask()
+    path = str(Path(path).absolute())
+    with dio.EMDFile(path) as f:
+        uuid = f._get_ds_uuid("Image", dataset_index)
+        raw = f.get_raw_data("Image", uuid)
+        h, w, frames = raw.shape
+        dtype = raw.dtype
+    read = dask.delayed(_read_image_frame, pure=True)
+    return da.stack([da.from_delayed(read(path, uuid, i), shape=(h, w),
+                                     dtype=dtype)
+                     for i in range(frames)])
+
+
+def _read_stream_frame(path, uuid, index, dimensions, channel_slice):
+    """Read frame index of a spectrum stream and return the dense block"""
+    channels, h, w = dimensions
+    with dio.EMDFile(path) as f:
+        flut = f._get_spectrum_stream_flut(uuid)
+        ix1, ix2 = dio.EMDFile._get_frame_limits(index, flut)
+        d1d = f.get_raw_data("SpectrumStream", uuid)[ix1:ix2].flatten()
+    frame = dio.EMDFile._convert_stream_to_sparse(
+        d1d, (w, h, channels, 1), compress_type="csr")
+    return _sparse_to_block(frame, (h, w), channel_slice)
+
+
+def _read_npz_frame(path, dimensions, channel_slice):
+    """Read a spectrum stream frame .npz file and return the dense block"""
+    from scipy.sparse import load_npz
+    _, h, w = dimensions
+    return _sparse_to_block(load_npz(path).tocsr(), (h, w), channel_slice)
+
+
+def _sparse_to_block(frame, shape, channel_slice):
+    """Dense (channels, h, w) block of a (pixels, channels) sparse frame"""
+    h, w = shape
+    c0, c1 = channel_slice
+    return frame[:, c0:c1].toarray().T.reshape(c1-c0, h, w)
+
+
+def _spectrum_array(read, sources, dimensions, dtype, channel_chunk):
+    """Build (frames, channels, height, width) array from block readers"""
+    channels, h, w = dimensions
+    if channel_chunk is None:
+        channel_chunk = channels
+    read = dask.delayed(read, pure=True)
+    frames = []
+    for source in sources:
+        blocks = []
+        for c0 in range(0, channels, channel_chunk):
+            c1 = min(c0+channel_chunk, channels)
+            blocks.append(da.from_delayed(
+                read(*source, dimensions, (c0, c1)),
+                shape=(c1-c0, h, w), dtype=dtype))
+        frames.append(da.concatenate(blocks, axis=0))
+    return da.stack(frames)
+
+
+def emd_spectrum_stream(path, dataset_index=0, channel_chunk=None):
+    """
+    Spectrum stream of an emd file as (frames, channels, h, w) dask array
+
+    The raw event stream of each frame is only read and converted when a
+    block is computed.
+
+    Parameters
+    ----------
+    path : str
+        path to the emd file
+    dataset_index : int, optional
+        index of the spectrum stream dataset
+    channel_chunk : int, optional
+        number of energy channels per chunk. By default one chunk contains
+        all channels of a frame.
+
+    Returns
+    -------
+    spectra : dask.array.Array
+        lazy spectrum stream
+    """
+    _require_dask()
+    path = str(Path(path).absolute())
+    with dio.EMDFile(path) as f:
+        uuid = f._get_ds_uuid("SpectrumStream", dataset_index)
+        w, h, channels, frames = f._get_spectrum_stream_dim(uuid)
+        dtype = f.get_raw_data("SpectrumStream", uuid).dtype
+    sources = [(path, uuid, i) for i in range(frames)]
+    return _spectrum_array(_read_stream_frame, sources, (channels, h, w),
+                           dtype, channel_chunk)
+
+
+def folder_spectrum_stream(spectra_folder, dimensions, channel_chunk=None,
+                           dtype=np.uint16):
+    """
+    Spectrum frames exported as .npz files as (frames, channels, h, w) array
+
+    Parameters
+    ----------
+    spectra_folder : str
+        path to the folder with the spectrum stream frames
+    dimensions : tuple
+        (channels, height, width) of the frames
+    channel_chunk : int, optional
+        number of energy channels per chunk
+    dtype : numpy dtype, optional
+        dtype of the counts
+
+    Returns
+    -------
+    spectra : dask.array.Array
+        lazy spectrum stream
+    """
+    _require_dask()
+    files = sorted(Path(spectra_folder).glob("*_[0-9]*.npz"))
+    sources = [(str(i),) for i in files]
+    return _spectrum_array(_read_npz_frame, sources, dimensions, dtype,
+                           channel_chunk)
+
+
+def _read_deformation(result_folder, stage, bznumber, index, first_frame,
+                      shift=None):
+    defX, defY = load_deformation(result_folder, stage, bznumber, index,
+                                  first_frame)
+    if shift is not None:
+        defX, defY = compose_shift(defX, defY, shift)
+    return np.stack([defX, defY])
+
+
+def deformation_fields(result_folder, rigid_shifts=True):
+    """
+    The deformations calculated by match-series as a lazy array
+
+    Parameters
+    ----------
+    result_folder : str
+        path to the folder where non rigid registration saved its result
+    rigid_shifts : bool, optional
+        if the registered frames were pre-aligned, compose the rigid shifts
+        with the deformations so that they apply to the original data, e.g.
+        the stacks of the emd file. If False the fields apply to the
+        aligned frames.
+
+    Returns
+    -------
+    frames : list of int
+        the indexes of the frames for which there is a deformation
+    fields : dask.array.Array
+        (frames, 2, height, width) array of the x and y deformations
+    """
+    _require_dask()
+    config_file = str(Path(result_folder + "/parameter-dump.txt"))
+    (_, _, _, numframes, skipframes, bznumber,
+        stage) = _getNameCounterFrames(config_file)
+    frames = [i for i in range(numframes) if i not in skipframes]
+    shifts = [None]*numframes
+    if rigid_shifts:
+        imfolder, _ = os.path.split(
+            read_config_file(config_file)["templateNamePattern"])
+        found = read_shifts(imfolder)
+        if found is not None:
+            shifts = [tuple(int(j) for j in i) for i in found]
+    # the shape is only known after reading a field
+    first = _read_deformation(result_folder, stage, bznumber, frames[0],
+                              True, shifts[frames[0]])
+    read = dask.delayed(_read_deformation, pure=True)
+    fields = [da.from_array(first, chunks=first.shape)]
+    for i in frames[1:]:
+        fields.append(da.from_delayed(
+            read(result_folder, stage, bznumber, i, False, shifts[i]),
+            shape=first.shape, dtype=first.dtype))
+    return frames, da.stack(fields)
+
+
+def _warp_block(block, fields, cval=0.):
+    """Warp all frames and channels in a block with the matching fields"""
+    out = np.empty_like(block)
+    for j in range(block.shape[0]):
+        if block.ndim == 3:
+            fill = block[j].mean() if cval == "mean" else cval
+            out[j] = warp_image(block[j], fields[j, 0], fields[j, 1],
+                                cval=fill)
+        else:
+            out[j] = warp_channels(block[j], fields[j, 0], fields[j, 1])
+    return out
+
+
+def _per_frame(array, fields):
+    """Rechunk to one full frame per chunk, fields entirely per frame"""
+    chunks = {0: 1, array.ndim-2: -1, array.ndim-1: -1}
+    return (array.rechunk(chunks),
+            fields.rechunk((1, 2) + fields.shape[2:]))
+
+
+def warp_images(stack, fields, cval="mean"):
+    """
+    Apply the deformations to a (frames, height, width) image stack
+
+    Parameters
+    ----------
+    stack : dask.array.Array
+        the image stack, must have the same number of frames as fields
+    fields : dask.array.Array
+        (frames, 2, height, width) deformations
+    cval : float or "mean", optional
+        the value outside of the image. By default the mean of each frame.
+
+    Returns
+    -------
+    corrected : dask.array.Array
+        the corrected image stack
+    """
+    _require_dask()
+    stack, fields = _per_frame(stack, fields)
+    return da.blockwise(_warp_block, "fyx", stack, "fyx", fields, "fdyx",
+                        concatenate=True, dtype=stack.dtype, cval=cval)
+
+
+def warp_spectra(spectra, fields):
+    """
+    Apply the deformations to a (frames, channels, height, width) stream
+
+    Each block of energy channels of each frame is warped independently.
+
+    Parameters
+    ----------
+    spectra : dask.array.Array
+        the spectrum stream, must have the same number of frames as fields
+    fields : dask.array.Array
+        (frames, 2, height, width) deformations
+
+    Returns
+    -------
+    corrected : dask.array.Array
+        the corrected spectrum stream
+    """
+    _require_dask()
+    spectra, fields = _per_frame(spectra, fields)
+    return da.blockwise(_warp_block, "fcyx", spectra, "fcyx", fields, "fdyx",
+                        concatenate=True, dtype=spectra.dtype)
+
+
+def average(stack):
+    """Lazy average over the frames of an image stack"""
+    return stack.mean(axis=0)
+
+
+def spectrum_map(spectra, dtype=None):
+    """
+    Lazy (channels, height, width) sum over the frames of a stream
+
+    By default the sum uses the smallest integer type that can not overflow
+    for the number of frames and the data type of the stream.
+    """
+    if dtype is None and np.issubdtype(spectra.dtype, np.integer):
+        dtype = smallest_dtype(
+            spectra.shape[0]*int(np.iinfo(spectra.dtype).max))
+    return spectra.sum(axis=0, dtype=dtype)
+
+
+def correct(result_folder, emd_path, image_dataset_index=0,
+            spectrum_dataset_index=None, channel_chunk=None):
+    """
+    Build the full lazy correction of an emd dataset
+
+    The stacks of the emd file are not pre-aligned, so the rigid shifts of
+    pre-aligned registrations are composed with the deformations.
+
+    Parameters
+    ----------
+    result_folder : str
+        path to the folder where non rigid registration saved its result
+    emd_path : str
+        path to the emd file from which the data is read
+    image_dataset_index : int, optional
+        index of the image dataset to correct
+    spectrum_dataset_index : int, optional
+        index of the spectrum stream dataset to correct. If None no spectra
+        are corrected.
+    channel_chunk : int, optional
+        number of energy channels per chunk of the spectrum stream
+
+    Returns
+    -------
+    results : dict
+        lazy "averageUndeformed", "averageDeformed", "imagesDeformed" and if
+        spectra are corrected "spectrumUndeformed" and "spectrumDeformed".
+        Compute them together with dask.compute(results) so that the input
+        is read only once.
+    """
+    frames, fields = deformation_fields(result_folder)
+    stack = emd_image_stack(emd_path, image_dataset_index)
+    deformed = warp_images(stack[frames], fields)
+    results = {"averageUndeformed": average(stack),
+               "averageDeformed": average(deformed),
+               "imagesDeformed": deformed}
+    if spectrum_dataset_index is not None:
+        spectra = emd_spectrum_stream(emd_path, spectrum_dataset_index,
+                                      channel_chunk)[frames]
+        results["spectrumUndeformed"] = spectrum_map(spectra)
+        results["spectrumDeformed"] = spectrum_map(warp_spectra(spectra,
+                                                                fields))
+    return results
+
+
+def local_client(n_workers=None, threads_per_worker=1, **kwargs):
+    """
+    Start a local distributed cluster and return a client connected to it
+
+    Once the client exists, dask.compute uses it by default. Other clusters
+    can be used by creating a distributed.Client with their address instead.
+    """
+    from distributed import Client, LocalCluster
+    cluster = LocalCluster(n_workers=n_workers,
+                           threads_per_worker=threads_per_worker, **kwargs)
+    return Client(cluster)
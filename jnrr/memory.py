@@ -0,0 +1,274 @@
+"""
+Memory budget governor for extraction and correction
+
+The working set of the steps is estimated from the dimensions and data
+types of the data, before anything is loaded. From a memory budget the
+planners choose how many frames are processed at once, how many workers
+run concurrently and how the spectra are corrected:
+
+* "dense": every spectrum frame is warped as a (channels, height, width)
+  array and the corrected stream is kept in memory (fastest)
+* "sparse": spectrum frames are read one at a time, warped in sparse form
+  and written out as they are calculated, the summed spectrum maps fit in
+  memory
+* "tiled": like "sparse", but the summed maps are spilled to memory-mapped
+  scratch files in tiles that fit the budget
+
+The plans are plain dictionaries, so they can be inspected, logged or
+adjusted before they are used.
+
+>>> plan = plan_correction(1024, 1024, 200, channels=4096,
+...                        counts=5e8, memory_limit="16GB")
+>>> plan["spectra"]
+'tiled'
+"""
+import glob
+import os
+import re
+from pathlib import Path
+import numpy as np
+
+# bytes per stored value of a CSR matrix besides the value: int32 index
+_CSR_INDEX = 4
+# dtype of the summed spectrum maps and the deformation fields
+_SUM_DTYPE = np.dtype(np.uint32)
+_FIELD_DTYPE = np.dtype(np.float64)
+
+
+def parse_memory_limit(memory_limit):
+    """Convert a memory limit like 2e9, "500MB" or "4GB" to bytes"""
+    if isinstance(memory_limit, (int, float)):
+        return int(memory_limit)
+    units = {"B": 1, "KB": 1e3, "MB": 1e6, "GB": 1e9, "TB": 1e12,
+             "KIB": 2**10, "MIB": 2**20, "GIB": 2**30, "TIB": 2**40}
+    mt = re.match(r"^\s*([0-9.]+)\s*([A-Za-z]*)\s*$", str(memory_limit))
+    if not mt or (mt.group(2).upper() or "B") not in units:
+        raise ValueError(f"Could not interpret memory limit {memory_limit}")
+    return int(float(mt.group(1))*units[mt.group(2).upper() or "B"])
+
+
+def available_memory():
+    """Physical memory that is currently available in bytes, or None"""
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES")*os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def _budget(memory_limit):
+    if memory_limit is None:
+        memory_limit = available_memory()
+        if memory_limit is None:
+            raise ValueError("The available memory can not be determined on "
+                             "this system, provide a memory_limit")
+    return parse_memory_limit(memory_limit)
+
+
+def image_frame_bytes(height, width, dtype):
+    """
+    Working set of correcting one image frame
+
+    The input and warped frame, the two deformation fields and the
+    (2, height, width) sampling coordinates.
+    """
+    pixels = height*width
+    return pixels*(2*np.dtype(dtype).itemsize + 4*_FIELD_DTYPE.itemsize)
+
+
+def dense_spectrum_frame_bytes(height, width, channels, dtype):
+    """Working set of warping one dense (channels, h, w) spectrum frame"""
+    return 2*height*width*channels*np.dtype(dtype).itemsize
+
+
+def sparse_spectrum_frame_bytes(height, width, counts, dtype):
+    """
+    Working set of warping one sparse spectrum frame with a warp plan
+
+    The input and warped CSR frames with counts stored values each, the warp
+    plan and the (pixels, pixels) selection matrix.
+    """
+    pixels = height*width
+    stored = counts*(np.dtype(dtype).itemsize + _CSR_INDEX)
+    return 2*stored + pixels*(8 + np.dtype(dtype).itemsize + 2*_CSR_INDEX)
+
+
+def plan_extraction(height, width, frames, dtype, memory_limit=None,
+                    workers=None):
+    """
+    Plan the export, screening and pre-alignment of an image stack
+
+    Parameters
+    ----------
+    height, width, frames : int
+        dimensions of the image stack
+    dtype : numpy.dtype
+        data type of the frames
+    memory_limit : int or str, optional
+        memory budget in bytes or as a string like "8GB". Defaults to the
+        currently available memory.
+    workers : int, optional
+        maximum number of export threads. Defaults to the number of cpus.
+
+    Returns
+    -------
+    plan : dict
+        "memory_limit" in bytes, "stack" the size of the stack in bytes,
+        "chunk" the number of frames per batch of the FFT based screening
+        and pre-alignment, "workers" the number of export threads and
+        "fits" whether the stack fits in the budget at all
+    """
+    budget = _budget(memory_limit)
+    itemsize = np.dtype(dtype).itemsize
+    stack = height*width*frames*itemsize
+    # float32 copy, real FFT and cross correlation of each frame in a batch
+    fft_frame = height*width*(4 + 8 + 8)
+    # the aligned copy of the stack made by the pre-alignment
+    available = budget - 2*stack
+    chunk = int(np.clip(available//fft_frame, 1, frames))
+    if workers is None:
+        workers = os.cpu_count() or 1
+    # every export thread converts a copy of its frame
+    workers = int(np.clip(available//(2*height*width*itemsize), 1, workers))
+    return {"memory_limit": budget, "stack": stack, "chunk": chunk,
+            "workers": workers, "fits": available > 0}
+
+
+def plan_correction(height, width, frames, channels=None, counts=None,
+                    image_dtype=np.float32, spectrum_dtype=np.uint16,
+                    memory_limit=None, workers=None):
+    """
+    Plan the correction of a dataset with apply_deformations
+
+    Parameters
+    ----------
+    height, width, frames : int
+        dimensions of the image stack
+    channels : int, optional
+        number of spectrum channels. If None, only images are corrected.
+    counts : int, optional
+        number of stored values in the sparse spectrum stream, summed over
+        all frames. Defaults to the worst case of a dense stream.
+    image_dtype, spectrum_dtype : numpy.dtype, optional
+        data types of the image frames and of the spectrum stream
+    memory_limit : int or str, optional
+        memory budget in bytes or as a string like "8GB". Defaults to the
+        currently available memory.
+    workers : int, optional
+        maximum number of datasets corrected concurrently. Defaults to the
+        number of cpus.
+
+    Returns
+    -------
+    plan : dict
+        "memory_limit" in bytes, "spectra" the spectrum mode (None, "dense",
+        "sparse" or "tiled"), "workers" the number of datasets that can be
+        corrected concurrently, "worker_memory" the budget of each of them
+        and "estimates" the estimated sizes in bytes that led to the
+        decisions
+    """
+    budget = _budget(memory_limit)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    pixels = height*width
+    # the full image stack and the corrected frames are held in memory
+    images = 2*pixels*frames*np.dtype(image_dtype).itemsize
+    estimates = {"images": images,
+                 "image_frame": image_frame_bytes(height, width,
+                                                  image_dtype)}
+    if channels is None:
+        needed = images + estimates["image_frame"]
+        mode = None
+    else:
+        itemsize = np.dtype(spectrum_dtype).itemsize
+        if counts is None:
+            counts = pixels*channels*frames
+        counts = int(counts)
+        stream = counts*(itemsize + _CSR_INDEX)
+        sums = 2*pixels*channels*_SUM_DTYPE.itemsize
+        estimates.update({
+            "stream": stream, "sums": sums,
+            "dense_frame": dense_spectrum_frame_bytes(
+                height, width, channels, spectrum_dtype),
+            "sparse_frame": sparse_spectrum_frame_bytes(
+                height, width, counts//max(frames, 1), spectrum_dtype)})
+        # the input and the corrected stream are both held in memory
+        dense = (images + estimates["image_frame"] + 2*stream + sums +
+                 estimates["dense_frame"])
+        # the input frames are read one at a time and the corrected frames
+        # written out, only a frame and its warped copy are held
+        sparse = (images + estimates["image_frame"] + sums +
+                  2*estimates["sparse_frame"])
+        if dense <= budget:
+            mode, needed = "dense", dense
+        elif sparse <= budget:
+            mode, needed = "sparse", sparse
+        else:
+            # the sums take whatever is left of the budget
+            mode, needed = "tiled", budget
+            estimates["minimum"] = sparse - sums
+    concurrent = int(np.clip(budget//max(needed, 1), 1, workers))
+    return {"memory_limit": budget, "spectra": mode, "workers": concurrent,
+            "worker_memory": budget//concurrent, "estimates": estimates,
+            "fits": estimates.get("minimum", needed) < budget}
+
+
+# dtype of the pixels of PIL image modes, unknown modes count as float64
+_PIL_DTYPES = {"1": np.bool_, "L": np.uint8, "P": np.uint8,
+               "I;16": np.uint16, "I;16L": np.uint16, "I;16B": np.uint16,
+               "I;16S": np.int16, "I": np.int32, "F": np.float32}
+
+
+def plan_dataset(result_folder, spectra_folder=None, memory_limit=None,
+                 workers=None):
+    """
+    Plan the correction of a registered dataset from the files on disk
+
+    Only the headers of the files are read: the dimensions of the frames
+    from the first exported image and the spectrum stream dimensions and
+    counts from the sparse frame files.
+
+    Parameters
+    ----------
+    result_folder : str
+        path to the folder where non rigid registration saved its result
+    spectra_folder : str, optional
+        path to the folder with the spectrum stream frames
+    memory_limit : int or str, optional
+        see plan_correction
+    workers : int, optional
+        see plan_correction
+
+    Returns
+    -------
+    plan : dict
+        see plan_correction
+    """
+    from PIL import Image
+    from .io_tools import read_config_file, _getNameCounterFrames
+    config_file = str(Path(result_folder + "/parameter-dump.txt"))
+    conf = read_config_file(config_file)
+    (_, _, _, frames, skipframes, _, _) = _getNameCounterFrames(config_file)
+    frames = frames - len(skipframes)
+    imfolder, _ = os.path.split(conf["templateNamePattern"])
+    first = [i for i in sorted(glob.glob(str(Path(f"{imfolder}/*.*"))))
+             if not i.endswith(".json")][0]
+    with Image.open(first) as img:
+        # the mode is read from the header, the pixels are not decoded
+        width, height = img.size
+        image_dtype = _PIL_DTYPES.get(img.mode, np.float64)
+    channels = counts = None
+    spectrum_dtype = np.uint16
+    if spectra_folder is not None:
+        counts = 0
+        paths = sorted(glob.glob(str(Path(f"{spectra_folder}/*.npz"))))
+        for path in paths:
+            with np.load(path) as frame:
+                counts += int(frame["indptr"][-1])
+                channels = int(frame["shape"][1])
+        if paths:
+            with np.load(paths[0]) as frame:
+                spectrum_dtype = frame["data"].dtype
+    return plan_correction(height, width, frames, channels=channels,
+                           counts=counts, image_dtype=image_dtype,
+                           spectrum_dtype=spectrum_dtype,
+                           memory_limit=memory_limit, workers=workers)
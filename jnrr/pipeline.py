@@ -0,0 +1,92 @@
+"""
+In-memory handoff from extraction to correction
+
+extract_emd(..., keep_stacks=True) returns an ExtractedDataset for every
+exported image dataset. It keeps the image stack that was exported, with
+its metadata, and a handle to the dataset in the emd file. Passing it to
+apply_deformations as dataset corrects that stack directly instead of
+decoding the exported image files again, so the corrected data has the
+full bit depth of the original.
+
+>>> paths = extract_emd("data.emd", keep_stacks=True)
+>>> dataset = paths["datasets"][0]
+>>> calculate_non_rigid_registration(dataset.config_file)
+>>> apply_deformations(dataset.result_folder, dataset=dataset)
+"""
+from .alignment import read_shifts, apply_shifts
+from ._imports import lazy_import
+
+dio = lazy_import("temmeta.data_io")
+
+
+class ExtractedDataset(object):
+    """
+    An image dataset exported by extract_emd and its image stack
+
+    Parameters
+    ----------
+    emd_path : str
+        path to the emd file
+    uuid : str
+        uuid of the image dataset in the emd file
+    image_folder : str
+        folder the frames were exported to
+    config_file : str
+        match-series config file of the dataset
+    result_folder : str
+        folder in which match-series saves the result
+    stack : temmeta image stack, optional
+        the exported stack. If None, it is read from the emd file when it
+        is needed.
+    prealigned : bool, optional
+        the exported frames were shifted by the pre-alignment
+    image_post_processing : callable, optional
+        filter that was applied before the export, applied again when the
+        stack is read from the emd file
+    frames : list of int, optional
+        the exported frames, if not all frames were exported. The stack
+        only keeps these frames, like the stack of the exported files.
+    """
+    def __init__(self, emd_path, uuid, image_folder, config_file,
+                 result_folder, stack=None, prealigned=False,
+                 image_post_processing=None, frames=None):
+        self.emd_path = emd_path
+        self.uuid = uuid
+        self.image_folder = image_folder
+        self.config_file = config_file
+        self.result_folder = result_folder
+        self.stack = stack
+        self.prealigned = prealigned
+        self.image_post_processing = image_post_processing
+        self.frames = frames
+        if stack is not None:
+            self.stack = self._select(stack)
+
+    def _select(self, stack):
+        """Only the exported frames of a stack with all frames"""
+        if self.frames is None:
+            return stack
+        return stack.select_frames(self.frames)
+
+    def load(self):
+        """The image stack as it was exported, read if it was released"""
+        if self.stack is None:
+            with dio.EMDFile(self.emd_path) as f:
+                stack = f.get_dataset("Image", self.uuid)
+            if self.image_post_processing is not None:
+                stack.apply_filter(self.image_post_processing, inplace=True)
+            if self.prealigned:
+                # the shifts were estimated and written for all frames
+                stack.data = apply_shifts(stack.data,
+                                          read_shifts(self.image_folder))
+            self.stack = self._select(stack)
+        return self.stack
+
+    def release(self):
+        """Free the memory of the stack, it is read again by load"""
+        self.stack = None
+
+    def __repr__(self):
+        state = "in memory" if self.stack is not None else "released"
+        return (f"ExtractedDataset({self.emd_path}, {self.uuid}, "
+                f"{self.image_folder}, {state})")
@@ -1,16 +1,35 @@
+import concurrent.futures as cf
+import copy
+import functools
+import glob
+import json
 import logging
 import os
+import re
 import subprocess
-from PIL import Image
-from scipy import ndimage
+import time
 from pathlib import Path
 from .io_tools import read_config_file, loadFromQ2bz, _getNameCounterFrames
 import numpy as np
-import hyperspy.api as hs
-from scipy.sparse import csr_matrix
-from temmeta import data_io as dio
+from .alignment import read_shifts, compose_shift
+from .kernels import (HAS_NUMBA, _get_coordinates, warp_image, warp_channels,
+                      displacement_statistics)
+from .stackfile import StackWriter
+from .memory import plan_correction
+from .accumulate import CountAccumulator
+from .progress import ProgressTracker
+from .sharedmem import SharedArray, map_indexes
+from ._imports import lazy_import
 
-logger = logging.Logger(name="Processing", level=logging.INFO)
+Image = lazy_import("PIL.Image")
+ndimage = lazy_import("scipy.ndimage")
+sparse = lazy_import("scipy.sparse")
+hs = lazy_import("hyperspy.api")
+dio = lazy_import("temmeta.data_io")
+mda = lazy_import("temmeta.metadata")
+
+logger = logging.getLogger("Processing")
+logger.setLevel(logging.INFO)
 
 
 def write_as_image(img, path):
@@ -18,14 +37,91 @@ def write_as_image(img, path):
     defimg.save(path)
 
 
-def calculate_non_rigid_registration(config_file):
-    cmd = [str("matchSeries"), f"{config_file}", ">", "output.log"]
-    process1 = subprocess.Popen(cmd, stderr=subprocess.PIPE)
-    process1.wait()
+def _count_registered(savedir, bznumber, since=0.):
+    """Number of frames for which match-series wrote final deformations"""
+    paths = glob.glob(str(Path(
+        f"{savedir}/stage*/*/deformation_{bznumber}_1.dat.bz2")))
+    # files of a previous run in the same folder do not count
+    return sum(1 for i in paths if os.path.getmtime(i) >= since)
+
+
+def calculate_non_rigid_registration(config_file, progress=None,
+                                     poll_interval=1.):
+    """
+    Run match-series on a config file and return the result folder
+
+    The output of match-series is written to a .log file next to the config
+    file.
+
+    Parameters
+    ----------
+    config_file : str
+        path to the config file
+    progress : callable or list of callables, optional
+        receive progress reports, see progress.ProgressTracker. The
+        progress is followed by counting the deformation files in the
+        result folder.
+    poll_interval : float, optional
+        seconds between checks of the result folder if progress is given
+    """
+    logfile = os.path.splitext(config_file)[0] + ".log"
+    cmd = [str("matchSeries"), f"{config_file}"]
+    if progress is not None:
+        savedir = read_config_file(config_file)["saveDirectory"]
+        (_, _, _, numframes, skipframes, bznumber,
+            stages) = _getNameCounterFrames(config_file)
+        total = (numframes - len(skipframes))*stages
+        tracker = ProgressTracker("register", total, progress,
+                                  label=config_file)
+        start = time.time()
+    with open(logfile, "w") as log:
+        process1 = subprocess.Popen(cmd, stdout=log,
+                                    stderr=subprocess.STDOUT)
+        if progress is None:
+            process1.wait()
+        else:
+            while process1.poll() is None:
+                time.sleep(poll_interval)
+                tracker.set(min(_count_registered(savedir, bznumber, start),
+                                total))
+            tracker.set(min(_count_registered(savedir, bznumber, start),
+                            total))
+            tracker.finish()
+    if process1.returncode != 0:
+        logger.error(f"matchSeries exited with code {process1.returncode} "
+                     f"on {config_file}, see {logfile}")
     logger.info("Finished non-rigid registration")
     return read_config_file(config_file)["saveDirectory"]
 
 
+def calculate_non_rigid_registrations(config_files, workers=None,
+                                      progress=None):
+    """
+    Run match-series on several config files concurrently
+
+    Parameters
+    ----------
+    config_files : list of str
+        paths to the config files
+    workers : int, optional
+        maximum number of match-series processes running at the same time.
+        Defaults to the number of processors.
+    progress : callable or list of callables, optional
+        receive progress reports of every registration
+
+    Returns
+    -------
+    result_folders : list of str
+        the result folder of each config file
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    register = functools.partial(calculate_non_rigid_registration,
+                                 progress=progress)
+    with cf.ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(register, config_files))
+
+
 def apply_deformations_spectra():
     pass
 
@@ -34,13 +130,362 @@ def apply_deformations_images():
     pass
 
 
+def load_deformation(result_folder, stage, bznumber, index,
+                     first_frame=False, statistics=False):
+    """
+    Read the x and y deformation fields of one frame from the results
+
+    Parameters
+    ----------
+    result_folder : str
+        path to the folder where non rigid registration saved its result
+    stage : int
+        the stage from which the deformations are read
+    bznumber : str
+        two digit level of the deformation files
+    index : int
+        frame index
+    first_frame : bool, optional
+        the first processed frame is stored without the "-r" suffix
+    statistics : bool, optional
+        also return the displacement statistics of the frame, see
+        kernels.displacement_statistics
+
+    Returns
+    -------
+    defX, defY : numpy.ndarray
+        the deformations normalized by the largest image dimension - 1
+    stats : dict
+        only if statistics is True
+    """
+    sub = f"{index}" if first_frame else f"{index}-r"
+    folder = f"{result_folder}/stage{stage}/{sub}/"
+    defX = loadFromQ2bz(str(Path(f"{folder}deformation_{bznumber}_0.dat.bz2")))
+    defY = loadFromQ2bz(str(Path(f"{folder}deformation_{bznumber}_1.dat.bz2")))
+    if statistics:
+        return defX, defY, displacement_statistics(defX, defY)
+    return defX, defY
+
+
+def _warp_frame_shared(index, images, deformed, defX, defY, result_folder,
+                       stage, bznumber, image_shifts):
+    """
+    Load the deformations of a frame and warp its image, in a worker
+
+    Returns the displacement statistics of the frame, with "image_identity"
+    whether the image was copied instead of warped.
+    """
+    pos, i = index
+    fieldX, fieldY, stats = load_deformation(result_folder, stage, bznumber,
+                                             i, pos == 0, statistics=True)
+    if defX is not None:
+        defX[pos] = fieldX
+        defY[pos] = fieldY
+    identity = stats["identity"]
+    if image_shifts is not None:
+        fieldX, fieldY = compose_shift(fieldX, fieldY, image_shifts[i])
+        identity = displacement_statistics(fieldX, fieldY)["identity"]
+    if identity:
+        deformed[pos] = images[i]
+    else:
+        deformed[pos] = warp_image(images[i], fieldX, fieldY,
+                                   cval=images[i].mean())
+    return {**stats, "image_identity": identity}
+
+
+def _warp_images_shared(data, indexes, result_folder, stage, bznumber,
+                        image_shifts, keep_deformations, workers):
+    """
+    Warp the frames indexes of an image stack on a process pool
+
+    Returns a dict of SharedArrays: "deformed" with the warped frames and,
+    if keep_deformations, "defX" and "defY" with the deformations, in the
+    order of indexes, and the list of displacement statistics of the
+    frames. The SharedArrays must be closed by the caller.
+    """
+    n = len(indexes)
+    _, h, w = data.shape
+    shared = {"images": SharedArray.from_array(data),
+              "deformed": SharedArray((n, h, w), data.dtype)}
+    if keep_deformations:
+        shared["defX"] = SharedArray((n, h, w), np.float64)
+        shared["defY"] = SharedArray((n, h, w), np.float64)
+    arrays = [shared["images"], shared["deformed"],
+              shared.get("defX"), shared.get("defY")]
+    statistics = map_indexes(_warp_frame_shared, list(enumerate(indexes)),
+                             arrays, result_folder, stage, bznumber,
+                             image_shifts, workers=workers)
+    shared.pop("images").close()
+    return shared, statistics
+
+
+def _write_displacement_statistics(frame_stats, path):
+    """Save the displacement statistics of the frames as json for QA"""
+    copied = [i for i, v in frame_stats.items() if v["image_identity"]]
+    logger.info(f"{len(copied)} of {len(frame_stats)} frames were not "
+                "deformed and copied instead of warped")
+    with open(path, "w") as f:
+        json.dump({"identity_frames": [i for i, v in frame_stats.items()
+                                       if v["identity"]],
+                   "copied_frames": copied,
+                   "frames": {str(i): v for i, v in frame_stats.items()}},
+                  f, indent=4)
+
+
+def _get_window_channels(specstr, energy_windows):
+    """
+    Convert a list of (start, end) energy windows in keV to channel ranges
+
+    The dispersion and offset are read from the spectrum stream metadata.
+    The windows are clipped to the available channels.
+    """
+    ranges = []
+    for start, end in energy_windows:
+        if end <= start:
+            raise ValueError(f"Invalid energy window ({start}, {end}): the "
+                             "end must be larger than the start")
+        # window ends on a channel edge must not pick up the neighbor
+        # channel because of rounding errors
+        c0 = int(np.floor((start - specstr.spectrum_offset) /
+                          specstr.dispersion + 1e-9))
+        c1 = int(np.ceil((end - specstr.spectrum_offset) /
+                         specstr.dispersion - 1e-9))
+        c0 = min(max(c0, 0), specstr.channels)
+        c1 = min(max(c1, 0), specstr.channels)
+        if c1 <= c0:
+            raise ValueError(f"Energy window ({start}, {end}) lies outside "
+                             "the spectrum range")
+        ranges.append((c0, c1))
+    return ranges
+
+
+def _get_window_selector(channel_ranges):
+    """
+    Sparse matrix that sums the channels of each window, and its span
+
+    The matrix has a row for every channel in the (first, end) span of all
+    windows. Multiplying the span columns of a (pixels, channels) CSR frame
+    with it yields the (pixels, windows) counts, so only the counts inside
+    the span are touched.
+    """
+    first = min(c0 for c0, _ in channel_ranges)
+    end = max(c1 for _, c1 in channel_ranges)
+    rows = np.concatenate([np.arange(c0, c1) - first
+                           for c0, c1 in channel_ranges])
+    cols = np.concatenate([np.full(c1-c0, j)
+                           for j, (c0, c1) in enumerate(channel_ranges)])
+    vals = np.ones(rows.shape[0], dtype=np.int64)
+    selector = sparse.csr_matrix((vals, (rows, cols)),
+                                 shape=(end - first, len(channel_ranges)))
+    return selector, (first, end)
+
+
+def _get_window_maps(spectra, selector, span, dimensions):
+    """Return the (windows, height, width) maps of a CSR spectrum frame"""
+    _, h, w = dimensions
+    # the column slice only copies the counts inside the span
+    counts = (spectra[:, span[0]:span[1]] @ selector).toarray()
+    return counts.T.reshape(-1, h, w)
+
+
+def _get_warp_plan(coords):
+    """
+    Flat source pixel index for each output pixel of a nearest neighbor warp
+
+    Reproduces map_coordinates with order=0 and mode="constant": coordinates
+    are rounded half up and points outside the grid get index -1.
+    """
+    _, h, w = coords.shape
+    yi = np.floor(coords[0] + 0.5).astype(np.int64)
+    xi = np.floor(coords[1] + 0.5).astype(np.int64)
+    valid = ((coords[0] >= 0) & (coords[0] <= h-1) &
+             (coords[1] >= 0) & (coords[1] <= w-1))
+    return np.where(valid, yi*w + xi, -1).ravel()
+
+
+def _warp_sparse_frame(spectra, plan):
+    """
+    Warp a (pixels, channels) CSR spectrum frame with a warp plan
+
+    The warp is a row selection, so it is done as a sparse product without
+    ever creating the dense (channels, height, width) frame.
+    """
+    npix = plan.shape[0]
+    outinx = np.nonzero(plan >= 0)[0]
+    selection = sparse.csr_matrix(
+        (np.ones(outinx.shape[0], dtype=spectra.dtype),
+         (outinx, plan[outinx])), shape=(npix, npix))
+    return (selection @ spectra).tocsr()
+
+
+def _create_spectrum_map(arr, specstr, process=None):
+    """
+    Wrap an array as SpectrumMap with the axes of specstr without copying
+
+    dio.create_new_spectrum_map calls np.array on the data, which would load
+    a memory-mapped array entirely into memory.
+    """
+    newmeta = mda.Metadata()
+    newmeta.experiment_type = "modified"
+    newmeta.parent_meta = specstr.metadata
+    if process:
+        newmeta.process = process
+    xinfo = (arr.shape[2], specstr.pixelunit, specstr.pixelsize)
+    yinfo = (arr.shape[1], specstr.pixelunit, specstr.pixelsize)
+    cinfo = (arr.shape[0], specstr.energy_unit, specstr.dispersion,
+             specstr.spectrum_offset)
+    newmeta["data_axes"] = mda.gen_spectrum_map_axes(xinfo, yinfo, cinfo)
+    return dio.SpectrumMap(arr, mda.Metadata(newmeta))
+
+
+class SpectrumFrameFiles(object):
+    """
+    Spectrum stream frames in a folder, read one frame at a time
+
+    The frames are the .npz files written by export_streamframes, sorted
+    like import_files_to_spectrumstream sorts them. Only the metadata is
+    read up front, so the whole stream is never held in memory.
+
+    Parameters
+    ----------
+    folder : str
+        path to the folder with the spectrum stream frames
+
+    Attributes
+    ----------
+    stream : temmeta.SpectrumStream
+        the stream without data, only for its axes and metadata
+    """
+    PATTERN = re.compile(r"(.*)\_([0-9]+)\.npz")
+
+    def __init__(self, folder):
+        names = sorted(i for i in os.listdir(folder)
+                       if self.PATTERN.match(i))
+        self.paths = [str(Path(f"{folder}/{i}")) for i in names]
+        meta = [i for i in os.listdir(folder) if i.endswith(".json")]
+        if meta:
+            with open(str(Path(f"{folder}/{meta[0]}"))) as f:
+                self.stream = dio.SpectrumStream(None,
+                                                 mda.Metadata(json.load(f)))
+        else:
+            # temmeta guesses the axes from the data
+            logger.warning(f"No metadata in {folder}, the whole stream is "
+                           "imported")
+            self.stream = dio.import_files_to_spectrumstream(folder)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        return sparse.load_npz(self.paths[index]).tocsr()
+
+    def counts(self, indexes):
+        """Number of stored values of the frames, read from their headers"""
+        total = 0
+        for i in indexes:
+            with np.load(self.paths[i]) as frame:
+                total += int(frame["indptr"][-1])
+        return total
+
+    @property
+    def dtype(self):
+        with np.load(self.paths[0]) as frame:
+            return frame["data"].dtype
+
+
+def _save_spectrum_map(spectrum_map, path):
+    """Write a (memory-mapped) spectrum map to .hspy chunk by chunk"""
+    # a lazy signal is written block-wise, never loading the whole map
+    spectrum_map.to_hspy().as_lazy().save(path)
+
+
+class SpillingSpectrumSum(object):
+    """
+    Sum of sparse spectrum frames spilled to a memory-mapped file
+
+    Frames are added as sparse matrices to a CountAccumulator, so the sparse
+    sum is kept in the smallest safe integer type. Once it grows beyond
+    half of the memory budget, it is added to the dense (channels, pixels)
+    memory map in tiles that each fit in the other half of the budget.
+
+    Parameters
+    ----------
+    path : str
+        path to the scratch file that holds the dense sum
+    dimensions : tuple
+        (channels, height, width) of the spectrum map
+    memory_limit : int
+        memory budget in bytes
+    dtype : numpy dtype, optional
+        dtype of the dense sum
+    """
+    def __init__(self, path, dimensions, memory_limit, dtype=np.uint32):
+        self.path = path
+        self.dimensions = dimensions
+        self.memory_limit = memory_limit
+        channels, h, w = dimensions
+        self.data = np.memmap(path, dtype=dtype, mode="w+",
+                              shape=(channels, h*w))
+        self._sparse = CountAccumulator()
+
+    @staticmethod
+    def _sparse_size(matrix):
+        return (matrix.data.nbytes + matrix.indices.nbytes +
+                matrix.indptr.nbytes)
+
+    def add(self, frame):
+        """Add a (pixels, channels) sparse frame to the sum"""
+        self._sparse.add(frame)
+        if self._sparse_size(self._sparse.data) > self.memory_limit//2:
+            self.flush()
+
+    def flush(self):
+        """Add the sparse sum to the memory map tile by tile"""
+        total = self._sparse.result()
+        if total is None:
+            return
+        channels, h, w = self.dimensions
+        elements = max(1, (self.memory_limit//2)//self.data.itemsize)
+        ctile = min(channels, elements)
+        ptile = max(1, elements//ctile)
+        for p0 in range(0, h*w, ptile):
+            block = total[p0:p0+ptile]
+            if block.nnz == 0:
+                continue
+            for c0 in range(0, channels, ctile):
+                tile = block[:, c0:c0+ctile]
+                if tile.nnz == 0:
+                    continue
+                self.data[c0:c0+ctile, p0:p0+ptile] += \
+                    tile.toarray().T.astype(self.data.dtype)
+        self.data.flush()
+        self._sparse = CountAccumulator()
+
+    def result(self):
+        """Flush and return the (channels, height, width) memory map"""
+        self.flush()
+        return self.data.reshape(self.dimensions)
+
+
 def apply_deformations(result_folder, image_folder=None,
-                       spectra_folder=None):
+                       spectra_folder=None, energy_windows=None,
+                       memory_limit=None, scratch_folder=None,
+                       output_format="frames", compression=None,
+                       progress=None, workers=None, dataset=None):
     """
     Apply the deformations calculated by match-series to images and
     optionally spectra. The resulting deformed images and spectra are
     written out to a folder for later import if necessary.
 
+    If the registered frames were pre-aligned by extract_emd (prealign=True),
+    the rigid shifts are composed with the deformations for all data that
+    was not aligned in the same way, e.g. the spectra.
+
+    Frames whose deformations round to zero everywhere, such as the
+    reference frame, are copied instead of warped. The maximum and RMS
+    shift of every frame are saved to displacement_statistics.json in the
+    results folder.
+
     Parameters
     ----------
     result_folder : str
@@ -53,6 +498,43 @@ def apply_deformations(result_folder, image_folder=None,
         path to the folder where the spectrum stream frames reside to which
         the deformation should be applied. If None, then no spectra are
         corrected
+    energy_windows : list of (float, float), optional
+        list of (start, end) energy windows in keV. If given, only the
+        channels inside each window are summed, warped and accumulated,
+        resulting in one corrected map per window instead of the full
+        corrected spectrum map. No deformed spectrum frames are written out.
+    memory_limit : int or str, optional
+        memory budget for the spectrum correction in bytes, or as a string
+        like "4GB". If given, memory.plan_correction decides from the size
+        of the data whether the spectra can be corrected densely in memory.
+        If not, the spectrum frames are read from spectra_folder one at a
+        time and warped in sparse form, deformed frames are written out as
+        they are calculated and the summed spectrum maps are accumulated in
+        memory-mapped scratch files in tiles that fit the budget. The
+        returned spectrum maps are then backed by these files and are
+        written to .hspy block by block.
+    scratch_folder : str, optional
+        folder for the memory-mapped scratch files. Defaults to the results
+        folder.
+    output_format : str, optional
+        "frames" writes every corrected frame to its own file in the
+        deformedImages folder. "hdf5" streams the corrected frames into the
+        single file deformedImages_XXX.h5 instead, see stackfile.StackWriter.
+    compression : str, optional
+        HDF5 compression filter for output_format "hdf5", e.g. "gzip". By
+        default the file is uncompressed and can be memory-mapped.
+    progress : callable or list of callables, optional
+        receive progress reports of the correction, see
+        progress.ProgressTracker
+    workers : int, optional
+        if larger than 1, the deformations are read and the images are
+        warped on this many processes beforehand. The image stack, the
+        deformed images and, if spectra are corrected, the deformations are
+        held in shared memory, the workers only receive frame indexes.
+    dataset : pipeline.ExtractedDataset, optional
+        the dataset returned by extract_emd(..., keep_stacks=True) for
+        these results. Its image stack is corrected directly instead of
+        reading the exported frames from image_folder.
 
     Returns
     -------
@@ -61,89 +543,245 @@ def apply_deformations(result_folder, image_folder=None,
     averageDeformed: temmeta.GeneralImage object
         The averaged image of the corrected dataset
     spectrumUndeformed: temmeta.SpectrumMap object or None
-        The sum of all the spectrum frames in the uncorrected dataset
+        The sum of all the spectrum frames in the uncorrected dataset,
+        including the frames that are skipped in the corrected one. If
+        energy_windows are provided, a list of temmeta.GeneralImage objects
+        with the map of each window.
     spectrumDeformed: temmeta.SpectrumMap object or None
-        The sum of all the spectrum frames in the corrected dataset
+        The sum of all the spectrum frames in the corrected dataset. If
+        energy_windows are provided, a list of temmeta.GeneralImage objects
+        with the map of each window.
     """
     config_file = str(Path(result_folder + "/parameter-dump.txt"))
     # get the path to the image files
     conf = read_config_file(config_file)
     imfolder, _ = os.path.split(conf["templateNamePattern"])
-    if image_folder is not None:
+    # rigid shifts applied to the frames before registration are composed
+    # with the deformations, unless the data was aligned in the same way
+    rigid_shifts = read_shifts(imfolder)
+    if dataset is not None:
+        imfolder = dataset.image_folder
+    elif image_folder is not None:
         imfolder = image_folder
+    image_shifts = rigid_shifts
+    if dataset is not None and dataset.prealigned:
+        image_shifts = None
+    elif dataset is None and read_shifts(imfolder) is not None:
+        image_shifts = None
     parfolder, imsubfolder = os.path.split(imfolder)
     _, numbering = imsubfolder.split("_")
     # get basic info about the images
     (dataBaseName, counter, imgext, frames, skipframes, bznumber,
         stage) = _getNameCounterFrames(config_file)
     # read in the data
-    images = dio.import_files_to_stack(imfolder)
-    # set the path to the deformed images folder
-    defImagesFolder = parfolder+f"/deformedImages_{numbering}/"
-    if not os.path.isdir(defImagesFolder):
-        os.makedirs(defImagesFolder)
+    if dataset is not None:
+        images = dataset.load()
+    else:
+        images = dio.import_files_to_stack(imfolder)
+    nframes = len([i for i in range(frames) if i not in skipframes])
+    if output_format == "frames":
+        # set the path to the deformed images folder
+        defImagesFolder = parfolder+f"/deformedImages_{numbering}/"
+        if not os.path.isdir(defImagesFolder):
+            os.makedirs(defImagesFolder)
+    elif output_format != "hdf5":
+        raise ValueError(f"Unknown output format {output_format}")
     spec_list = []
+    indexes = [i for i in range(frames) if i not in skipframes]
     if spectra_folder is not None:
-        specstr = dio.import_files_to_spectrumstream(spectra_folder)
-        spec_list = specstr._get_frame_list()
-        defSpectraFolder = parfolder+f"/deformedSpectra_{numbering}/"
-        if not os.path.isdir(defSpectraFolder):
-            os.makedirs(defSpectraFolder)
+        frame_files = SpectrumFrameFiles(spectra_folder)
+        specstr = frame_files.stream
+        if energy_windows is not None:
+            # only the window maps of one frame at a time are needed
+            spec_list = frame_files
+            channel_ranges = _get_window_channels(specstr, energy_windows)
+            selector, span = _get_window_selector(channel_ranges)
+            windowsUndeformed = CountAccumulator(frames=len(frame_files))
+            windowsDeformed = CountAccumulator(frames=nframes)
+        else:
+            defSpectraFolder = parfolder+f"/deformedSpectra_{numbering}/"
+            if not os.path.isdir(defSpectraFolder):
+                os.makedirs(defSpectraFolder)
+        if memory_limit is not None and energy_windows is None:
+            memory_plan = plan_correction(
+                images.height, images.width, nframes,
+                channels=specstr.channels,
+                counts=frame_files.counts(indexes),
+                image_dtype=images.data.dtype,
+                spectrum_dtype=frame_files.dtype,
+                memory_limit=memory_limit, workers=1)
+            logger.info(f"Spectra are corrected {memory_plan['spectra']}, "
+                        f"memory plan {memory_plan}")
+            if not memory_plan["fits"]:
+                logger.warning("The data does not fit in the memory limit")
+            # dense correction uses the in-memory path below
+            memory_limit = (None if memory_plan["spectra"] == "dense"
+                            else memory_plan["memory_limit"])
+        if memory_limit is not None and energy_windows is None:
+            # the frames are read one at a time
+            spec_list = frame_files
+        elif energy_windows is None:
+            # the dense correction works on the whole stream in memory
+            specstr = dio.import_files_to_spectrumstream(spectra_folder)
+            spec_list = specstr._get_frame_list()
+        if memory_limit is not None and energy_windows is None:
+            if scratch_folder is None:
+                scratch_folder = str(Path(parfolder+f"/results_{numbering}/"))
+            if not os.path.isdir(scratch_folder):
+                os.makedirs(scratch_folder)
+            # half the budget for each of the two sums
+            sumUndeformed = SpillingSpectrumSum(
+                str(Path(scratch_folder+"/spectrumUndeformed.dat")),
+                specstr.dimensions, memory_limit//2)
+            sumDeformed = SpillingSpectrumSum(
+                str(Path(scratch_folder+"/spectrumDeformed.dat")),
+                specstr.dimensions, memory_limit//2)
     # loop over files
     im_frm_list = []
     spec_frm_list = []
     firstframe = True
-    for i in range(frames):
-        if i in skipframes:
-            continue
-        c = str(i).zfill(counter)
-        imname = str(Path(
-            f"{parfolder}/{imfolder}/{dataBaseName}_{c}.{imgext}"))
-        image = images.get_frame(i)
-        logger.info(f"Processing frame {i}: {imname}")
-        if firstframe:
-            defX = loadFromQ2bz(str(Path(f"{result_folder}/stage{stage}/{i}/"
-                                f"deformation_{bznumber}_0.dat.bz2")))
-            defY = loadFromQ2bz(str(Path(f"{result_folder}/stage{stage}/{i}/"
-                                f"deformation_{bznumber}_1.dat.bz2")))
+    tracker = ProgressTracker("apply", nframes, progress, label=result_folder)
+    writer = None
+    if output_format == "hdf5":
+        writer = StackWriter(
+            str(Path(parfolder+f"/deformedImages_{numbering}.h5")),
+            nframes, (images.height, images.width), images.data.dtype,
+            pixelsize=images.pixelsize, pixelunit=images.pixelunit,
+            compression=compression,
+            attributes={"process": "Applied non rigid registration"})
+        defImageSum = np.zeros((images.height, images.width))
+    shared = {}
+    try:
+        if workers is not None and workers > 1:
+            logger.info(f"Warping the images on {workers} processes")
+            shared, shared_stats = _warp_images_shared(
+                images.data, indexes, result_folder, stage, bznumber,
+                image_shifts, bool(spec_list), workers)
+        frame_stats = {}
+        for pos, i in enumerate(indexes):
+            c = str(i).zfill(counter)
+            imname = str(Path(
+                f"{parfolder}/{imfolder}/{dataBaseName}_{c}.{imgext}"))
+            image = images.get_frame(i)
+            logger.info(f"Processing frame {i}: {imname}")
+            if shared:
+                # loaded and warped by the workers
+                deformedData = shared["deformed"].array[pos].copy()
+                stats = shared_stats[pos]
+                if spec_list:
+                    defX = shared["defX"].array[pos]
+                    defY = shared["defY"].array[pos]
+            else:
+                defX, defY, stats = load_deformation(
+                    result_folder, stage, bznumber, i, firstframe,
+                    statistics=True)
+                stats["image_identity"] = stats["identity"]
+                if image_shifts is not None:
+                    imX, imY = compose_shift(defX, defY, image_shifts[i])
+                    stats["image_identity"] = displacement_statistics(
+                        imX, imY)["identity"]
+                else:
+                    imX, imY = defX, defY
+                if stats["image_identity"]:
+                    # the nearest neighbor warp would return the same frame
+                    deformedData = image.data.copy()
+                else:
+                    deformedData = warp_image(image.data, imX, imY,
+                                              cval=image.data.mean())
             firstframe = False
-        else:
-            defX = loadFromQ2bz(str(Path(f"{result_folder}/stage{stage}/{i}-r/"
-                                f"deformation_{bznumber}_0.dat.bz2")))
-            defY = loadFromQ2bz(str(Path(f"{result_folder}/stage{stage}/{i}-r/"
-                                f"deformation_{bznumber}_1.dat.bz2")))
-        w = image.width
-        h = image.height
-        coords = \
-            np.mgrid[0:h, 0:w] + np.multiply([defY, defX], (np.max([h, w])-1))
-        deformedData = ndimage.map_coordinates(image.data, coords, order=0,
-                                               mode='constant',
-                                               cval=image.data.mean())
-        defImage = dio.create_new_image(deformedData, image.pixelsize,
-                                        image.pixelunit, parent=image,
-                                        process=("Applied non rigid "
-                                                 "registration"))
-        im_frm_list.append(defImage)
-        if spec_list:
-            logger.info("Correcting corresponding spectrum frame")
-            spectra = spec_list[i]
-            spectradef = dio.SpectrumStream._reshape_sparse_matrix(
-                                spectra, specstr.dimensions)
-            image_stack = hs.signals.Signal2D(spectradef)
-            image_stack.axes_manager[1].name = "x"
-            image_stack.axes_manager[2].name = "y"
-            result = image_stack.map(
-                        lambda x: ndimage.map_coordinates(
-                            x, coords, order=0, mode="constant"),
-                        inplace=False, parallel=True)
-            result.unfold()
-            defspec_sp = csr_matrix(result.data.T)  # sparse matrix rep
-            spec_frm_list.append(defspec_sp)
+            if spec_list and rigid_shifts is not None:
+                spX, spY = compose_shift(defX, defY, rigid_shifts[i])
+                stats["spectrum_identity"] = displacement_statistics(
+                    spX, spY)["identity"]
+            elif spec_list:
+                spX, spY = defX, defY
+                stats["spectrum_identity"] = stats["identity"]
+            frame_stats[i] = stats
+            if output_format == "hdf5":
+                writer.write(deformedData, index=i)
+                defImageSum += deformedData
+            else:
+                defImage = dio.create_new_image(deformedData, image.pixelsize,
+                                                image.pixelunit, parent=image,
+                                                process=("Applied non rigid "
+                                                         "registration"))
+                im_frm_list.append(defImage)
+            if spec_list:
+                logger.info("Correcting corresponding spectrum frame")
+                spectra = spec_list[i]
+                identity = stats["spectrum_identity"]
+                if energy_windows is not None:
+                    maps = _get_window_maps(spectra, selector, span,
+                                            specstr.dimensions)
+                    windowsUndeformed.add(maps)
+                    windowsDeformed.add(maps if identity
+                                        else warp_channels(maps, spX, spY))
+                elif memory_limit is not None:
+                    if identity:
+                        defspec_sp = spectra
+                    else:
+                        plan = _get_warp_plan(_get_coordinates(spX, spY))
+                        defspec_sp = _warp_sparse_frame(spectra, plan)
+                    c = str(len(spec_frm_list)).zfill(counter)
+                    sparse.save_npz(
+                        str(Path(f"{defSpectraFolder}/{dataBaseName}_{c}")),
+                        defspec_sp)
+                    sumUndeformed.add(spectra)
+                    sumDeformed.add(defspec_sp)
+                    # only keep track of the number of frames
+                    spec_frm_list.append(None)
+                elif identity:
+                    spec_frm_list.append(spectra.copy())
+                elif HAS_NUMBA:
+                    spectradef = dio.SpectrumStream._reshape_sparse_matrix(
+                                        spectra, specstr.dimensions)
+                    defspec = warp_channels(spectradef, spX, spY)
+                    spec_frm_list.append(
+                        dio.SpectrumStream._to_sparse(defspec))
+                else:
+                    coords = _get_coordinates(spX, spY)
+                    spectradef = dio.SpectrumStream._reshape_sparse_matrix(
+                                        spectra, specstr.dimensions)
+                    image_stack = hs.signals.Signal2D(spectradef)
+                    image_stack.axes_manager[1].name = "x"
+                    image_stack.axes_manager[2].name = "y"
+                    result = image_stack.map(
+                                lambda x: ndimage.map_coordinates(
+                                    x, coords, order=0, mode="constant"),
+                                inplace=False, parallel=True)
+                    result.unfold()
+                    # sparse matrix rep
+                    defspec_sp = sparse.csr_matrix(result.data.T)
+                    spec_frm_list.append(defspec_sp)
+            nbytes = image.data.nbytes
+            if spec_list:
+                nbytes += (spectra.data.nbytes + spectra.indices.nbytes +
+                           spectra.indptr.nbytes)
+            tracker.update(1, nbytes)
+        if spec_list and (energy_windows is not None or
+                          memory_limit is not None):
+            # the undeformed sums are of all frames, like the average image
+            # and the spectrum map of the in-memory correction
+            for i in sorted(set(range(len(spec_list))) - set(indexes)):
+                if energy_windows is not None:
+                    windowsUndeformed.add(_get_window_maps(
+                        spec_list[i], selector, span, specstr.dimensions))
+                else:
+                    sumUndeformed.add(spec_list[i])
+        tracker.finish()
+    finally:
+        # also when a frame fails, so that the file is not left open
+        if writer is not None:
+            writer.close()
+        for shared_array in shared.values():
+            shared_array.close()
     # also do the post processing, with temmeta it's a minor thing
     logger.info("Calculating average image (undeformed)")
     resultFolder = str(Path(parfolder+f"/results_{numbering}/"))
     if not os.path.isdir(resultFolder):
         os.makedirs(resultFolder)
+    _write_displacement_statistics(
+        frame_stats, str(Path(resultFolder+"/displacement_statistics.json")))
     # average image
     averageUndeformed = images.average()
     averageUndeformed.to_hspy(str(Path(resultFolder+"/imageUndeformed.hspy")))
@@ -151,14 +789,64 @@ def apply_deformations(result_folder, image_folder=None,
                    str(Path(resultFolder+f"/imageUndeformed.{imgext}")))
     # average image from deformed
     logger.info("Calculating average image (deformed)")
-    defstack = dio.images_to_stack(im_frm_list)
-    averageDeformed = defstack.average()
+    if output_format == "hdf5":
+        averageDeformed = dio.create_new_image(
+            defImageSum/writer.frames, images.pixelsize, images.pixelunit,
+            parent=images, process=("Applied non rigid registration, "
+                                    "average of all frames"))
+    else:
+        defstack = dio.images_to_stack(im_frm_list)
+        averageDeformed = defstack.average()
     averageDeformed.to_hspy(str(Path(resultFolder+"/imageDeformed.hspy")))
     write_as_image(averageDeformed.data,
                    str(Path(resultFolder+f"/imageDeformed.{imgext}")))
-    # also write out frames to individual files
-    defstack.export_frames(defImagesFolder, name=dataBaseName, counter=counter)
-    if spectra_folder is not None:
+    if output_format == "frames":
+        # also write out frames to individual files
+        defstack.export_frames(defImagesFolder, name=dataBaseName,
+                               counter=counter)
+    if spectra_folder is not None and energy_windows is not None:
+        logger.info("Writing out the energy window maps")
+        spectrumUndeformed = []
+        spectrumDeformed = []
+        windowsUndeformed = windowsUndeformed.result()
+        windowsDeformed = windowsDeformed.result()
+        for j, (start, end) in enumerate(energy_windows):
+            label = f"{start}-{end}keV"
+            undef = dio.create_new_image(
+                windowsUndeformed[j], specstr.pixelsize, specstr.pixelunit,
+                parent=specstr, process=f"Sum of energy window {label}")
+            undef.to_hspy(str(Path(
+                resultFolder+f"/spectrumUndeformed_{label}.hspy")))
+            spectrumUndeformed.append(undef)
+            defo = dio.create_new_image(
+                windowsDeformed[j], specstr.pixelsize, specstr.pixelunit,
+                parent=specstr, process=("Applied non rigid registration to "
+                                         f"energy window {label}"))
+            defo.to_hspy(str(Path(
+                resultFolder+f"/spectrumDeformed_{label}.hspy")))
+            spectrumDeformed.append(defo)
+        return (averageUndeformed, averageDeformed,
+                spectrumUndeformed, spectrumDeformed)
+    elif spectra_folder is not None and memory_limit is not None:
+        logger.info("Calculating average spectrum (undeformed)")
+        spectrumUndeformed = _create_spectrum_map(
+            sumUndeformed.result(), specstr, "Sum of all frames")
+        _save_spectrum_map(spectrumUndeformed, str(Path(
+            resultFolder+"/spectrumUndeformed.hspy")))
+        logger.info("Calculating average spectrum (deformed)")
+        spectrumDeformed = _create_spectrum_map(
+            sumDeformed.result(), specstr,
+            "Applied non rigid registration, sum of all frames")
+        _save_spectrum_map(spectrumDeformed, str(Path(
+                resultFolder+"/spectrumDeformed.hspy")))
+        # metadata of the deformed frames that were written out
+        defmeta = copy.deepcopy(specstr.metadata)
+        defmeta.data_axes["frame"]["bins"] = len(spec_frm_list)
+        defmeta.to_file(str(Path(f"{defSpectraFolder}/"
+                                 f"{dataBaseName}_meta.json")))
+        return (averageUndeformed, averageDeformed,
+                spectrumUndeformed, spectrumDeformed)
+    elif spectra_folder is not None:
         # averaged spectrum
         logger.info("Calculating average spectrum (undeformed)")
         spectrumUndeformed = specstr.spectrum_map
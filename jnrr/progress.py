@@ -0,0 +1,202 @@
+"""
+Progress and throughput reporting of the processing steps
+
+extract_emd, calculate_non_rigid_registration(s) and apply_deformations
+accept a progress argument: a callable, or a list of callables, that is
+called with a dictionary describing the progress of a stage:
+
+    stage     "export", "register", "apply" or "batch" (counts files)
+    label     the dataset, config file or result folder being processed
+    done      frames done
+    total     total number of frames
+    elapsed   seconds since the start of the stage
+    fps       frames per second
+    mbps      megabytes per second processed
+    eta       estimated seconds until the stage is finished, or None
+    finished  True for the last report of the stage
+
+Reports are rate limited, so updating a ProgressTracker for every frame
+costs a counter increment and a clock read. Adapters for tqdm, notebook
+widgets, logging and JSON-lines files are included.
+
+>>> apply_deformations(result_folder, progress=TqdmProgress())
+"""
+import json
+import logging
+import threading
+import time
+
+
+class ProgressTracker(object):
+    """
+    Count the frames of a stage and report the progress to callbacks
+
+    Parameters
+    ----------
+    stage : str
+        name of the stage
+    total : int
+        total number of frames
+    callbacks : callable or list of callables, optional
+        receive the progress dictionaries. If None, nothing is reported.
+    label : str, optional
+        name of what is being processed, e.g. the dataset
+    interval : float, optional
+        minimum time in seconds between two reports
+    """
+    def __init__(self, stage, total, callbacks=None, label=None,
+                 interval=0.5):
+        if callbacks is None:
+            callbacks = []
+        elif callable(callbacks):
+            callbacks = [callbacks]
+        self.stage = stage
+        self.total = total
+        self.callbacks = list(callbacks)
+        self.label = label
+        self.interval = interval
+        self.done = 0
+        self.nbytes = 0
+        self._start = time.perf_counter()
+        self._last = self._start
+        self._lock = threading.Lock()
+        self._finished = False
+        self._report(self._start)
+
+    def update(self, n=1, nbytes=0):
+        """Add n frames and nbytes processed bytes"""
+        if not self.callbacks:
+            return
+        with self._lock:
+            self.done += n
+            self.nbytes += nbytes
+            now = time.perf_counter()
+            if now - self._last >= self.interval:
+                self._report(now)
+
+    def set(self, done, nbytes=None):
+        """Set the number of frames done, e.g. when polling a process"""
+        if not self.callbacks:
+            return
+        with self._lock:
+            changed = done != self.done
+            self.done = done
+            if nbytes is not None:
+                self.nbytes = nbytes
+            now = time.perf_counter()
+            if changed and now - self._last >= self.interval:
+                self._report(now)
+
+    def finish(self):
+        """Send the final report of the stage"""
+        if not self.callbacks or self._finished:
+            return
+        with self._lock:
+            self._finished = True
+            self._report(time.perf_counter())
+
+    def _report(self, now):
+        self._last = now
+        if not self.callbacks:
+            return
+        elapsed = now - self._start
+        fps = self.done/elapsed if elapsed > 0 else 0.
+        eta = None
+        if self._finished:
+            eta = 0.
+        elif fps > 0:
+            eta = max(self.total - self.done, 0)/fps
+        event = {"stage": self.stage, "label": self.label, "done": self.done,
+                 "total": self.total, "elapsed": elapsed, "fps": fps,
+                 "mbps": self.nbytes/1e6/elapsed if elapsed > 0 else 0.,
+                 "eta": eta, "finished": self._finished}
+        for callback in self.callbacks:
+            callback(event)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.finish()
+
+
+def _key(event):
+    return (event["stage"], event["label"])
+
+
+def _describe(event):
+    label = f" {event['label']}" if event["label"] else ""
+    return f"{event['stage']}{label}"
+
+
+class LoggingProgress(object):
+    """Write the progress reports to a logger"""
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger("Progress")
+        self.level = level
+
+    def __call__(self, event):
+        eta = "" if event["eta"] is None else f", ETA {event['eta']:.0f} s"
+        self.logger.log(self.level,
+                        f"{_describe(event)}: {event['done']}/"
+                        f"{event['total']} frames, {event['fps']:.2f} fps, "
+                        f"{event['mbps']:.1f} MB/s{eta}")
+
+
+class JsonLinesProgress(object):
+    """
+    Append the progress reports as lines of json to a file
+
+    Parameters
+    ----------
+    path : str
+        path to the file
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        line = json.dumps({"time": time.time(), **event})
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+
+
+class TqdmProgress(object):
+    """
+    Show a tqdm progress bar for every stage and dataset
+
+    Parameters
+    ----------
+    kwargs : dict
+        passed to tqdm.tqdm, e.g. position or leave
+    """
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self._bars = {}
+        self._lock = threading.Lock()
+
+    def _new_bar(self, event):
+        from tqdm import tqdm
+        return tqdm(total=event["total"], desc=_describe(event),
+                    unit="frame", **self.kwargs)
+
+    def __call__(self, event):
+        with self._lock:
+            bar = self._bars.get(_key(event))
+            if bar is None:
+                bar = self._bars[_key(event)] = self._new_bar(event)
+            bar.update(event["done"] - bar.n)
+            bar.set_postfix_str(f"{event['mbps']:.1f} MB/s", refresh=False)
+            if event["finished"]:
+                bar.close()
+                del self._bars[_key(event)]
+
+
+class NotebookProgress(TqdmProgress):
+    """Show a progress bar widget in a jupyter notebook per stage"""
+    def _new_bar(self, event):
+        from tqdm.notebook import tqdm
+        return tqdm(total=event["total"], desc=_describe(event),
+                    unit="frame", **self.kwargs)
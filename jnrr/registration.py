@@ -0,0 +1,259 @@
+"""
+In-process non-rigid registration with numpy and scipy
+
+An alternative to the external match-series binary for small and medium
+frames (up to about 512x512). The frames are registered with a multilevel
+demons algorithm: on every level of an image pyramid, from coarse to fine,
+the displacements are updated with the intensity difference and gradient
+of the warped frames, and regularized by Gaussian smoothing of the update
+(fluid) and of the displacements (diffusion). Like match-series, later
+stages register the frames to the mean of the frames deformed in the
+previous stage. All frames of a chunk are processed at once, vectorized
+over the frames.
+
+The deformations follow the match-series convention used by
+apply_deformations: frame(x + d(x)) matches the reference, with d
+normalized by the largest image dimension - 1. register_stack works
+entirely in memory; register_config reads the frames of a config file
+and saves the deformations in the folder structure of match-series, so
+it can replace calculate_non_rigid_registration (backend="numpy").
+
+>>> fields = register_stack(stack)
+>>> deformed = warp_image(stack[3], fields[3, 0], fields[3, 1])
+"""
+import concurrent.futures as cf
+import functools
+import logging
+import os
+import shutil
+from pathlib import Path
+import numpy as np
+from .io_tools import read_config_file, saveToQ2bz, _getNameCounterFrames
+from .progress import ProgressTracker
+from ._imports import lazy_import
+
+ndimage = lazy_import("scipy.ndimage")
+Image = lazy_import("PIL.Image")
+
+logger = logging.getLogger("Registration")
+
+
+def _normalize(stack):
+    """Zero mean and unit standard deviation per frame"""
+    stack = np.asarray(stack, dtype=np.float64)
+    mean = stack.mean(axis=(-2, -1), keepdims=True)
+    std = stack.std(axis=(-2, -1), keepdims=True)
+    return (stack - mean)/np.where(std > 0, std, 1.)
+
+
+def _pyramid(stack, levels):
+    """Images from the finest to the coarsest level, halved per level"""
+    pyramid = [stack]
+    for _ in range(levels - 1):
+        smooth = ndimage.gaussian_filter(pyramid[-1], (0, 1., 1.))
+        pyramid.append(smooth[:, ::2, ::2])
+    return pyramid
+
+
+def _resize_field(u, shape):
+    """Resize (n, 2, h, w) pixel displacements to shape, scaling them"""
+    _, _, h, w = u.shape
+    zoom = (1, 1, shape[0]/h, shape[1]/w)
+    resized = ndimage.zoom(u, zoom, order=1, mode="nearest",
+                           grid_mode=True)
+    resized[:, 0] *= shape[1]/w
+    resized[:, 1] *= shape[0]/h
+    return resized
+
+
+def _warp(stack, u):
+    """Sample every frame at x + u(x) with linear interpolation"""
+    n, h, w = stack.shape
+    frames, rows, cols = np.ogrid[0:n, 0:h, 0:w]
+    coords = np.array(np.broadcast_arrays(frames + 0., rows + u[:, 1],
+                                          cols + u[:, 0]))
+    return ndimage.map_coordinates(stack, coords, order=1, mode="nearest")
+
+
+def _register_level(stack, reference, u, iterations, sigma_fluid,
+                    sigma_diffusion, epsilon):
+    """Demons iterations on one level, u is updated in place"""
+    energy = None
+    for _ in range(iterations):
+        warped = _warp(stack, u)
+        diff = warped - reference
+        gy, gx = np.gradient(warped, axis=(1, 2))
+        denominator = gx**2 + gy**2 + diff**2
+        scale = np.divide(diff, denominator, out=np.zeros_like(diff),
+                          where=denominator > 1e-12)
+        update = -np.array([scale*gx, scale*gy]).swapaxes(0, 1)
+        if sigma_fluid:
+            update = ndimage.gaussian_filter(
+                update, (0, 0, sigma_fluid, sigma_fluid))
+        u += update
+        if sigma_diffusion:
+            u[...] = ndimage.gaussian_filter(
+                u, (0, 0, sigma_diffusion, sigma_diffusion))
+        new_energy = float(np.mean(diff**2))
+        if energy is not None and energy - new_energy < epsilon*energy:
+            break
+        energy = new_energy
+    return u
+
+
+def register_stack(stack, reference=None, levels=3, iterations=50,
+                   stages=2, sigma_fluid=1., sigma_diffusion=2.,
+                   epsilon=1e-4, chunk=16, progress=None, label=None):
+    """
+    Register all frames of a stack to a reference
+
+    Parameters
+    ----------
+    stack : numpy.ndarray
+        (frames, height, width) image stack
+    reference : numpy.ndarray, optional
+        (height, width) reference of the first stage. Defaults to the
+        first frame.
+    levels : int, optional
+        number of levels of the image pyramid
+    iterations : int, optional
+        maximum number of iterations per level
+    stages : int, optional
+        number of stages. Every stage after the first registers the frames
+        to the mean of the frames deformed in the previous stage, starting
+        from the previous deformations.
+    sigma_fluid : float, optional
+        smoothing of the updates in pixels of the level
+    sigma_diffusion : float, optional
+        smoothing of the displacements in pixels of the level, the
+        regularization of the deformations
+    epsilon : float, optional
+        a level stops when the relative decrease of the mean squared
+        difference drops below epsilon
+    chunk : int, optional
+        number of frames registered at once, limits the memory use
+    progress : callable or list of callables, optional
+        receive progress reports, see progress.ProgressTracker
+    label : str, optional
+        label of the progress reports
+
+    Returns
+    -------
+    fields : numpy.ndarray
+        (frames, 2, height, width) x and y deformations normalized by the
+        largest image dimension - 1
+    """
+    stack = _normalize(stack)
+    n, h, w = stack.shape
+    levels = max(1, min(levels, int(np.log2(min(h, w))) - 2))
+    reference = stack[0] if reference is None else _normalize(reference)
+    u = np.zeros((n, 2, h, w))
+    tracker = ProgressTracker("register", n*stages, progress, label=label)
+    for stage in range(stages):
+        total = np.zeros((h, w))
+        for c0 in range(0, n, chunk):
+            frames = stack[c0:c0+chunk]
+            images = _pyramid(frames, levels)
+            targets = _pyramid(np.broadcast_to(reference, frames.shape),
+                               levels)
+            field = _resize_field(u[c0:c0+chunk], images[-1].shape[1:])
+            for level in range(levels - 1, -1, -1):
+                if field.shape[2:] != images[level].shape[1:]:
+                    field = _resize_field(field, images[level].shape[1:])
+                field = _register_level(images[level], targets[level], field,
+                                        iterations, sigma_fluid,
+                                        sigma_diffusion, epsilon)
+            u[c0:c0+chunk] = field
+            if stage + 1 < stages:
+                total += _warp(frames, field).sum(axis=0)
+            tracker.update(len(frames))
+        logger.debug(f"Finished stage {stage + 1} of {stages}")
+        if stage + 1 < stages:
+            # the next stage registers to the mean of the deformed frames
+            reference = _normalize(total/n)
+    tracker.finish()
+    return u/(max(h, w) - 1)
+
+
+def _read_frames(pattern, indexes):
+    frames = []
+    for i in indexes:
+        with Image.open(pattern % i) as img:
+            frames.append(np.asarray(img))
+    return np.array(frames)
+
+
+def register_config(config_file, progress=None, **kwargs):
+    """
+    Register the frames of a match-series config file in-process
+
+    The deformations are saved in the folder structure of match-series in
+    the saveDirectory of the config file, together with a copy of the
+    config file as parameter-dump.txt.
+
+    Parameters
+    ----------
+    config_file : str
+        path to the config file
+    progress : callable or list of callables, optional
+        receive progress reports, see progress.ProgressTracker
+    kwargs : dict
+        passed to register_stack. By default stages follows
+        numExtraStages and iterations maxGDIterations of the config file.
+
+    Returns
+    -------
+    result_folder : str
+        path to the folder with the deformations
+    """
+    conf = read_config_file(config_file)
+    savedir = conf["saveDirectory"].strip()
+    pattern = conf["templateNamePattern"].strip()
+    (_, _, _, numframes, skipframes, bznumber,
+        stages) = _getNameCounterFrames(config_file)
+    indexes = [i for i in range(numframes) if i not in skipframes]
+    kwargs.setdefault("stages", stages)
+    if "maxGDIterations" in conf:
+        kwargs.setdefault("iterations", int(conf["maxGDIterations"]))
+    fields = register_stack(_read_frames(pattern, indexes),
+                            progress=progress, label=config_file, **kwargs)
+    for pos, i in enumerate(indexes):
+        sub = f"{i}" if pos == 0 else f"{i}-r"
+        folder = str(Path(f"{savedir}/stage{stages}/{sub}/"))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        for j in range(2):
+            saveToQ2bz(str(Path(f"{folder}/deformation_{bznumber}_{j}"
+                                ".dat.bz2")), fields[pos, j])
+    shutil.copyfile(config_file, str(Path(savedir + "/parameter-dump.txt")))
+    logger.info(f"Registered {len(indexes)} frames of {config_file}")
+    return savedir
+
+
+def register_configs(config_files, workers=None, progress=None, **kwargs):
+    """
+    Register several config files in-process concurrently
+
+    Parameters
+    ----------
+    config_files : list of str
+        paths to the config files
+    workers : int, optional
+        maximum number of config files registered at the same time.
+        Defaults to the number of processors.
+    progress : callable or list of callables, optional
+        receive progress reports of every registration
+    kwargs : dict
+        passed to register_stack
+
+    Returns
+    -------
+    result_folders : list of str
+        the result folder of each config file
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    register = functools.partial(register_config, progress=progress,
+                                 **kwargs)
+    with cf.ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(register, config_files))
@@ -0,0 +1,149 @@
+"""
+Screening of image stacks for frames that should not be registered
+
+Cheap statistics are calculated for all frames of a stack at once: the mean
+intensity, the sharpness and the FFT based correlation with the neighboring
+frames and the corresponding shift. Frames where one of the statistics is a
+robust outlier (beam blanking, drift jumps, charging, ...) can then be added
+to templateSkipNums so match-series does not spend time on them.
+"""
+import numpy as np
+
+
+# lower bound of the spread of each statistic, so that very stable series
+# do not reject frames over insignificant differences. Relative to the
+# median for intensity and sharpness, absolute for correlation and shift.
+SPREAD_FLOOR = {"intensity": (0.01, 0.), "sharpness": (0.05, 0.),
+                "correlation": (0., 0.05), "shift": (0., 1.)}
+
+
+def _robust_zscore(values, floor=(0., 0.)):
+    """Deviation from the median in units of the scaled MAD"""
+    relative, absolute = floor
+    median = np.median(values)
+    mad = 1.4826*np.median(np.abs(values - median))
+    mad = max(mad, relative*abs(median), absolute, 1e-12)
+    return (values - median)/mad
+
+
+def _normalize(frames):
+    """Subtract the mean and scale each frame to unit norm"""
+    frames = frames - frames.mean(axis=(1, 2), keepdims=True)
+    norms = np.sqrt((frames**2).sum(axis=(1, 2), keepdims=True))
+    return frames/np.where(norms > 0, norms, 1)
+
+
+def _neighbour_correlation(data, window, chunk):
+    """
+    Correlation peak and shift of every frame with the mean of its neighbors
+
+    The reference of a frame is the average of the (normalized) frames up
+    to window frames before and after it. The cross correlations of a chunk
+    of frames are calculated with one batched FFT.
+    """
+    frames, h, w = data.shape
+    peaks = np.zeros(frames)
+    shifts = np.zeros(frames)
+    for a in range(0, frames, chunk):
+        b = min(a + chunk, frames)
+        lo = max(0, a - window)
+        hi = min(frames, b + window)
+        ffts = np.fft.rfft2(_normalize(data[lo:hi].astype(np.float32)))
+        cumulative = np.concatenate([np.zeros((1,) + ffts.shape[1:],
+                                              dtype=ffts.dtype),
+                                     np.cumsum(ffts, axis=0)])
+        local = np.arange(a, b) - lo
+        start = np.maximum(local - window, 0)
+        stop = np.minimum(local + window + 1, hi - lo)
+        count = (stop - start - 1)[:, None, None]
+        refs = (cumulative[stop] - cumulative[start] - ffts[local])
+        refs = refs/count
+        refnorms = np.sqrt((np.fft.irfft2(refs, s=(h, w))**2).sum(
+            axis=(1, 2)))
+        xcorr = np.fft.irfft2(ffts[local]*np.conj(refs), s=(h, w))
+        flat = xcorr.reshape(b - a, -1)
+        maxinx = flat.argmax(axis=1)
+        peaks[a:b] = flat[np.arange(b - a), maxinx] / np.where(
+            refnorms > 0, refnorms, 1)
+        dy, dx = np.unravel_index(maxinx, (h, w))
+        dy = np.where(dy > h//2, dy - h, dy)
+        dx = np.where(dx > w//2, dx - w, dx)
+        shifts[a:b] = np.hypot(dx, dy)
+    return peaks, shifts
+
+
+def frame_statistics(data, window=2, chunk=64):
+    """
+    Calculate screening statistics of all frames of an image stack
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        (frames, height, width) image stack
+    window : int, optional
+        number of frames before and after a frame that are averaged as its
+        reference for the correlation
+    chunk : int, optional
+        number of frames that are processed together, limits the memory use
+
+    Returns
+    -------
+    statistics : dict
+        arrays of "intensity", "sharpness", "correlation" and "shift" with
+        one value per frame
+    """
+    frames = data.shape[0]
+    intensity = np.zeros(frames)
+    sharpness = np.zeros(frames)
+    for a in range(0, frames, chunk):
+        block = data[a:a+chunk].astype(np.float32)
+        intensity[a:a+chunk] = block.mean(axis=(1, 2))
+        gradient = (np.mean(np.diff(block, axis=1)**2, axis=(1, 2)) +
+                    np.mean(np.diff(block, axis=2)**2, axis=(1, 2)))
+        variance = block.var(axis=(1, 2))
+        sharpness[a:a+chunk] = gradient/np.where(variance > 0, variance, 1)
+    if frames > 1:
+        correlation, shift = _neighbour_correlation(data, window, chunk)
+    else:
+        correlation, shift = np.ones(frames), np.zeros(frames)
+    return {"intensity": intensity, "sharpness": sharpness,
+            "correlation": correlation, "shift": shift}
+
+
+def find_bad_frames(data, threshold=5., window=2, chunk=64):
+    """
+    Return the indexes of frames that are outliers in the screening
+
+    A frame is rejected when its intensity deviates in either direction, its
+    sharpness or correlation with its neighbors is low, or it is shifted a
+    lot with respect to its neighbors. Deviations are measured as robust
+    z-scores (median and MAD over all frames), where the MAD is at least
+    the value in SPREAD_FLOOR.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        (frames, height, width) image stack
+    threshold : float, optional
+        z-score above which a frame is rejected
+    window : int, optional
+        see frame_statistics
+    chunk : int, optional
+        see frame_statistics
+
+    Returns
+    -------
+    bad_frames : list of int
+        indexes of the rejected frames
+    statistics : dict
+        the statistics of frame_statistics with the z-scores added as
+        "<name>_z"
+    """
+    stats = frame_statistics(data, window=window, chunk=chunk)
+    for k in list(stats.keys()):
+        stats[f"{k}_z"] = _robust_zscore(stats[k], SPREAD_FLOOR[k])
+    bad = ((np.abs(stats["intensity_z"]) > threshold) |
+           (stats["sharpness_z"] < -threshold) |
+           (stats["correlation_z"] < -threshold) |
+           (stats["shift_z"] > threshold))
+    return [int(i) for i in np.nonzero(bad)[0]], stats
@@ -0,0 +1,186 @@
+"""
+Shared memory arrays for process pools
+
+Sending frames, spectrum cubes or whole stacks to worker processes pickles
+and copies them for every task. A SharedArray is allocated once, in shared
+memory or in a memory-mapped file, and pickles to a small reference that
+the workers attach to without copying. map_indexes runs a function on a
+process pool where every worker attaches to the arrays once and the tasks
+only carry an index.
+
+The process pools of the package start their workers with process_context,
+not by forking: a forked worker inherits the state of the threads of the
+parent, e.g. the TBB thread pool of numba once a kernel ran, and the
+interpreter then hangs at exit.
+
+>>> with SharedArray.from_array(stack) as data, \\
+...         SharedArray(stack.shape, stack.dtype) as out:
+...     map_indexes(process_frame, range(len(stack)), [data, out])
+...     result = out.array.copy()
+"""
+import concurrent.futures as cf
+import itertools
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+import numpy as np
+
+
+class SharedArray(object):
+    """
+    numpy array in shared memory that is pickled by reference
+
+    Parameters
+    ----------
+    shape : tuple
+        shape of the array
+    dtype : numpy.dtype
+        data type of the array
+    path : str, optional
+        back the array by a memory-mapped file at path instead of shared
+        memory, e.g. when /dev/shm is small. The file is not deleted.
+    name : str, optional
+        name of existing shared memory to attach to
+    create : bool, optional
+        allocate new memory. If False, attach to the memory given by name or
+        the file given by path.
+
+    Attributes
+    ----------
+    array : numpy.ndarray
+        the array, a view on the shared memory
+    """
+    def __init__(self, shape, dtype, path=None, name=None, create=True):
+        self.shape = tuple(int(i) for i in shape)
+        self.dtype = np.dtype(dtype)
+        self.path = path
+        self.create = create
+        self._shm = None
+        if path is not None:
+            self.array = np.memmap(path, dtype=self.dtype,
+                                   mode="w+" if create else "r+",
+                                   shape=self.shape)
+            return
+        size = max(int(np.prod(self.shape))*self.dtype.itemsize, 1)
+        self._shm = shared_memory.SharedMemory(name=name, create=create,
+                                               size=size)
+        if not create:
+            _untrack(self._shm)
+        self.array = np.ndarray(self.shape, dtype=self.dtype,
+                                buffer=self._shm.buf)
+
+    @classmethod
+    def from_array(cls, data, path=None):
+        """Allocate a SharedArray and copy data into it"""
+        shared = cls(data.shape, data.dtype, path=path)
+        shared.array[...] = data
+        return shared
+
+    @property
+    def name(self):
+        """Name of the shared memory, None if backed by a file"""
+        return None if self._shm is None else self._shm.name
+
+    def __reduce__(self):
+        return (SharedArray, (self.shape, self.dtype.str, self.path,
+                              self.name, False))
+
+    def close(self):
+        """Release the memory, it is freed when the creator closes it"""
+        self.array = None
+        if self._shm is not None:
+            self._shm.close()
+            if self.create:
+                self._shm.unlink()
+            self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _untrack(shm):
+    """
+    Stop the resource tracker from unlinking memory that is only attached
+
+    Before python 3.13 attaching registers the memory with the resource
+    tracker, which unlinks it when the process exits. Workers of a process
+    pool share the tracker of their parent, where the memory is already
+    registered by its creator and must stay registered.
+    """
+    process = multiprocessing.current_process()
+    if multiprocessing.parent_process() is not None or \
+            getattr(process, "_inheriting", False):
+        # started by a pool, the initargs are unpickled while inheriting
+        return
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception:
+        pass
+
+
+def process_context():
+    """
+    Multiprocessing context of the process pools
+
+    The workers are started by a fork server, or spawned where there is
+    none, so functions run in them must be defined at module level.
+    """
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context(
+        "forkserver" if "forkserver" in methods else "spawn")
+
+
+# the arrays a worker process is attached to
+_worker_arrays = []
+
+
+def _attach(arrays):
+    _worker_arrays[:] = [None if i is None else i.array for i in arrays]
+
+
+def _call(func, index, args, kwargs):
+    return func(index, *_worker_arrays, *args, **kwargs)
+
+
+def imap_indexes(func, indexes, arrays, *args, workers=None, **kwargs):
+    """
+    Run func(index, *arrays, *args, **kwargs) for all indexes on processes
+
+    The worker processes attach to the shared arrays once, every task only
+    sends the index, func and the additional arguments. func must be
+    defined at module level. The results are yielded in the order of the
+    indexes.
+
+    Parameters
+    ----------
+    func : callable
+        function called in the workers with the index and the numpy arrays
+        of the shared arrays
+    indexes : iterable
+        the indexes
+    arrays : list of SharedArray
+        arrays passed to func, None entries are passed as None
+    workers : int, optional
+        number of processes, defaults to the number of processors
+    """
+    indexes = list(indexes)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    chunksize = max(1, len(indexes)//(4*workers))
+    with cf.ProcessPoolExecutor(max_workers=workers,
+                                mp_context=process_context(),
+                                initializer=_attach,
+                                initargs=(list(arrays),)) as pool:
+        yield from pool.map(_call, itertools.repeat(func), indexes,
+                            itertools.repeat(args),
+                            itertools.repeat(kwargs), chunksize=chunksize)
+
+
+def map_indexes(func, indexes, arrays, *args, workers=None, **kwargs):
+    """Like imap_indexes, but return the results as a list"""
+    return list(imap_indexes(func, indexes, arrays, *args, workers=workers,
+                             **kwargs))
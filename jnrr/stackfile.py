@@ -0,0 +1,137 @@
+"""
+Single file output of image series
+
+Instead of one image file per frame, a corrected series can be written as
+one (frames, height, width) dataset in an HDF5 file while the frames are
+calculated. Without compression the dataset is stored contiguously, so
+other tools can memory-map it directly from the file. With compression it
+is chunked per frame.
+
+>>> with StackWriter("deformed.h5", 100, (512, 512), np.float32,
+...                  pixelsize=0.1, pixelunit="nm") as writer:
+...     for frame in frames:
+...         writer.write(frame)
+>>> data, attributes = read_stack("deformed.h5")
+"""
+import numpy as np
+from ._imports import lazy_import
+
+h5py = lazy_import("h5py")
+
+DATASET = "frames"
+
+
+class StackWriter(object):
+    """
+    Write the frames of an image series one by one to an HDF5 file
+
+    Parameters
+    ----------
+    path : str
+        path of the HDF5 file, is overwritten if it exists
+    frames : int
+        number of frames that will be written
+    shape : tuple
+        (height, width) of a frame
+    dtype : numpy.dtype
+        data type of the frames
+    pixelsize : float, optional
+        size of a pixel, stored as attribute
+    pixelunit : str, optional
+        unit of the pixel size, stored as attribute
+    compression : str, optional
+        HDF5 compression filter, e.g. "gzip" or "lzf". If None, the data is
+        stored contiguously and can be memory-mapped.
+    compression_opts : int, optional
+        options of the compression filter, e.g. the gzip level
+    chunk_frames : int, optional
+        number of frames per chunk when compressed
+    attributes : dict, optional
+        additional attributes stored with the dataset
+    """
+    def __init__(self, path, frames, shape, dtype, pixelsize=None,
+                 pixelunit=None, compression=None, compression_opts=None,
+                 chunk_frames=1, attributes=None):
+        self.path = path
+        self.frames = frames
+        self._file = h5py.File(path, "w")
+        kwargs = {}
+        if compression is not None:
+            kwargs = {"chunks": (min(chunk_frames, frames),) + tuple(shape),
+                      "compression": compression,
+                      "compression_opts": compression_opts}
+        self._dataset = self._file.create_dataset(
+            DATASET, shape=(frames,) + tuple(shape), dtype=dtype, **kwargs)
+        if pixelsize is not None:
+            self._dataset.attrs["pixelsize"] = pixelsize
+        if pixelunit is not None:
+            self._dataset.attrs["pixelunit"] = pixelunit
+        for k, v in (attributes or {}).items():
+            self._dataset.attrs[k] = v
+        self._indexes = []
+
+    def write(self, frame, index=None):
+        """
+        Write the next frame
+
+        Parameters
+        ----------
+        frame : numpy.ndarray
+            (height, width) frame
+        index : int, optional
+            index of the frame in the original series, stored in the
+            frame_indexes attribute. Defaults to the position in the file.
+        """
+        n = len(self._indexes)
+        if n >= self.frames:
+            raise IndexError(f"All {self.frames} frames were already written")
+        self._dataset[n] = frame
+        self._indexes.append(n if index is None else index)
+
+    def close(self):
+        """Write the frame indexes and close the file"""
+        if self._file is None:
+            return
+        self._dataset.attrs["frame_indexes"] = np.array(self._indexes,
+                                                        dtype=np.int64)
+        self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_stack(path, memmap=True):
+    """
+    Read an image series written by StackWriter
+
+    Parameters
+    ----------
+    path : str
+        path of the HDF5 file
+    memmap : bool, optional
+        return a read-only memory map of the file if the dataset is stored
+        contiguously without compression. Otherwise the data is read into
+        memory.
+
+    Returns
+    -------
+    data : numpy.ndarray or numpy.memmap
+        (frames, height, width) array
+    attributes : dict
+        pixelsize, pixelunit, frame_indexes and other stored attributes
+    """
+    with h5py.File(path, "r") as f:
+        dataset = f[DATASET]
+        attributes = dict(dataset.attrs)
+        offset = None
+        if memmap and dataset.chunks is None:
+            offset = dataset.id.get_offset()
+        if offset is None:
+            return dataset[()], attributes
+        shape, dtype = dataset.shape, dataset.dtype
+    return (np.memmap(path, dtype=dtype, mode="r", offset=offset,
+                      shape=shape), attributes)
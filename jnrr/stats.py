@@ -0,0 +1,258 @@
+"""
+Streaming statistics of image series
+
+The statistics are calculated per pixel over the frames of a folder of
+exported frames or of a stack that is read frame by frame, such as a
+memory-mapped HDF5 stack. Frames are read in chunks by a pool of reader
+threads while the previous chunk is processed, so at most two chunks are
+held in memory:
+
+* mean and variance in one pass, by merging the moments of the chunks
+* sigma-clipped mean, with one more pass per clipping iteration
+* approximate median, the medians of the chunks are reduced to medians of
+  MEDIAN_MERGE medians at a time, so only a few frames per level of the
+  reduction are held. It is exact if the series fits in one chunk.
+
+>>> stats = frame_statistics("nonrigid_results_000/deformedImages_000",
+...                          memory_limit="2GB")
+>>> stats["clipped_mean"]
+"""
+import concurrent.futures as cf
+import os
+from pathlib import Path
+import numpy as np
+from .memory import _budget
+from ._imports import lazy_import
+
+Image = lazy_import("PIL.Image")
+
+IMAGE_EXTENSIONS = (".tiff", ".tif", ".png", ".bmp", ".jpg", ".jpeg")
+STATISTICS = ("mean", "variance", "clipped_mean", "median")
+# number of chunk medians that are reduced to one median
+MEDIAN_MERGE = 8
+
+
+def _read_image(path):
+    with Image.open(path) as img:
+        return np.asarray(img)
+
+
+class FrameSource(object):
+    """
+    Frames of a folder or of a stack that are read one by one
+
+    Parameters
+    ----------
+    source : str or array-like
+        folder with one image per frame, or a (frames, height, width) stack
+        that reads a frame when it is indexed, e.g. a numpy memmap, h5py
+        dataset or dask array
+    frames : list of int, optional
+        indexes of the frames to use, by default all
+    """
+    def __init__(self, source, frames=None):
+        if isinstance(source, (str, os.PathLike)):
+            self.paths = [str(Path(f"{source}/{i}"))
+                          for i in sorted(os.listdir(source))
+                          if i.lower().endswith(IMAGE_EXTENSIONS)
+                          and not i.startswith(".")]
+            self._read = self._read_path
+            self.indexes = list(range(len(self.paths)))
+        else:
+            self.stack = source
+            self._read = self._read_stack
+            self.indexes = list(range(source.shape[0]))
+        if frames is not None:
+            self.indexes = [self.indexes[i] for i in frames]
+        if not self.indexes:
+            raise ValueError(f"No frames found in {source}")
+        self.shape = self._read(self.indexes[0]).shape
+
+    def _read_path(self, index):
+        return _read_image(self.paths[index])
+
+    def _read_stack(self, index):
+        return np.asarray(self.stack[index])
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def chunks(self, chunk, workers=None):
+        """
+        Yield the frames as float64 (frames, height, width) chunks
+
+        The next chunk is read by the thread pool while the current one is
+        processed.
+        """
+        starts = range(0, len(self), chunk)
+        with cf.ThreadPoolExecutor(max_workers=workers) as pool:
+
+            def submit(start):
+                return [pool.submit(self._read, i)
+                        for i in self.indexes[start:start+chunk]]
+
+            pending = submit(starts[0])
+            for n, start in enumerate(starts):
+                frames = pending
+                if n + 1 < len(starts):
+                    pending = submit(starts[n+1])
+                yield np.array([f.result() for f in frames],
+                               dtype=np.float64)
+
+
+def _median_frames(chunks):
+    """Frames held by the reduction of the medians of a number of chunks"""
+    levels = max(1, int(np.ceil(np.log(max(chunks, 1))/np.log(MEDIAN_MERGE))))
+    # MEDIAN_MERGE - 1 per level and the copy made to merge a level
+    return (MEDIAN_MERGE - 1)*levels + MEDIAN_MERGE
+
+
+def _chunk_size(source, chunk, memory_limit, medians=True):
+    if chunk is not None:
+        return max(int(chunk), 1)
+    frame = int(np.prod(source.shape))*np.dtype(np.float64).itemsize
+    # two chunks, the accumulators and the chunk medians, at most one chunk
+    # per frame
+    reserved = 8 + (_median_frames(len(source)) if medians else 0)
+    available = _budget(memory_limit)//2 - reserved*frame
+    return int(np.clip(available//(2*frame), 1, len(source)))
+
+
+def _push_median(levels, median):
+    """Add a chunk median, every MEDIAN_MERGE medians of a level are merged"""
+    for level in levels:
+        level.append(median)
+        if len(level) < MEDIAN_MERGE:
+            return
+        median = np.median(level, axis=0)
+        level.clear()
+    levels.append([median])
+
+
+def _reduce_medians(levels):
+    """Merge the remaining medians from the lowest level up"""
+    median = None
+    for level in levels:
+        if median is not None:
+            level.append(median)
+        if level:
+            median = level[0] if len(level) == 1 else np.median(level, axis=0)
+    return median
+
+
+def _clip_pass(source, center, spread, sigma, chunk, workers):
+    """Mean and standard deviation of the values within sigma*spread"""
+    total = np.zeros(source.shape)
+    squares = np.zeros(source.shape)
+    count = np.zeros(source.shape)
+    lower = center - sigma*spread
+    upper = center + sigma*spread
+    for data in source.chunks(chunk, workers):
+        keep = (data >= lower) & (data <= upper)
+        data = np.where(keep, data, 0.)
+        total += data.sum(axis=0)
+        squares += (data**2).sum(axis=0)
+        count += keep.sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = total/count
+        std = np.sqrt(np.maximum(squares/count - mean**2, 0.))
+    # pixels where every value was clipped keep the previous estimate
+    empty = count == 0
+    mean[empty] = center[empty]
+    std[empty] = spread[empty]
+    return mean, std
+
+
+def frame_statistics(source, statistics=STATISTICS, sigma=3.,
+                     iterations=1, frames=None, chunk=None,
+                     memory_limit=None, workers=None):
+    """
+    Per pixel statistics over the frames of an image series
+
+    Parameters
+    ----------
+    source : str or array-like
+        folder with one image per frame or a (frames, height, width) stack,
+        see FrameSource
+    statistics : tuple of str, optional
+        which of "mean", "variance", "clipped_mean" and "median" to
+        calculate
+    sigma : float, optional
+        values further than sigma standard deviations from the mean are
+        rejected by the clipped mean
+    iterations : int, optional
+        number of clipping iterations, each reads the frames once more
+    frames : list of int, optional
+        indexes of the frames to use, by default all
+    chunk : int, optional
+        number of frames read at once. By default as many as fit in the
+        memory limit.
+    memory_limit : int or str, optional
+        memory budget in bytes or as a string like "2GB" that determines
+        the chunk size. Defaults to the available memory.
+    workers : int, optional
+        number of reader threads
+
+    Returns
+    -------
+    stats : dict
+        float64 (height, width) arrays of the requested statistics and the
+        number of "frames"
+    """
+    unknown = set(statistics) - set(STATISTICS)
+    if unknown:
+        raise ValueError(f"Unknown statistics {unknown}")
+    if not isinstance(source, FrameSource):
+        source = FrameSource(source, frames)
+    chunk = _chunk_size(source, chunk, memory_limit,
+                        medians="median" in statistics)
+    count = 0
+    mean = np.zeros(source.shape)
+    m2 = np.zeros(source.shape)
+    medians = []
+    for data in source.chunks(chunk, workers):
+        # merge the moments of the chunk into the running moments
+        n = data.shape[0]
+        chunk_mean = data.mean(axis=0)
+        delta = chunk_mean - mean
+        mean += delta*n/(count + n)
+        m2 += ((data - chunk_mean)**2).sum(axis=0) + \
+            delta**2*count*n/(count + n)
+        count += n
+        if "median" in statistics:
+            _push_median(medians, np.median(data, axis=0))
+    variance = m2/count
+    stats = {"frames": count}
+    if "mean" in statistics:
+        stats["mean"] = mean
+    if "variance" in statistics:
+        stats["variance"] = variance
+    if "median" in statistics:
+        stats["median"] = _reduce_medians(medians)
+    if "clipped_mean" in statistics:
+        center, spread = mean, np.sqrt(variance)
+        for _ in range(iterations):
+            center, spread = _clip_pass(source, center, spread, sigma,
+                                        chunk, workers)
+        stats["clipped_mean"] = center
+    return stats
+
+
+def save_statistics(stats, folder, prefix="", extension="tiff"):
+    """
+    Write the statistics as float32 images
+
+    Returns
+    -------
+    paths : dict
+        path of the image of each statistic
+    """
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    paths = {}
+    for key, value in stats.items():
+        if key == "frames":
+            continue
+        paths[key] = str(Path(f"{folder}/{prefix}{key}.{extension}"))
+        Image.fromarray(value.astype(np.float32)).save(paths[key])
+    return paths
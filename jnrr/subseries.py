@@ -0,0 +1,242 @@
+"""
+Parallel registration of long series in overlapping sub-series
+
+match-series registers all frames of a config file in one process, so the
+runtime of a long series grows with its length while the other cores are
+idle. Instead the series is split in overlapping chunks of frames. Every
+chunk gets a copy of the config file that only registers its frames and
+the common reference, the first registered frame of the series, and the
+chunks are registered concurrently.
+
+Later match-series stages register the frames to the average of their
+chunk, so the fields of different chunks refer to slightly different
+targets. The chunks are chained through the frames they share: the mean
+difference of the fields of the shared frames maps the target of a chunk
+to the target of the previous chunk, and is composed with all fields of
+the chunk. The merged fields are saved in the folder structure of
+match-series in the result folder of the original config file, so
+apply_deformations can use it directly.
+
+>>> result_folder = run_subseries_registration("matchSeries_000.par",
+...                                            chunk_size=100, overlap=8)
+"""
+import json
+import logging
+import os
+import re
+import shutil
+from pathlib import Path
+import numpy as np
+from .io_tools import read_config_file, saveToQ2bz, _getNameCounterFrames
+from .processing import calculate_non_rigid_registrations, load_deformation
+from ._imports import lazy_import
+
+ndimage = lazy_import("scipy.ndimage")
+
+logger = logging.getLogger("Subseries")
+
+LAYOUT_FILE = "subseries.json"
+
+
+def _set_option(text, key, value):
+    """Replace the value of an option in the text of a config file"""
+    line = f"{key} {value}"
+    text, n = re.subn(rf"^{key}\s+.*$", lambda _: line, text,
+                      flags=re.MULTILINE)
+    if n == 0:
+        text = text.rstrip("\n") + f"\n{line}\n"
+    return text
+
+
+def split_series(config_file, chunk_size, overlap=8, output_folder=None):
+    """
+    Write a config file for every overlapping chunk of a series
+
+    Parameters
+    ----------
+    config_file : str
+        path to the config file of the whole series
+    chunk_size : int
+        number of registered frames per chunk, without the reference
+    overlap : int, optional
+        number of frames shared by consecutive chunks, at least 1
+    output_folder : str, optional
+        folder for the chunk config files and results. Defaults to
+        subseries_<config name> next to the config file.
+
+    Returns
+    -------
+    layout_file : str
+        path to the json file describing the chunks
+    """
+    if not 1 <= overlap < chunk_size:
+        raise ValueError("The overlap must be at least 1 and smaller than "
+                         "the chunk size")
+    config_file = os.path.abspath(config_file)
+    stem = os.path.splitext(os.path.basename(config_file))[0]
+    if output_folder is None:
+        output_folder = str(Path(
+            f"{os.path.dirname(config_file)}/subseries_{stem}"))
+    if not os.path.isdir(output_folder):
+        os.makedirs(output_folder)
+    with open(config_file) as f:
+        text = f.read()
+    (_, _, _, numframes, skipframes, _,
+        _) = _getNameCounterFrames(config_file)
+    registered = [i for i in range(numframes) if i not in skipframes]
+    reference = registered[0]
+    chunks = []
+    for start in range(0, len(registered), chunk_size - overlap):
+        frames = registered[start:start+chunk_size]
+        if start > 0 and len(frames) <= overlap:
+            # the previous chunk already contains these frames
+            break
+        if reference not in frames:
+            frames = [reference] + frames
+        c = str(len(chunks)).zfill(3)
+        savedir = str(Path(f"{output_folder}/nonrigid_results_{c}"))
+        if not os.path.isdir(savedir):
+            os.makedirs(savedir)
+        skip = [i for i in range(frames[-1] + 1) if i not in frames]
+        chunk_text = _set_option(text, "numTemplates", frames[-1] + 1)
+        chunk_text = _set_option(chunk_text, "templateSkipNums",
+                                 "{ " + " ".join(map(str, skip)) + " }")
+        chunk_text = _set_option(chunk_text, "saveDirectory", savedir)
+        chunk_config = str(Path(f"{output_folder}/matchSeries_{c}.par"))
+        with open(chunk_config, "w") as f:
+            f.write(chunk_text)
+        chunks.append({"config": chunk_config, "savedir": savedir,
+                       "frames": frames})
+    layout = {"config_file": config_file,
+              "result_folder": read_config_file(
+                  config_file)["saveDirectory"].strip(),
+              "reference": reference, "overlap": overlap, "chunks": chunks}
+    layout_file = str(Path(f"{output_folder}/{LAYOUT_FILE}"))
+    with open(layout_file, "w") as f:
+        json.dump(layout, f, indent=4)
+    logger.info(f"Split {len(registered)} frames in {len(chunks)} chunks")
+    return layout_file
+
+
+def _compose(field, correction, scale):
+    """
+    Displacement of x -> m(x) + field(m(x)) with m(x) = x + correction(x)
+
+    field and correction are (2, h, w) x and y displacements normalized by
+    scale, field is interpolated linearly at the corrected positions.
+    """
+    _, h, w = field.shape
+    rows, cols = np.mgrid[0:h, 0:w]
+    coords = np.array([rows + correction[1]*scale,
+                       cols + correction[0]*scale])
+    return correction + np.array([
+        ndimage.map_coordinates(i, coords, order=1, mode="nearest")
+        for i in field])
+
+
+def merge_subseries(layout_file):
+    """
+    Chain the deformations of the chunks into one set of fields
+
+    Parameters
+    ----------
+    layout_file : str
+        path to the json file created by split_series
+
+    Returns
+    -------
+    result_folder : str
+        the result folder of the original config file with the merged
+        deformations and its parameter-dump.txt
+    """
+    with open(layout_file) as f:
+        layout = json.load(f)
+    result_folder = layout["result_folder"]
+    reference = layout["reference"]
+    (_, _, _, _, _, bznumber,
+        stage) = _getNameCounterFrames(layout["chunks"][0]["config"])
+    merged = {}
+    previous = {}
+    for n, chunk in enumerate(layout["chunks"]):
+        fields = {}
+        for i in chunk["frames"]:
+            defX, defY = load_deformation(chunk["savedir"], stage, bznumber,
+                                          i, i == reference)
+            fields[i] = np.array([defX, defY])
+        if n > 0:
+            shared = [i for i in chunk["frames"] if i in previous]
+            # maps the target of this chunk to the target of the previous
+            correction = np.mean([previous[i] - fields[i] for i in shared],
+                                 axis=0)
+            scale = max(correction.shape[1:]) - 1
+            fields = {i: _compose(v, correction, scale)
+                      for i, v in fields.items()}
+        for i, field in fields.items():
+            if i in merged:
+                continue
+            merged[i] = True
+            sub = f"{i}" if i == reference else f"{i}-r"
+            folder = str(Path(f"{result_folder}/stage{stage}/{sub}/"))
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            for j in range(2):
+                saveToQ2bz(str(Path(f"{folder}/deformation_{bznumber}_{j}"
+                                    ".dat.bz2")), field[j])
+        # only the chained fields of the frames in the next chunk are kept
+        if n + 1 < len(layout["chunks"]):
+            following = layout["chunks"][n+1]["frames"]
+            previous = {i: v for i, v in fields.items() if i in following}
+    shutil.copyfile(layout["config_file"],
+                    str(Path(result_folder + "/parameter-dump.txt")))
+    logger.info(f"Merged {len(layout['chunks'])} chunks into {result_folder}")
+    return result_folder
+
+
+def run_subseries_registration(config_file, chunk_size, overlap=8,
+                               workers=None, progress=None,
+                               output_folder=None, backend="matchseries",
+                               **kwargs):
+    """
+    Register a long series in overlapping chunks concurrently
+
+    Parameters
+    ----------
+    config_file : str
+        path to the config file of the whole series
+    chunk_size : int
+        number of registered frames per chunk
+    overlap : int, optional
+        number of frames shared by consecutive chunks
+    workers : int, optional
+        maximum number of chunks registered at the same time
+    progress : callable or list of callables, optional
+        receive progress reports of the chunks, see progress.ProgressTracker
+    output_folder : str, optional
+        see split_series
+    backend : str, optional
+        "matchseries" to register the chunks with match-series, "numpy" with
+        registration.register_configs
+    kwargs : dict
+        passed to registration.register_configs with the numpy backend
+
+    Returns
+    -------
+    result_folder : str
+        path to the folder with the merged deformations, which can be
+        passed to processing.apply_deformations
+    """
+    layout_file = split_series(config_file, chunk_size, overlap,
+                               output_folder)
+    with open(layout_file) as f:
+        layout = json.load(f)
+    configs = [i["config"] for i in layout["chunks"]]
+    if backend == "numpy":
+        from .registration import register_configs
+        register_configs(configs, workers=workers, progress=progress,
+                         **kwargs)
+    elif backend == "matchseries":
+        calculate_non_rigid_registrations(configs, workers=workers,
+                                          progress=progress)
+    else:
+        raise ValueError(f"Unknown registration backend {backend}")
+    return merge_subseries(layout_file)
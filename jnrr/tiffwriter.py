@@ -0,0 +1,236 @@
+"""
+TIFF writer that writes frames straight from their numpy buffer
+
+Saving a frame with PIL converts it to a PIL image first, which copies it
+and for 16 bit and float data goes through PIL's mode handling. This
+writer builds the TIFF header with the dtype of the frame and then writes
+the buffer of the frame, or of a memory-mapped stack, directly to the file.
+Without compression and tiling the header is the same for every frame of a
+series, so it is built once and writing a frame is two writes.
+
+Tiles and deflate compression are optional. They need a copy of every
+tile or strip, but produce files that are faster to read in parts or
+smaller. The files are baseline little-endian TIFFs with one sample per
+pixel, readable by tifffile and match-series. PIL reads only some sample
+types correctly, so the frames are written as the nearest type it does
+read: float16 and float64 frames as float32, like PIL itself converts them,
+and int8 frames as int16. uint32 and 64 bit integer frames are refused.
+PIL still returns int16 frames as int32, with the same values.
+
+>>> writer = RawTiffWriter((512, 512), np.uint16)
+>>> for i, frame in enumerate(stack):
+...     writer.write(f"frame_{i:03d}.tiff", frame)
+"""
+import concurrent.futures as cf
+import struct
+import zlib
+import numpy as np
+
+_SHORT = 3
+_LONG = 4
+_COMPRESSION = {None: 1, "deflate": 8, "zlib": 8}
+# SampleFormat per numpy kind
+_SAMPLE_FORMAT = {"u": 1, "i": 2, "f": 3}
+# types that PIL does not read, written as one it reads
+_CONVERTED = {"f2": "f4", "f8": "f4", "i1": "i2"}
+# types that PIL misreads and that can not be converted without loss
+_UNREADABLE = ("u4", "i8", "u8")
+# target size of a compressed strip in bytes
+_STRIP_BYTES = 2**16
+
+
+def _entry(tag, kind, values):
+    """IFD entry and the values that do not fit in it"""
+    values = list(values)
+    fmt = "<" + ("H" if kind == _SHORT else "I")*len(values)
+    data = struct.pack(fmt, *values)
+    return tag, kind, len(values), data
+
+
+def _ifd(entries, offset):
+    """
+    Pack the IFD at offset, with the values that do not fit in the entries
+    directly after it
+    """
+    entries = sorted(entries)
+    extra_offset = offset + 2 + 12*len(entries) + 4
+    ifd = [struct.pack("<H", len(entries))]
+    extra = []
+    for tag, kind, count, data in entries:
+        if len(data) <= 4:
+            value = data.ljust(4, b"\0")
+        else:
+            value = struct.pack("<I", extra_offset)
+            extra.append(data)
+            extra_offset += len(data)
+        ifd.append(struct.pack("<HHI", tag, kind, count) + value)
+    ifd.append(struct.pack("<I", 0))
+    return b"".join(ifd + extra)
+
+
+class RawTiffWriter(object):
+    """
+    Write frames of one shape and dtype as TIFF files
+
+    Parameters
+    ----------
+    shape : tuple
+        (height, width) of the frames
+    dtype : numpy.dtype
+        data type of the frames: unsigned or signed integers or floats.
+        float16, float64 and int8 frames are converted, see the module.
+    tile : int, optional
+        write square tiles of this size, a multiple of 16, instead of strips
+    compression : str, optional
+        "deflate" to compress the strips or tiles with zlib
+    compression_level : int, optional
+        zlib compression level
+    """
+    def __init__(self, shape, dtype, tile=None, compression=None,
+                 compression_level=6):
+        self.shape = tuple(int(i) for i in shape)
+        self.dtype = np.dtype(dtype).newbyteorder("<")
+        if self.dtype == np.dtype(bool):
+            self.dtype = np.dtype(np.uint8)
+        key = f"{self.dtype.kind}{self.dtype.itemsize}"
+        if self.dtype.kind not in _SAMPLE_FORMAT or key in _UNREADABLE:
+            raise TypeError(f"Frames of type {self.dtype} can not be "
+                            "written as TIFF")
+        if key in _CONVERTED:
+            self.dtype = np.dtype(_CONVERTED[key]).newbyteorder("<")
+        if compression not in _COMPRESSION:
+            raise ValueError(f"Unknown compression {compression}")
+        if tile is not None and tile % 16:
+            raise ValueError("The tile size must be a multiple of 16")
+        self.tile = tile
+        self.compression = compression
+        self.compression_level = compression_level
+        h, w = self.shape
+        if tile is None and compression is None:
+            rows = h
+        else:
+            rows = max(1, _STRIP_BYTES//(w*self.dtype.itemsize))
+        self.rows_per_strip = min(rows, h)
+        self._header = None
+        if tile is None and compression is None:
+            self._header = self._build_header(
+                [h*w*self.dtype.itemsize])
+
+    def _tags(self):
+        h, w = self.shape
+        tags = [_entry(256, _LONG, [w]), _entry(257, _LONG, [h]),
+                _entry(258, _SHORT, [8*self.dtype.itemsize]),
+                _entry(259, _SHORT, [_COMPRESSION[self.compression]]),
+                _entry(262, _SHORT, [1]), _entry(277, _SHORT, [1]),
+                _entry(284, _SHORT, [1]),
+                _entry(339, _SHORT, [_SAMPLE_FORMAT[self.dtype.kind]])]
+        if self.tile is None:
+            tags.append(_entry(278, _LONG, [self.rows_per_strip]))
+        else:
+            tags += [_entry(322, _LONG, [self.tile]),
+                     _entry(323, _LONG, [self.tile])]
+        return tags
+
+    def _build_header(self, counts):
+        """Header and IFD for blocks of counts bytes following them"""
+        offsets_tag, counts_tag = (273, 279) if self.tile is None \
+            else (324, 325)
+        tags = self._tags()
+        # the size of the IFD does not depend on the offset values
+        size = len(_ifd(tags + [_entry(offsets_tag, _LONG, counts),
+                                _entry(counts_tag, _LONG, counts)], 8))
+        start = 8 + size
+        offsets = list(np.cumsum([start] + counts[:-1]))
+        ifd = _ifd(tags + [_entry(offsets_tag, _LONG, offsets),
+                           _entry(counts_tag, _LONG, counts)], 8)
+        return b"II*\0" + struct.pack("<I", 8) + ifd
+
+    def _blocks(self, frame):
+        """The strips or tiles of a frame as bytes-like objects"""
+        h, w = self.shape
+        if self.tile is None:
+            for r in range(0, h, self.rows_per_strip):
+                yield frame[r:r+self.rows_per_strip]
+            return
+        t = self.tile
+        for r in range(0, h, t):
+            for c in range(0, w, t):
+                block = np.zeros((t, t), dtype=self.dtype)
+                part = frame[r:r+t, c:c+t]
+                block[:part.shape[0], :part.shape[1]] = part
+                yield block
+
+    def _encode(self, block):
+        if self.compression is None:
+            return memoryview(np.ascontiguousarray(block)).cast("B")
+        return zlib.compress(np.ascontiguousarray(block),
+                             self.compression_level)
+
+    def _check(self, frame):
+        frame = np.asarray(frame)
+        if frame.shape != self.shape:
+            raise ValueError(f"Frame of shape {frame.shape} does not match "
+                             f"the writer shape {self.shape}")
+        if frame.dtype != self.dtype:
+            # byte order, bool and the conversions of _CONVERTED
+            frame = frame.astype(self.dtype)
+        return frame
+
+    def write(self, path, frame):
+        """Write frame as TIFF file at path"""
+        frame = self._check(frame)
+        with open(path, "wb") as f:
+            if self._header is not None:
+                f.write(self._header)
+                # no intermediate copy for contiguous frames
+                f.write(memoryview(np.ascontiguousarray(frame)).cast("B"))
+                return
+            blocks = [self._encode(i) for i in self._blocks(frame)]
+            f.write(self._build_header([len(i) for i in blocks]))
+            for block in blocks:
+                f.write(block)
+
+
+def write_tiff(path, frame, tile=None, compression=None,
+               compression_level=6):
+    """Write a single 2D array as TIFF file, see RawTiffWriter"""
+    frame = np.asarray(frame)
+    RawTiffWriter(frame.shape, frame.dtype, tile=tile,
+                  compression=compression,
+                  compression_level=compression_level).write(path, frame)
+
+
+def write_tiffs(stack, paths, indexes=None, tile=None, compression=None,
+                compression_level=6, workers=None):
+    """
+    Write many frames of a (frames, height, width) stack as TIFF files
+
+    The header is shared by all frames and the frames are written by a
+    thread pool, reading them directly from the stack, e.g. a memmap.
+
+    Parameters
+    ----------
+    stack : numpy.ndarray
+        the frames
+    paths : list of str
+        path of every written frame
+    indexes : list of int, optional
+        frames of the stack to write, by default all
+    workers : int, optional
+        number of writing threads, 1 to write serially
+    """
+    if indexes is None:
+        indexes = range(stack.shape[0])
+    indexes = list(indexes)
+    if len(indexes) != len(paths):
+        raise ValueError("Provide one path for every frame")
+    writer = RawTiffWriter(stack.shape[1:], stack.dtype, tile=tile,
+                           compression=compression,
+                           compression_level=compression_level)
+    if workers == 1:
+        for i, path in zip(indexes, paths):
+            writer.write(path, stack[i])
+        return
+    with cf.ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(lambda j: writer.write(paths[j], stack[indexes[j]]),
+                      range(len(paths))))
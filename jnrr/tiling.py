@@ -0,0 +1,252 @@
+"""
+Tiled non-rigid registration of large or non-square frames
+
+match-series works on square images with a power of two size. Instead of
+registering the full frames, the frames are split in overlapping square
+tiles with a power of two size. Every tile series gets its own config file,
+the tiles are registered concurrently and the deformations of the tiles are
+blended into one deformation field per frame. These are saved in the same
+folder structure as match-series uses, so apply_deformations can use the
+stitched result folder directly.
+"""
+import json
+import logging
+import os
+from pathlib import Path
+import numpy as np
+from .io_tools import (export_frames, write_config_file, saveToQ2bz,
+                       frame_extension, _getNameCounterFrames)
+from .processing import (calculate_non_rigid_registrations,
+                         load_deformation)
+from ._imports import lazy_import
+
+dio = lazy_import("temmeta.data_io")
+
+
+def _tile_starts(length, tile_size, overlap):
+    """Start positions of tiles covering length with at least overlap"""
+    if tile_size > length:
+        raise ValueError(f"The tile size {tile_size} is larger than the "
+                         f"image dimension {length}")
+    if overlap >= tile_size:
+        raise ValueError("The overlap must be smaller than the tile size")
+    starts = list(range(0, length - tile_size + 1, tile_size - overlap))
+    # the last tile is aligned with the edge of the frame
+    if starts[-1] != length - tile_size:
+        starts.append(length - tile_size)
+    return starts
+
+
+def tile_layout(height, width, tile_size, overlap=32):
+    """
+    Return the (y, x) top left corners of tiles covering a frame
+
+    Parameters
+    ----------
+    height : int
+        frame height
+    width : int
+        frame width
+    tile_size : int
+        tile width and height, must be a power of 2
+    overlap : int, optional
+        minimum overlap between neighboring tiles in pixels
+
+    Returns
+    -------
+    corners : list of tuples
+        (y, x) of each tile
+    """
+    if tile_size & (tile_size - 1) or tile_size < 2:
+        raise ValueError(f"The tile size {tile_size} is not a power of 2")
+    return [(y, x) for y in _tile_starts(height, tile_size, overlap)
+            for x in _tile_starts(width, tile_size, overlap)]
+
+
+def export_tiles(stack, output_folder, tile_size, overlap=32,
+                 prefix="frame", digits=None, pathpattern=None,
+                 result_folder=None, skipframes=[], multithreading=True,
+                 extension="tiff", **kwargs):
+    """
+    Export the frames of an image stack as overlapping tiles
+
+    For every tile the frames are exported to a folder and a match-series
+    config file is created. The layout is written to tiling.json in
+    output_folder.
+
+    Parameters
+    ----------
+    stack : temmeta.GeneralImageStack
+        the image stack to split in tiles
+    output_folder : str
+        folder in which the tile folders and config files are created
+    tile_size : int
+        tile width and height, must be a power of 2
+    overlap : int, optional
+        minimum overlap between neighboring tiles in pixels
+    prefix : str, optional
+        name of the individual frames
+    digits : int, optional
+        number of counter digits. Defaults to the minimum necessary
+    pathpattern : str, optional
+        match-series name pattern of the full frames. Is written in the
+        config file of the stitched result, so the full frames are corrected
+        by apply_deformations.
+    result_folder : str, optional
+        folder in which the stitched deformations will be saved. Defaults to
+        nonrigid_results in output_folder.
+    skipframes : list, optional
+        frames that should not be registered
+    multithreading : bool, optional
+        whether to use multithreading to export
+    extension : str, optional
+        extension of the exported images
+
+    Additional parameters
+    ---------------------
+    See kwargs of io_tools.write_config_file
+
+    Returns
+    -------
+    layout_file : str
+        path to the tiling.json file
+    """
+    output_folder = os.path.abspath(output_folder)
+    if not os.path.isdir(output_folder):
+        os.makedirs(output_folder)
+    if digits is None:
+        digits = dio._get_counter(stack.frames)
+    if result_folder is None:
+        result_folder = str(Path(f"{output_folder}/nonrigid_results/"))
+    corners = tile_layout(stack.height, stack.width, tile_size, overlap)
+    tiles = []
+    for k, (y, x) in enumerate(corners):
+        c = str(k).zfill(3)
+        tilestack = dio.create_new_image_stack(
+            stack.data[:, y:y+tile_size, x:x+tile_size], stack.pixelsize,
+            stack.pixelunit, parent=stack,
+            process=f"Tile {k} at x={x}, y={y}")
+        opath = str(Path(f"{output_folder}/tile_{c}/"))
+        if not os.path.isdir(opath):
+            os.makedirs(opath)
+        export_frames(tilestack, output_folder=opath, prefix=prefix,
+                      digits=digits, multithreading=multithreading,
+                      data_format=extension)
+        filename = str(Path(f"{output_folder}/matchSeries_tile_{c}.par"))
+        savedir = str(Path(f"{output_folder}/nonrigid_results_tile_{c}/"))
+        if not os.path.isdir(savedir):
+            os.makedirs(savedir)
+        write_config_file(
+            filename,
+            pathpattern=str(Path(f"{opath}/{prefix}_%0{digits}d."
+                                 f"{frame_extension(extension)}")),
+            savedir=savedir, preclevel=int(np.log2(tile_size)),
+            num_frames=stack.frames, skipframes=skipframes, **kwargs)
+        tiles.append({"y": y, "x": x, "config": filename,
+                      "savedir": savedir})
+    layout = {"height": stack.height, "width": stack.width,
+              "tile_size": tile_size, "overlap": overlap,
+              "pathpattern": pathpattern, "result_folder": result_folder,
+              "num_frames": stack.frames, "skipframes": list(skipframes),
+              "numstag": kwargs.get("numstag", 2), "tiles": tiles}
+    layout_file = str(Path(f"{output_folder}/tiling.json"))
+    with open(layout_file, "w") as f:
+        json.dump(layout, f, indent=4)
+    logging.debug(f"Exported {len(tiles)} tiles to {output_folder}")
+    return layout_file
+
+
+def _blend_weights(tile_size, overlap):
+    """Weights that fall off linearly towards the tile edges"""
+    inx = np.arange(tile_size)
+    ramp = np.minimum(1., np.minimum(inx + 1, tile_size - inx)/(overlap + 1))
+    return np.outer(ramp, ramp)
+
+
+def stitch_tiles(layout_file):
+    """
+    Blend the deformations of the tiles into one field per frame
+
+    The tile deformations are converted to pixels, averaged with weights
+    that fall off towards the tile edges and normalized with the size of the
+    full frame. The result is saved with the match-series folder structure
+    and a parameter-dump.txt in the result folder of the layout.
+
+    Parameters
+    ----------
+    layout_file : str
+        path to the tiling.json file created by export_tiles
+
+    Returns
+    -------
+    result_folder : str
+        path to the folder with the stitched deformations
+    """
+    with open(layout_file) as f:
+        layout = json.load(f)
+    height, width = layout["height"], layout["width"]
+    tile_size = layout["tile_size"]
+    result_folder = layout["result_folder"]
+    weights = _blend_weights(tile_size, layout["overlap"])
+    weightsum = np.zeros((height, width))
+    for tile in layout["tiles"]:
+        y, x = tile["y"], tile["x"]
+        weightsum[y:y+tile_size, x:x+tile_size] += weights
+    # read the stage and level from the first tile
+    (_, _, _, numframes, skipframes, tilebz,
+        stage) = _getNameCounterFrames(
+            str(Path(layout["tiles"][0]["savedir"]+"/parameter-dump.txt")))
+    preclevel = int(np.ceil(np.log2(max(height, width))))
+    bznumber = str(preclevel).zfill(2)
+    scale = max(height, width) - 1
+    firstframe = True
+    for i in range(numframes):
+        if i in skipframes:
+            continue
+        displacement = np.zeros((2, height, width))
+        for tile in layout["tiles"]:
+            y, x = tile["y"], tile["x"]
+            defX, defY = load_deformation(tile["savedir"], stage, tilebz, i,
+                                          firstframe)
+            displacement[:, y:y+tile_size, x:x+tile_size] += \
+                weights*np.array([defX, defY])*(tile_size - 1)
+        displacement = displacement/weightsum/scale
+        sub = f"{i}" if firstframe else f"{i}-r"
+        folder = str(Path(f"{result_folder}/stage{stage}/{sub}/"))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        for j in range(2):
+            saveToQ2bz(str(Path(f"{folder}/deformation_{bznumber}_{j}"
+                                ".dat.bz2")), displacement[j])
+        firstframe = False
+    write_config_file(str(Path(result_folder+"/parameter-dump.txt")),
+                      pathpattern=layout["pathpattern"],
+                      savedir=result_folder, preclevel=preclevel,
+                      num_frames=numframes, skipframes=skipframes,
+                      numstag=stage-1)
+    logging.debug(f"Stitched the tile deformations into {result_folder}")
+    return result_folder
+
+
+def run_tiled_registration(layout_file, workers=None):
+    """
+    Register all tiles concurrently and stitch the deformations
+
+    Parameters
+    ----------
+    layout_file : str
+        path to the tiling.json file created by export_tiles
+    workers : int, optional
+        maximum number of concurrent match-series processes
+
+    Returns
+    -------
+    result_folder : str
+        path to the folder with the stitched deformations, which can be
+        passed to processing.apply_deformations
+    """
+    with open(layout_file) as f:
+        layout = json.load(f)
+    calculate_non_rigid_registrations([i["config"] for i in layout["tiles"]],
+                                      workers=workers)
+    return stitch_tiles(layout_file)
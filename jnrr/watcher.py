@@ -0,0 +1,287 @@
+"""
+Watch a folder for new emd files and process them as they arrive
+
+Every emd file that appears in the watched folder, and whose size has not
+changed for a while, goes through extraction, non-rigid registration and
+application of the deformations. Each stage has its own pool with a
+bounded number of workers, so different files can be in different stages
+at the same time. The state of every file is kept in a json job file in the
+output folder, so a restarted watcher continues where it stopped.
+
+>>> watcher = FolderWatcher("/share/session", "/data/session")
+>>> watcher.run()
+"""
+import concurrent.futures as cf
+import fnmatch
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from . import io_tools
+from . import processing
+from .sharedmem import process_context
+
+logger = logging.getLogger("Watcher")
+
+JOB_FILE = "jobs.json"
+
+# stage that runs for a file in a given state, with the state while running
+# and the state after success
+STAGES = {"queued": ("extract", "extracting", "extracted"),
+          "extracted": ("register", "registering", "registered"),
+          "registered": ("apply", "applying", "done")}
+# state from which a running state was started
+RUNNING = {v[1]: k for k, v in STAGES.items()}
+
+
+def extract_stage(path, output_folder, options):
+    """Extract the emd file, return the paths dictionary of extract_emd"""
+    return io_tools.extract_emd(path, output_folder=output_folder, **options)
+
+
+def register_stage(paths, options):
+    """Run match-series on all config files of an extracted file"""
+    return [processing.calculate_non_rigid_registration(i)
+            for i in paths["config_file_paths"]]
+
+
+def apply_stage(paths, result_folders, options):
+    """Apply the deformations to the images and their spectrum streams"""
+    options = dict(options)
+    spectra = io_tools.dataset_spectra(paths)
+    if not options.pop("spectra", True):
+        spectra = [None]*len(spectra)
+    for result_folder, image_folder, spectra_folder in zip(
+            result_folders, paths["image_folder_paths"], spectra):
+        processing.apply_deformations(result_folder, image_folder,
+                                      spectra_folder, **options)
+    return result_folders
+
+
+class FolderWatcher(object):
+    """
+    Process emd files that appear in a folder in a pipeline
+
+    Parameters
+    ----------
+    input_folder : str
+        the folder that is watched
+    output_folder : str, optional
+        results of file name.emd are written to output_folder/name. By
+        default the input folder.
+    pattern : str, optional
+        file name pattern of the files to process
+    settle_time : float, optional
+        seconds that the size and modification time of a file must be
+        constant before it is considered complete
+    poll_interval : float, optional
+        seconds between scans of the folder
+    workers : dict, optional
+        maximum number of concurrent jobs per stage, keys "extract",
+        "register" and "apply". Defaults to 1, 2 and 1.
+    options : dict, optional
+        keyword arguments per stage, passed to io_tools.extract_emd and
+        processing.apply_deformations. The apply options can also contain
+        "spectra": False to not correct the spectra. The stages work on the
+        extracted files, so the extract option keep_stacks is not supported.
+    stages : dict, optional
+        replacement functions for the stages "extract", "register" and
+        "apply" with the signatures of extract_stage, register_stage and
+        apply_stage
+    use_processes : bool, optional
+        run extraction and application in worker processes instead of
+        threads. The stage functions must then be picklable.
+    """
+    def __init__(self, input_folder, output_folder=None, pattern="*.emd",
+                 settle_time=10., poll_interval=2., workers=None,
+                 options=None, stages=None, use_processes=True):
+        self.input_folder = os.path.abspath(input_folder)
+        if output_folder is None:
+            output_folder = self.input_folder
+        self.output_folder = os.path.abspath(output_folder)
+        if not os.path.isdir(self.output_folder):
+            os.makedirs(self.output_folder)
+        self.pattern = pattern
+        self.settle_time = settle_time
+        self.poll_interval = poll_interval
+        self.workers = {"extract": 1, "register": 2, "apply": 1}
+        self.workers.update(workers or {})
+        self.options = {"extract": {}, "register": {}, "apply": {}}
+        self.options.update(options or {})
+        if self.options["extract"].get("keep_stacks"):
+            raise ValueError("The watcher does not support keep_stacks")
+        self.stages = {"extract": extract_stage,
+                       "register": register_stage,
+                       "apply": apply_stage}
+        self.stages.update(stages or {})
+        self.use_processes = use_processes
+        self.job_file = str(Path(f"{self.output_folder}/{JOB_FILE}"))
+        self.jobs = self._load_jobs()
+        self._seen = {}
+        self._running = {}
+        self._pools = None
+        self._stop = False
+
+    def _load_jobs(self):
+        """Read the job file, jobs that were interrupted are restarted"""
+        if not os.path.isfile(self.job_file):
+            return {}
+        with open(self.job_file) as f:
+            jobs = json.load(f)
+        for job in jobs.values():
+            job["state"] = RUNNING.get(job["state"], job["state"])
+        return jobs
+
+    def _save_jobs(self):
+        tmp = self.job_file + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.jobs, f, indent=4)
+        os.replace(tmp, self.job_file)
+
+    def scan(self):
+        """Queue the files in the input folder that are complete"""
+        now = time.time()
+        for name in sorted(os.listdir(self.input_folder)):
+            path = str(Path(f"{self.input_folder}/{name}"))
+            if (not fnmatch.fnmatch(name, self.pattern) or
+                    path in self.jobs or not os.path.isfile(path)):
+                continue
+            stat = os.stat(path)
+            signature = (stat.st_size, stat.st_mtime)
+            previous = self._seen.get(path)
+            if previous is None or previous[0] != signature:
+                self._seen[path] = (signature, now)
+            elif now - previous[1] >= self.settle_time:
+                stem, _ = os.path.splitext(name)
+                self.jobs[path] = {
+                    "state": "queued",
+                    "output_folder": str(Path(f"{self.output_folder}/"
+                                              f"{stem}/")),
+                    "paths": None, "result_folders": None, "error": None}
+                del self._seen[path]
+                logger.info(f"Queued {path}")
+                self._save_jobs()
+
+    def _submit(self, path, job):
+        stage, running, _ = STAGES[job["state"]]
+        options = self.options[stage]
+        func = self.stages[stage]
+        if stage == "extract":
+            args = (path, job["output_folder"], options)
+        elif stage == "register":
+            args = (job["paths"], options)
+        else:
+            args = (job["paths"], job["result_folders"], options)
+        future = self._pools[stage].submit(func, *args)
+        job["state"] = running
+        self._running[future] = path
+        logger.info(f"Started {stage} of {path}")
+
+    def _collect(self, future):
+        path = self._running.pop(future)
+        job = self.jobs[path]
+        stage, _, done = STAGES[RUNNING[job["state"]]]
+        try:
+            result = future.result()
+        except Exception as e:
+            job["state"] = "failed"
+            job["error"] = f"{stage}: {e}"
+            logger.error(f"The {stage} of {path} failed: {e}")
+            return
+        if stage == "extract":
+            # the job file is json, kept stacks are not needed by the stages
+            job["paths"] = {k: v for k, v in result.items()
+                            if k != "datasets"}
+        elif stage == "register":
+            job["result_folders"] = result
+        job["state"] = done
+        logger.info(f"Finished {stage} of {path}")
+
+    def step(self):
+        """Scan the folder, collect finished jobs and start new ones"""
+        self.scan()
+        for future in [i for i in self._running if i.done()]:
+            self._collect(future)
+        busy = {k: 0 for k in self.workers}
+        for path in self._running.values():
+            busy[STAGES[RUNNING[self.jobs[path]["state"]]][0]] += 1
+        for path, job in self.jobs.items():
+            if job["state"] not in STAGES:
+                continue
+            stage = STAGES[job["state"]][0]
+            if busy[stage] < self.workers[stage]:
+                self._submit(path, job)
+                busy[stage] += 1
+        self._save_jobs()
+
+    def _start_pools(self):
+        def pool(max_workers):
+            if self.use_processes:
+                return cf.ProcessPoolExecutor(max_workers=max_workers,
+                                              mp_context=process_context())
+            return cf.ThreadPoolExecutor(max_workers=max_workers)
+        self._pools = {
+            "extract": pool(self.workers["extract"]),
+            "register": cf.ThreadPoolExecutor(
+                max_workers=self.workers["register"]),
+            "apply": pool(self.workers["apply"])}
+
+    def _shutdown_pools(self):
+        for future in list(self._running):
+            if future.cancel():
+                # not started yet, will be restarted next time
+                job = self.jobs[self._running.pop(future)]
+                job["state"] = RUNNING[job["state"]]
+            else:
+                cf.wait([future])
+                self._collect(future)
+        for pool in self._pools.values():
+            pool.shutdown(wait=True)
+        self._pools = None
+        self._save_jobs()
+
+    @property
+    def pending(self):
+        """Number of files that are not done or failed"""
+        return sum(1 for i in self.jobs.values()
+                   if i["state"] not in ("done", "failed"))
+
+    def run(self, timeout=None, until_idle=False):
+        """
+        Watch the folder until stop is called
+
+        Parameters
+        ----------
+        timeout : float, optional
+            stop after this many seconds
+        until_idle : bool, optional
+            stop as soon as all queued files are processed and no files are
+            waiting to settle
+        """
+        self._stop = False
+        self._start_pools()
+        start = time.time()
+        try:
+            while not self._stop:
+                self.step()
+                if until_idle and not self.pending and not self._seen:
+                    break
+                if timeout is not None and time.time() - start > timeout:
+                    break
+                time.sleep(self.poll_interval)
+        finally:
+            self._shutdown_pools()
+
+    def stop(self):
+        """Stop the watcher after the current iteration"""
+        self._stop = True
+
+
+def watch_folder(input_folder, output_folder=None, **kwargs):
+    """Create a FolderWatcher and run it, see FolderWatcher for arguments"""
+    run_kwargs = {k: kwargs.pop(k) for k in ("timeout", "until_idle")
+                  if k in kwargs}
+    watcher = FolderWatcher(input_folder, output_folder, **kwargs)
+    watcher.run(**run_kwargs)
+    return watcher
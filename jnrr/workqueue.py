@@ -0,0 +1,880 @@
+"""
+Distributed processing of emd files with a shared work queue
+
+Extraction, registration and correction of the files of a session are
+split in tasks that workers on any number of hosts pull from a queue.
+Finishing a task queues its follow-up tasks: the extraction of a file
+queues a registration per dataset, and each registration the correction of
+its dataset. A dataset registered in sub-series gets a registration task
+per chunk, and the last chunk that finishes queues the merge of the chunks,
+which queues the correction. All paths are on storage shared by the
+workers.
+
+The queue is pluggable, every transport offers put, claim, heartbeat,
+complete, fail and counts:
+
+* FileQueue keeps every task as a json file in a folder on the shared
+  storage. A task is claimed by renaming it, which only one worker can do.
+* MemoryQueue keeps the tasks in memory of one process. QueueBroker serves
+  any queue over TCP and TcpQueue is its client, so the workers only need
+  to reach the broker.
+
+Workers claim a task whenever they have a free slot, so fast workers take
+more tasks than slow ones, later stages first so files finish early. A
+claimed task is leased: the worker renews the lease with heartbeats, and
+when a worker dies its tasks are taken over by other workers after the
+lease expired. Failed tasks are queued again until they failed
+max_attempts times, also when the process running them died. A task that
+was taken over may still finish on its old worker; only the worker that
+owns the task completes it and queues its follow-up tasks, the other
+result is ignored. Follow-up tasks have ids derived from their task, so
+they are queued once.
+
+>>> queue = open_queue("/share/queue")
+>>> submit_files(queue, "/share/session", "/share/results")
+>>> QueueWorker(queue, slots=2).run(until_idle=True)
+"""
+import concurrent.futures as cf
+import glob
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+import uuid
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from .batch import find_emd_files, _output_folders, _index_entry
+from .sharedmem import process_context
+
+logger = logging.getLogger("WorkQueue")
+
+STATES = ("pending", "running", "done", "failed")
+# tasks of later stages are claimed first
+PRIORITY = {"apply": 0, "merge": 1, "register": 2, "extract": 3}
+# written to the result folder of a sub-series chunk once it is registered
+CHUNK_MARKER = "registered"
+
+
+def new_task(kind, args, max_attempts=3, task_id=None):
+    """
+    A task dictionary of the given kind with json serializable args
+
+    A task_id that is derived from the work, e.g. from a path, makes tasks
+    that are queued more than once collapse into one, see FileQueue.put.
+    By default the id is random.
+    """
+    return {"id": task_id or uuid.uuid4().hex, "kind": kind, "args": args,
+            "attempts": 0, "max_attempts": max_attempts, "created": None,
+            "worker": None, "error": None, "result": None}
+
+
+def _write_json(path, data, tmp_folder):
+    """Write json atomically, readers never see a partial file"""
+    tmp = str(Path(f"{tmp_folder}/{uuid.uuid4().hex}.tmp"))
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=4)
+    os.replace(tmp, path)
+
+
+def _read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+class FileQueue(object):
+    """
+    Work queue in a folder on shared storage
+
+    Every task is a json file in the subfolder of its state. The names of
+    pending tasks sort by priority and age, and a task is claimed by
+    renaming it to the running folder. The modification time of a running
+    task is its last heartbeat. The ids of all queued tasks are reserved by
+    creating a file in the ids folder.
+
+    Parameters
+    ----------
+    folder : str
+        folder of the queue, created if necessary
+    lease : float, optional
+        seconds after the last heartbeat after which a running task is
+        taken over by another worker
+    """
+    def __init__(self, folder, lease=300.):
+        self.folder = os.path.abspath(folder)
+        self.lease = lease
+        for sub in STATES + ("tmp", "ids"):
+            path = self._path(sub)
+            if not os.path.isdir(path):
+                os.makedirs(path, exist_ok=True)
+
+    def _path(self, state, name=""):
+        return str(Path(f"{self.folder}/{state}/{name}"))
+
+    @staticmethod
+    def _pending_name(task):
+        return (f"{PRIORITY.get(task['kind'], 9)}-{task['created']:020d}-"
+                f"{task['kind']}-{task['id']}.json")
+
+    def put(self, task):
+        """Queue a task, return its id. A task with a used id is ignored."""
+        try:
+            # only one of several puts of the same id can create the file
+            os.close(os.open(self._path("ids", task["id"]),
+                             os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            logger.debug(f"Task {task['id']} was already queued")
+            return task["id"]
+        return self._queue(task)
+
+    def _queue(self, task):
+        task = dict(task, created=time.time_ns(), worker=None)
+        _write_json(self._path("pending", self._pending_name(task)), task,
+                    self._path("tmp"))
+        return task["id"]
+
+    def claim(self, worker, kinds=None):
+        """Take the next pending task, None if there is none"""
+        self._requeue_expired()
+        for name in sorted(os.listdir(self._path("pending"))):
+            # ids may contain dashes, kinds do not
+            kind, task_id = name[:-5].split("-", 3)[2:]
+            if kinds is not None and kind not in kinds:
+                continue
+            source = self._path("pending", name)
+            target = self._path("running", f"{task_id}.json")
+            try:
+                # the lease starts now, not when the task was queued
+                os.utime(source)
+                os.rename(source, target)
+            except FileNotFoundError:
+                # claimed by another worker
+                continue
+            task = _read_json(target)
+            task["worker"] = worker
+            _write_json(target, task, self._path("tmp"))
+            return task
+        return None
+
+    def _requeue_expired(self):
+        """Queue the running tasks of lost workers again"""
+        deadline = time.time() - self.lease
+        for name in os.listdir(self._path("running")):
+            path = self._path("running", name)
+            try:
+                if os.path.getmtime(path) >= deadline:
+                    continue
+                # only one worker can take over the task
+                claimed = self._path("tmp", f"{name}.expired")
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                continue
+            task = _read_json(claimed)
+            logger.warning(f"The lease of task {task['id']} on "
+                           f"{task['worker']} expired")
+            self._retry(task, f"lease of {task['worker']} expired")
+            os.remove(claimed)
+
+    def _owner(self, task_id):
+        """Worker of a running task, None if it is not running"""
+        try:
+            return _read_json(self._path("running", f"{task_id}.json"))[
+                "worker"]
+        except FileNotFoundError:
+            return None
+
+    def heartbeat(self, task_id, worker):
+        """Renew the lease, False if the task was taken over"""
+        if self._owner(task_id) != worker:
+            return False
+        try:
+            os.utime(self._path("running", f"{task_id}.json"))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _finish(self, task_id, worker=None):
+        """
+        Remove a running task, return it. None if it was taken over, or
+        runs on another worker than the given one.
+        """
+        path = self._path("running", f"{task_id}.json")
+        claimed = self._path("tmp", f"{task_id}.json.finished")
+        try:
+            if worker is not None and self._owner(task_id) != worker:
+                raise FileNotFoundError(path)
+            os.rename(path, claimed)
+        except FileNotFoundError:
+            logger.warning(f"Task {task_id} was taken over by another worker")
+            return None
+        task = _read_json(claimed)
+        os.remove(claimed)
+        return task
+
+    def _retry(self, task, error):
+        task["attempts"] += 1
+        task["error"] = error
+        if task["attempts"] < task["max_attempts"]:
+            self._queue(task)
+        else:
+            _write_json(self._path("failed", f"{task['id']}.json"), task,
+                        self._path("tmp"))
+
+    def complete(self, task_id, result=None, worker=None, followups=None):
+        """
+        Mark a running task as done and queue its follow-up tasks
+
+        Returns False if the task was taken over by another worker than the
+        given one, then nothing is done.
+        """
+        task = self._finish(task_id, worker)
+        if task is None:
+            # it was queued again, the queued copy is done unless it runs
+            for path in glob.glob(self._path("pending", f"*-{task_id}.json")):
+                claimed = self._path("tmp", f"{task_id}.json.finished")
+                try:
+                    os.rename(path, claimed)
+                except FileNotFoundError:
+                    continue
+                task = _read_json(claimed)
+                os.remove(claimed)
+            if task is None:
+                return False
+        for followup in followups or []:
+            self.put(followup)
+        task["result"] = result
+        _write_json(self._path("done", f"{task_id}.json"), task,
+                    self._path("tmp"))
+        return True
+
+    def fail(self, task_id, error, worker=None):
+        """Queue a running task again, or mark it failed after its attempts"""
+        task = self._finish(task_id, worker)
+        if task is not None:
+            self._retry(task, error)
+
+    def counts(self):
+        """Number of tasks per state"""
+        return {i: sum(1 for j in os.listdir(self._path(i))
+                       if j.endswith(".json")) for i in STATES}
+
+    def tasks(self, state):
+        """The tasks in a state"""
+        tasks = []
+        for name in sorted(os.listdir(self._path(state))):
+            try:
+                tasks.append(_read_json(self._path(state, name)))
+            except FileNotFoundError:
+                continue
+        return tasks
+
+
+class MemoryQueue(object):
+    """
+    Work queue in the memory of one process, usually served by QueueBroker
+
+    Parameters
+    ----------
+    lease : float, optional
+        seconds after the last heartbeat after which a running task is
+        taken over by another worker
+    """
+    def __init__(self, lease=300.):
+        self.lease = lease
+        self._tasks = {i: {} for i in STATES}
+        self._heartbeats = {}
+        self._ids = set()
+        self._lock = threading.Lock()
+
+    def put(self, task):
+        """Queue a task, return its id. A task with a used id is ignored."""
+        with self._lock:
+            if task["id"] in self._ids:
+                return task["id"]
+            self._ids.add(task["id"])
+            return self._put(task)
+
+    def _put(self, task):
+        task = dict(task, created=time.time_ns(), worker=None)
+        self._tasks["pending"][task["id"]] = task
+        return task["id"]
+
+    def claim(self, worker, kinds=None):
+        """Take the next pending task, None if there is none"""
+        with self._lock:
+            self._requeue_expired()
+            pending = [i for i in self._tasks["pending"].values()
+                       if kinds is None or i["kind"] in kinds]
+            if not pending:
+                return None
+            task = min(pending, key=lambda i: (PRIORITY.get(i["kind"], 9),
+                                               i["created"]))
+            del self._tasks["pending"][task["id"]]
+            task["worker"] = worker
+            self._tasks["running"][task["id"]] = task
+            self._heartbeats[task["id"]] = time.time()
+            return dict(task)
+
+    def _requeue_expired(self):
+        deadline = time.time() - self.lease
+        for task_id, beat in list(self._heartbeats.items()):
+            if beat < deadline:
+                task = self._finish(task_id)
+                logger.warning(f"The lease of task {task_id} on "
+                               f"{task['worker']} expired")
+                self._retry(task, f"lease of {task['worker']} expired")
+
+    def heartbeat(self, task_id, worker):
+        """Renew the lease, False if the task was taken over"""
+        with self._lock:
+            task = self._tasks["running"].get(task_id)
+            if task is None or task["worker"] != worker:
+                return False
+            self._heartbeats[task_id] = time.time()
+            return True
+
+    def _finish(self, task_id, worker=None):
+        task = self._tasks["running"].get(task_id)
+        if task is None or worker is not None and task["worker"] != worker:
+            return None
+        self._heartbeats.pop(task_id, None)
+        return self._tasks["running"].pop(task_id)
+
+    def _retry(self, task, error):
+        task["attempts"] += 1
+        task["error"] = error
+        if task["attempts"] < task["max_attempts"]:
+            self._put(task)
+        else:
+            self._tasks["failed"][task["id"]] = task
+
+    def complete(self, task_id, result=None, worker=None, followups=None):
+        """
+        Mark a running task as done and queue its follow-up tasks
+
+        Returns False if the task was taken over by another worker than the
+        given one, then nothing is done.
+        """
+        with self._lock:
+            task = self._finish(task_id, worker)
+            if task is None:
+                logger.warning(f"Task {task_id} was taken over by another "
+                               "worker")
+                # the queued copy is done unless it runs
+                task = self._tasks["pending"].pop(task_id, None)
+                if task is None:
+                    return False
+            for followup in followups or []:
+                if followup["id"] not in self._ids:
+                    self._ids.add(followup["id"])
+                    self._put(followup)
+            task["result"] = result
+            self._tasks["done"][task_id] = task
+            return True
+
+    def fail(self, task_id, error, worker=None):
+        """Queue a running task again, or mark it failed after its attempts"""
+        with self._lock:
+            task = self._finish(task_id, worker)
+            if task is not None:
+                self._retry(task, error)
+
+    def counts(self):
+        """Number of tasks per state"""
+        with self._lock:
+            return {k: len(v) for k, v in self._tasks.items()}
+
+    def tasks(self, state):
+        """The tasks in a state"""
+        with self._lock:
+            return [dict(i) for i in self._tasks[state].values()]
+
+
+# methods of a queue that can be called over TCP
+OPERATIONS = ("put", "claim", "heartbeat", "complete", "fail", "counts",
+              "tasks")
+
+
+class _BrokerHandler(socketserver.StreamRequestHandler):
+    """One json request per line, answered with one json line"""
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                if request["op"] not in OPERATIONS:
+                    raise ValueError(f"Unknown operation {request['op']}")
+                method = getattr(self.server.queue, request["op"])
+                response = {"ok": True,
+                            "value": method(*request.get("args", []))}
+            except Exception as e:
+                response = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+            self.wfile.write((json.dumps(response) + "\n").encode())
+            self.wfile.flush()
+
+
+class _BrokerServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class QueueBroker(object):
+    """
+    Serve a queue to workers on other hosts over TCP
+
+    Parameters
+    ----------
+    queue : queue object, optional
+        the queue that is served, by default a MemoryQueue. A FileQueue
+        keeps the tasks if the broker is restarted.
+    host : str, optional
+        address to listen on, "0.0.0.0" for all interfaces
+    port : int, optional
+        port to listen on, 0 for any free port
+
+    >>> broker = QueueBroker(port=5555)
+    >>> broker.serve_forever()
+    """
+    def __init__(self, queue=None, host="127.0.0.1", port=0):
+        self.queue = MemoryQueue() if queue is None else queue
+        self._server = _BrokerServer((host, port), _BrokerHandler)
+        self._server.queue = self.queue
+        self._thread = None
+
+    @property
+    def address(self):
+        """(host, port) the broker listens on"""
+        return self._server.server_address[:2]
+
+    def serve_forever(self):
+        """Serve requests until shutdown is called"""
+        self._server.serve_forever()
+
+    def start(self):
+        """Serve requests in a background thread"""
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def shutdown(self):
+        """Stop serving and close the socket"""
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+
+class TcpQueue(object):
+    """
+    Client of a QueueBroker with the interface of a queue
+
+    Every request opens a new connection, so workers survive a restart of
+    the broker.
+
+    Parameters
+    ----------
+    host : str
+        host of the broker
+    port : int
+        port of the broker
+    timeout : float, optional
+        seconds to wait for a response
+    """
+    def __init__(self, host, port, timeout=30.):
+        self.address = (host, int(port))
+        self.timeout = timeout
+
+    def _request(self, op, *args):
+        with socket.create_connection(self.address,
+                                      timeout=self.timeout) as sock:
+            sock.sendall((json.dumps({"op": op, "args": args}) +
+                          "\n").encode())
+            with sock.makefile("rb") as f:
+                response = json.loads(f.readline())
+        if not response["ok"]:
+            raise RuntimeError(f"The broker failed on {op}: "
+                               f"{response['error']}")
+        return response["value"]
+
+    def put(self, task):
+        return self._request("put", task)
+
+    def claim(self, worker, kinds=None):
+        return self._request("claim", worker, kinds)
+
+    def heartbeat(self, task_id, worker):
+        return self._request("heartbeat", task_id, worker)
+
+    def complete(self, task_id, result=None, worker=None, followups=None):
+        return self._request("complete", task_id, result, worker, followups)
+
+    def fail(self, task_id, error, worker=None):
+        return self._request("fail", task_id, error, worker)
+
+    def counts(self):
+        return self._request("counts")
+
+    def tasks(self, state):
+        return self._request("tasks", state)
+
+
+def open_queue(spec, lease=300.):
+    """
+    A queue from a string, tcp://host:port for a broker or a folder
+
+    Parameters
+    ----------
+    spec : str
+        tcp://host:port of a QueueBroker or the folder of a FileQueue
+    lease : float, optional
+        lease of a FileQueue, see FileQueue
+    """
+    if spec.startswith("tcp://"):
+        host, port = spec[len("tcp://"):].rsplit(":", 1)
+        return TcpQueue(host, int(port))
+    return FileQueue(spec, lease=lease)
+
+
+def extract_task(args):
+    """Extract an emd file, queue a registration per dataset"""
+    from .io_tools import extract_emd
+    output_folder = args["output_folder"]
+    if not os.path.isdir(output_folder):
+        os.makedirs(output_folder, exist_ok=True)
+    paths = extract_emd(args["path"], output_folder=output_folder,
+                        **args.get("options", {}))
+    entry = _index_entry(paths)
+    followups = [("register", {
+        **dataset, "options": args.get("register_options", {}),
+        "apply_options": args.get("apply_options", {})})
+        for dataset in entry["datasets"]]
+    return entry, followups
+
+
+def _apply_followup(args, result_folder):
+    """The correction task of a registered dataset"""
+    apply_options = dict(args.get("apply_options", {}))
+    spectra = args.get("spectrum_folder")
+    if not apply_options.pop("spectra", True):
+        spectra = None
+    return ("apply", {"result_folder": result_folder,
+                      "image_folder": args["image_folder"],
+                      "spectrum_folder": spectra,
+                      "options": apply_options})
+
+
+def _split_task(args, chunk_size, options):
+    """Split a series in chunks, queue a registration per chunk"""
+    from .subseries import split_series
+    overlap = options.pop("overlap", 8)
+    layout_file = split_series(args["config_file"], chunk_size, overlap)
+    with open(layout_file) as f:
+        chunks = json.load(f)["chunks"]
+    # marks the chunks of this split, not those of earlier ones
+    series = uuid.uuid4().hex
+    followups = [("register", {
+        **args, "config_file": i["config"], "tiling_file": None,
+        "options": options, "layout_file": layout_file, "series": series})
+        for i in chunks]
+    return layout_file, followups
+
+
+def _chunk_marker(savedir):
+    return str(Path(f"{savedir}/{CHUNK_MARKER}"))
+
+
+def _registered(savedir, series):
+    try:
+        with open(_chunk_marker(savedir)) as f:
+            return f.read() == series
+    except FileNotFoundError:
+        return False
+
+
+def register_task(args):
+    """
+    Register a dataset, queue the correction of its frames
+
+    With a chunk_size in the options the series is split in sub-series
+    that are registered as separate tasks. Every chunk marks its result
+    folder when it is registered, and the chunks that find all chunks
+    marked queue the merge. The merge task has an id derived from the
+    split, so it is only queued once.
+    """
+    options = dict(args.get("options", {}))
+    backend = options.pop("backend", "matchseries")
+    chunk_size = options.pop("chunk_size", None)
+    if args.get("tiling_file"):
+        from .tiling import run_tiled_registration
+        result_folder = run_tiled_registration(args["tiling_file"],
+                                               workers=1)
+    elif chunk_size is not None:
+        return _split_task(args, chunk_size,
+                           dict(options, backend=backend))
+    elif backend == "numpy":
+        from .registration import register_config
+        result_folder = register_config(args["config_file"], **options)
+    else:
+        from .processing import calculate_non_rigid_registration
+        result_folder = calculate_non_rigid_registration(args["config_file"])
+    series = args.get("series")
+    if series is None:
+        return result_folder, [_apply_followup(args, result_folder)]
+    # a chunk of a sub-series
+    with open(args["layout_file"]) as f:
+        chunks = json.load(f)["chunks"]
+    savedir = [i["savedir"] for i in chunks
+               if i["config"] == args["config_file"]][0]
+    with open(_chunk_marker(savedir), "w") as f:
+        f.write(series)
+    if not all(_registered(i["savedir"], series) for i in chunks):
+        return result_folder, []
+    merge = {k: v for k, v in args.items()
+             if k not in ("config_file", "options", "series")}
+    return result_folder, [("merge", merge, f"merge-{series}")]
+
+
+def merge_task(args):
+    """Merge the registered chunks of a sub-series, queue the correction"""
+    from .subseries import merge_subseries
+    result_folder = merge_subseries(args["layout_file"])
+    return result_folder, [_apply_followup(args, result_folder)]
+
+
+def apply_task(args):
+    """Apply the deformations of a dataset to its images and spectra"""
+    from .processing import apply_deformations
+    apply_deformations(args["result_folder"], args["image_folder"],
+                       args.get("spectrum_folder"),
+                       **args.get("options", {}))
+    return args["result_folder"], []
+
+
+HANDLERS = {"extract": extract_task, "register": register_task,
+            "merge": merge_task, "apply": apply_task}
+
+
+def submit_files(queue, inputs, output_folder, pattern="*.emd",
+                 extract_options=None, register_options=None,
+                 apply_options=None, max_attempts=3):
+    """
+    Queue the extraction of emd files, the later stages follow
+
+    Parameters
+    ----------
+    queue : queue object
+        FileQueue, TcpQueue or MemoryQueue
+    inputs : str or list of str
+        directories, glob patterns or file paths, see batch.find_emd_files
+    output_folder : str
+        results of name.emd are written to output_folder/name, on storage
+        shared by all workers
+    pattern : str, optional
+        pattern of the files in a directory
+    extract_options : dict, optional
+        keyword arguments of io_tools.extract_emd, json serializable
+    register_options : dict, optional
+        "backend" ("matchseries" or "numpy"), "chunk_size" and "overlap"
+        to register in sub-series, and arguments of the backend
+    apply_options : dict, optional
+        keyword arguments of processing.apply_deformations, and "spectra":
+        False to not correct the spectra
+    max_attempts : int, optional
+        number of times a task is tried before it is marked failed
+
+    Returns
+    -------
+    task_ids : list of str
+        ids of the extraction tasks
+    """
+    output_folder = os.path.abspath(output_folder)
+    paths = find_emd_files(inputs, pattern)
+    folders = _output_folders(paths, output_folder)
+    task_ids = []
+    for path in paths:
+        task = new_task("extract", {
+            "path": path, "output_folder": folders[path],
+            "options": extract_options or {},
+            "register_options": register_options or {},
+            "apply_options": apply_options or {}}, max_attempts)
+        task_ids.append(queue.put(task))
+    logger.info(f"Queued the extraction of {len(paths)} files")
+    return task_ids
+
+
+def _run_task(handler, args):
+    return handler(args)
+
+
+class QueueWorker(object):
+    """
+    Run the tasks of a queue until it is empty or stop is called
+
+    Parameters
+    ----------
+    queue : queue object
+        FileQueue, TcpQueue or MemoryQueue
+    slots : int, optional
+        number of tasks run at the same time
+    kinds : list of str, optional
+        only claim tasks of these kinds, e.g. ["register"] on hosts with
+        match-series. By default all kinds.
+    handlers : dict, optional
+        replacement functions for the task kinds with the signature of
+        extract_task, returning the result and the follow-up tasks as
+        (kind, args) or (kind, args, task_id) tuples
+    name : str, optional
+        unique name of the worker, by default host name, process id and a
+        random suffix
+    poll_interval : float, optional
+        seconds between checks of the queue when all slots are busy or the
+        queue is empty
+    heartbeat_interval : float, optional
+        seconds between heartbeats of the running tasks, should be well
+        below the lease of the queue
+    use_processes : bool, optional
+        run the tasks in worker processes instead of threads. The handlers
+        must then be picklable.
+    """
+    def __init__(self, queue, slots=1, kinds=None, handlers=None, name=None,
+                 poll_interval=1., heartbeat_interval=30.,
+                 use_processes=True):
+        self.queue = queue
+        self.slots = slots
+        self.kinds = kinds
+        self.handlers = dict(HANDLERS)
+        self.handlers.update(handlers or {})
+        if name is None:
+            # tasks are owned by name, every worker needs its own
+            name = (f"{socket.gethostname()}-{os.getpid()}-"
+                    f"{uuid.uuid4().hex[:6]}")
+        self.name = name
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.use_processes = use_processes
+        self.finished = 0
+        self._stop = False
+        self._broken = False
+        self._last_beat = 0.
+
+    def _collect(self, future, task):
+        if task.get("lost"):
+            logger.warning(f"Ignored the result of the {task['kind']} task "
+                           f"{task['id']}, it was taken over")
+            return
+        try:
+            result, followups = future.result()
+        except BrokenProcessPool:
+            # the process of this or another task of the pool died
+            self._broken = True
+            logger.error(f"The process of the {task['kind']} task "
+                         f"{task['id']} died")
+            self.queue.fail(task["id"], "the worker process died", self.name)
+            return
+        except Exception as e:
+            logger.error(f"The {task['kind']} task {task['id']} failed: {e}")
+            self.queue.fail(task["id"], f"{type(e).__name__}: {e}",
+                            self.name)
+            return
+        # a run of the task that is repeated queues the same follow-ups
+        tasks = [new_task(kind, args, task["max_attempts"],
+                          *(task_id or [f"{task['id']}-{n}"]))
+                 for n, (kind, args, *task_id) in enumerate(followups)]
+        if not self.queue.complete(task["id"], result, self.name, tasks):
+            logger.warning(f"Dropped the result of the {task['kind']} task "
+                           f"{task['id']}, it was taken over")
+            return
+        self.finished += 1
+        logger.info(f"Finished the {task['kind']} task {task['id']}")
+
+    def _idle(self):
+        counts = self.queue.counts()
+        return not counts["pending"] and not counts["running"]
+
+    def _new_pool(self):
+        self._broken = False
+        if self.use_processes:
+            return cf.ProcessPoolExecutor(max_workers=self.slots,
+                                          mp_context=process_context())
+        return cf.ThreadPoolExecutor(max_workers=self.slots)
+
+    def run(self, until_idle=False, timeout=None):
+        """
+        Claim and run tasks until stop is called
+
+        If the process of a task dies, e.g. killed for lack of memory, the
+        tasks of the process pool fail and the pool is started again.
+
+        Parameters
+        ----------
+        until_idle : bool, optional
+            stop when no task is pending or running on any worker
+        timeout : float, optional
+            stop claiming tasks after this many seconds, running tasks are
+            finished
+        """
+        self._stop = False
+        pool = self._new_pool()
+        running = {}
+        start = time.time()
+        self._last_beat = start
+        try:
+            while not self._stop:
+                if timeout is not None and time.time() - start > timeout:
+                    break
+                while len(running) < self.slots and not self._broken:
+                    task = self.queue.claim(self.name, self.kinds)
+                    if task is None:
+                        break
+                    logger.info(f"Started the {task['kind']} task "
+                                f"{task['id']}")
+                    try:
+                        future = pool.submit(_run_task,
+                                             self.handlers[task["kind"]],
+                                             task["args"])
+                    except BrokenProcessPool:
+                        self._broken = True
+                        self.queue.fail(task["id"], "the worker process died",
+                                        self.name)
+                        break
+                    running[future] = task
+                if until_idle and not running and not self._broken and \
+                        self._idle():
+                    break
+                self._wait(running)
+                if self._broken and not running:
+                    # the tasks of the broken pool are all collected
+                    logger.warning("Starting new worker processes")
+                    pool.shutdown(wait=False)
+                    pool = self._new_pool()
+            # the running tasks are finished before returning
+            while running:
+                self._wait(running)
+        finally:
+            pool.shutdown(wait=True)
+
+    def _wait(self, running):
+        """Wait a poll interval, collect finished tasks and send heartbeats"""
+        if running:
+            cf.wait(running, timeout=self.poll_interval,
+                    return_when=cf.FIRST_COMPLETED)
+        else:
+            time.sleep(self.poll_interval)
+        for future in [i for i in running if i.done()]:
+            self._collect(future, running.pop(future))
+        if time.time() - self._last_beat > self.heartbeat_interval:
+            for task in running.values():
+                if task.get("lost") or \
+                        self.queue.heartbeat(task["id"], self.name):
+                    continue
+                # the result of the task will be ignored
+                logger.warning(f"The {task['kind']} task {task['id']} was "
+                               "taken over by another worker")
+                task["lost"] = True
+            self._last_beat = time.time()
+
+    def stop(self):
+        """Stop claiming tasks, the running tasks are finished"""
+        self._stop = True
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+from scipy import sparse
+from jnrr.accumulate import (CountAccumulator, smallest_dtype,
+                             total_spectrum)
+
+
+def _frame(rng, shape, as_sparse, peak):
+    dense = rng.poisson(0.5, shape)*(rng.random(shape) < 0.3)
+    dense[tuple(rng.integers(0, i) for i in shape)] = peak
+    return sparse.csr_matrix(dense) if as_sparse else dense
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_sum_matches_int64(seed):
+    rng = np.random.default_rng(seed)
+    shape = (7, 9)
+    first_sparse = bool(seed % 2)
+    # too few expected frames, so that the sum has to be promoted
+    total = CountAccumulator(frames=2)
+    expected = np.zeros(shape, dtype=np.int64)
+    for n in range(12):
+        as_sparse = first_sparse if n == 0 else bool(rng.integers(2))
+        peak = int(rng.choice([3, 200, 5000, 70000]))
+        frame = _frame(rng, shape, as_sparse, peak)
+        total.add(frame)
+        expected += frame.toarray() if as_sparse else frame
+        result = total.result()
+        # the sum stays sparse if the first frame was
+        assert sparse.issparse(result) == first_sparse
+        assert type(result) is (sparse.csr_matrix if first_sparse
+                                else np.ndarray)
+        dense = result.toarray() if first_sparse else result
+        np.testing.assert_array_equal(dense, expected)
+        assert result.dtype.kind == "u"
+        assert np.iinfo(result.dtype).max >= expected.max()
+    assert total.frames == 12
+
+
+def test_accumulator_checks_counts():
+    assert smallest_dtype(255) == np.uint8
+    assert smallest_dtype(256) == np.uint16
+    total = CountAccumulator()
+    with pytest.raises(ValueError):
+        total.add(np.array([-1, -2]))
+    with pytest.raises(ValueError):
+        total.add(np.array([1.5]))
+    assert total.result() is None
+
+
+def test_total_spectrum(tmp_path):
+    rng = np.random.default_rng(0)
+    frames = [_frame(rng, (6, 4), True, 10) for _ in range(3)]
+    for i, frame in enumerate(frames):
+        sparse.save_npz(str(tmp_path / f"frame_{i}.npz"), frame)
+    total = total_spectrum(str(tmp_path))
+    np.testing.assert_array_equal(total.toarray(),
+                                  sum(i.toarray() for i in frames))
+    total = total_spectrum(str(tmp_path), frames=[0, 2])
+    np.testing.assert_array_equal(total.toarray(),
+                                  frames[0].toarray() + frames[2].toarray())
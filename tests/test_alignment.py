@@ -0,0 +1,46 @@
+import numpy as np
+from scipy import ndimage
+from jnrr.alignment import (estimate_shifts, apply_shifts, common_region,
+                            compose_shift, write_shifts, read_shifts)
+from jnrr.kernels import warp_image
+
+SHIFTS = np.array([[0, 0], [3, -2], [-4, 5], [1, 6]])
+
+
+def _stack(shape=(48, 40)):
+    """Smooth random reference, frame(y, x) = ref(y - dy, x - dx)"""
+    rng = np.random.default_rng(0)
+    ref = ndimage.gaussian_filter(rng.random(shape), 2.)
+    # periodic, as seen by the cross-correlation
+    frames = [np.roll(ref, shift, axis=(0, 1)) for shift in SHIFTS]
+    return ref, np.array(frames)
+
+
+def test_shifts_are_estimated_and_undone():
+    ref, stack = _stack()
+    shifts = estimate_shifts(stack, chunk=3)
+    np.testing.assert_array_equal(shifts, SHIFTS)
+    region = common_region(shifts, ref.shape)
+    assert region == (slice(4, 45), slice(2, 34))
+    aligned = apply_shifts(stack, shifts)
+    for frame in aligned:
+        np.testing.assert_array_equal(frame[region], ref[region])
+
+
+def test_composed_shift_warps_the_original_frames(tmp_path):
+    ref, stack = _stack()
+    write_shifts(str(tmp_path), SHIFTS)
+    shifts = read_shifts(str(tmp_path))
+    assert read_shifts(str(tmp_path / "missing")) is None
+    aligned = apply_shifts(stack, shifts)
+    region = common_region(shifts, ref.shape)
+    rng = np.random.default_rng(1)
+    scale = max(ref.shape) - 1
+    for frame, frame_aligned, shift in zip(stack, aligned, shifts):
+        # an integer deformation on the aligned frame
+        defX = rng.integers(-1, 2, ref.shape)/scale
+        defY = rng.integers(-1, 2, ref.shape)/scale
+        expected = warp_image(frame_aligned, defX, defY)
+        composed = warp_image(frame, *compose_shift(defX, defY, shift))
+        inner = tuple(slice(i.start + 1, i.stop - 1) for i in region)
+        np.testing.assert_array_equal(composed[inner], expected[inner])
@@ -0,0 +1,14 @@
+from jnrr import benchmark
+
+
+def test_light_modules_do_not_import_heavy_dependencies():
+    # generous time budget, the heavy imports are what makes them slow
+    results, problems = benchmark.check_import_times(budget=5., repeat=1)
+    assert sorted(results) == sorted(benchmark.LIGHT_MODULES)
+    assert problems == []
+    assert all(heavy == [] for _, heavy in results.values())
+
+
+def test_import_time_reports_heavy_dependencies():
+    _, heavy = benchmark.import_time("scipy.ndimage", repeat=1)
+    assert heavy == ["scipy"]
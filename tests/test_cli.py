@@ -0,0 +1,121 @@
+import json
+import shutil
+from pathlib import Path
+import numpy as np
+import pytest
+from PIL import Image
+from jnrr import cli
+from jnrr.io_tools import write_config_file
+
+LOG = Path(__file__).parent / "data" / "matchseries.log"
+
+COMMANDS = [
+    (["extract", "a.emd", "-o", "out", "--prealign", "--image-dataset", "1"],
+     {"func": cli.extract_command, "input": "a.emd", "output": "out",
+      "prealign": True, "image_dataset": [1]}),
+    (["batch", "in", "b.emd", "-o", "out", "--overwrite"],
+     {"func": cli.batch_command, "input": ["in", "b.emd"],
+      "overwrite": True, "pattern": "*.emd"}),
+    (["register", "a.par", "b.par", "--backend", "numpy",
+      "--chunk-size", "20"],
+     {"func": cli.register_command, "config": ["a.par", "b.par"],
+      "backend": "numpy", "chunk_size": 20, "overlap": 8}),
+    (["apply", "r0", "r1", "--energy-window", "1", "2",
+      "--energy-window", "6.2", "6.6", "--output-format", "hdf5"],
+     {"func": cli.apply_command, "result_folder": ["r0", "r1"],
+      "energy_window": [[1., 2.], [6.2, 6.6]], "output_format": "hdf5"}),
+    (["plan", "r0", "--memory-limit", "2GB", "--workers", "3"],
+     {"func": cli.plan_command, "memory_limit": "2GB", "workers": 3}),
+    (["tune", "a.par", "--apply", "b.par", "c.par", "--force"],
+     {"func": cli.tune_command, "apply": ["b.par", "c.par"],
+      "force": True, "tolerance": 1e-3}),
+    (["run", "a.emd", "--no-spectra", "--skip-bad-frames"],
+     {"func": cli.run_command, "no_spectra": True,
+      "skip_bad_frames": True}),
+    (["stats", "frames", "--statistics", "mean", "median"],
+     {"func": cli.stats_command, "statistics": ["mean", "median"]}),
+    (["watch", "in", "--settle-time", "2"],
+     {"func": cli.watch_command, "settle_time": 2.}),
+    (["submit", "in", "-o", "out", "--queue", "q", "--max-attempts", "5"],
+     {"func": cli.submit_command, "queue": "q", "max_attempts": 5,
+      "backend": "matchseries"}),
+    (["worker", "q", "--slots", "2", "--kinds", "apply", "--until-idle"],
+     {"func": cli.worker_command, "slots": 2, "kinds": ["apply"],
+      "until_idle": True}),
+    (["broker", "--port", "6000", "--queue-folder", "q"],
+     {"func": cli.broker_command, "port": 6000, "queue_folder": "q"}),
+]
+
+
+@pytest.mark.parametrize("argv, expected", COMMANDS,
+                         ids=[i[0][0] for i in COMMANDS])
+def test_parse_commands(argv, expected):
+    args = cli.get_parser().parse_args(argv)
+    assert args.command == argv[0]
+    for key, value in expected.items():
+        assert getattr(args, key) == value
+
+
+def test_every_command_is_covered():
+    parser = cli.get_parser()
+    commands = parser._subparsers._group_actions[0].choices
+    assert sorted(commands) == sorted(i[0][0] for i in COMMANDS)
+
+
+def test_invalid_arguments_are_rejected(capsys):
+    parser = cli.get_parser()
+    for argv in ([], ["register", "a.par", "--backend", "other"],
+                 ["apply"], ["submit", "in", "-o", "out"]):
+        with pytest.raises(SystemExit):
+            parser.parse_args(argv)
+    with pytest.raises(ValueError):
+        cli.main(["apply", "r0", "--spectra", "s", "--spectra-emd", "a.emd"])
+
+
+def _frames(folder, n=5, shape=(12, 10)):
+    folder.mkdir(parents=True)
+    for i in range(n):
+        Image.fromarray(np.full(shape, 10*i, dtype=np.uint16)).save(
+            str(folder / f"frame_{i:02d}.tiff"))
+
+
+def test_plan(tmp_path, capsys):
+    _frames(tmp_path / "images")
+    result = tmp_path / "result"
+    result.mkdir()
+    write_config_file(str(result / "parameter-dump.txt"),
+                      pathpattern=str(tmp_path / "images/frame_%02d.tiff"),
+                      savedir=str(result), num_frames=5)
+    assert cli.main(["plan", str(result), "--memory-limit", "1GB",
+                     "--workers", "2"]) == 0
+    report = json.loads(capsys.readouterr().out)
+    assert report["concurrent"] == 1
+    plan = report["plans"][str(result)]
+    assert plan["fits"] and plan["spectra"] is None
+
+
+def test_stats(tmp_path, capsys):
+    _frames(tmp_path / "frames")
+    output = tmp_path / "stats"
+    assert cli.main(["stats", str(tmp_path / "frames"), "-o", str(output),
+                     "--statistics", "mean", "median", "--prefix",
+                     "s_"]) == 0
+    paths = json.loads(capsys.readouterr().out)
+    assert sorted(paths) == ["mean", "median"]
+    with Image.open(paths["mean"]) as img:
+        np.testing.assert_allclose(np.asarray(img), 20.)
+    assert Path(paths["median"]).name == "s_median.tiff"
+
+
+def test_tune(tmp_path, capsys):
+    config = str(tmp_path / "matchSeries_000.par")
+    write_config_file(config, pathpattern="images/frame_%02d.tiff",
+                      savedir=str(tmp_path / "missing"), preclevel=6,
+                      num_frames=2, numstag=1, gditer=3)
+    shutil.copyfile(LOG, str(tmp_path / "matchSeries_000.log"))
+    other = str(tmp_path / "matchSeries_001.par")
+    shutil.copyfile(config, other)
+    assert cli.main(["tune", config, "--apply", other]) == 0
+    report = json.loads(capsys.readouterr().out)
+    assert report["recommendation"]["verified"]
+    assert "maxGDIterations 3\n" in Path(other).read_text()
@@ -0,0 +1,52 @@
+import shutil
+from pathlib import Path
+import pytest
+from jnrr import convergence
+from jnrr.io_tools import write_config_file
+
+LOG = Path(__file__).parent / "data" / "matchseries.log"
+
+
+def _config(tmp_path, log):
+    config = str(tmp_path / "matchSeries_000.par")
+    write_config_file(config, pathpattern="images/frame_%02d.tiff",
+                      savedir=str(tmp_path / "missing"), preclevel=6,
+                      num_frames=2, numstag=1, gditer=3)
+    shutil.copyfile(log, str(tmp_path / "matchSeries_000.log"))
+    return config
+
+
+def test_parse_log():
+    runs = convergence.parse_log(str(LOG))
+    assert [(i["stage"], i["frame"], i["level"]) for i in runs] == [
+        (1, 0, 5), (1, 0, 6), (1, 1, 5), (1, 1, 6), (2, 0, 6)]
+    assert runs[0]["energies"] == [12.5, 9., 8.1, 8.05]
+    assert runs[-1]["energies"] == [14., 13.9]
+
+
+def test_apply_verified_recommendation(tmp_path):
+    config = _config(tmp_path, LOG)
+    report = convergence.analyze(config)
+    assert report["problems"] == []
+    assert report["recommendation"]["verified"]
+    assert report["recommendation"]["capped"] == 1
+    output = str(tmp_path / "next.par")
+    convergence.apply_recommendation(config, report["recommendation"],
+                                     output_file=output)
+    text = Path(output).read_text()
+    assert "maxGDIterations 3\n" in text
+
+
+def test_unrecognized_log_is_not_applied(tmp_path):
+    log = tmp_path / "other.log"
+    # iterations are found, but no stages and levels
+    log.write_text("".join(f"Iteration {i}: energy = {10 - i}\n"
+                           for i in range(5)))
+    config = _config(tmp_path, log)
+    report = convergence.analyze(config)
+    assert report["problems"]
+    assert not report["recommendation"]["verified"]
+    with pytest.raises(ValueError):
+        convergence.apply_recommendation(config, report["recommendation"])
+    convergence.apply_recommendation(config, report["recommendation"],
+                                     force=True)
@@ -0,0 +1,97 @@
+import json
+import numpy as np
+import pytest
+from jnrr import kernels
+from jnrr.eventstream import stream_events, PIXEL_MARKER
+from jnrr.processing import _get_warp_plan
+
+
+def _stream(frames, rng):
+    """Raw Velox stream of (frames, pixels) event lists and its flut"""
+    values = []
+    flut = []
+    for frame in frames:
+        flut.append(len(values))
+        for channels in frame:
+            values += list(channels) + [PIXEL_MARKER]
+    return np.array(values, dtype=np.uint16), np.array(flut)
+
+
+def _frames(rng, n, pixels, channels):
+    return [[rng.integers(0, channels, rng.integers(0, 4))
+             for _ in range(pixels)] for _ in range(n)]
+
+
+def test_stream_events():
+    rng = np.random.default_rng(0)
+    frames = _frames(rng, 1, 12, 8)
+    stream, _ = _stream(frames, rng)
+    pixel, channel = stream_events(stream, 12, 8)
+    expected = [(p, c) for p, cs in enumerate(frames[0]) for c in cs]
+    assert list(zip(pixel.tolist(), channel.tolist())) == expected
+    # events beyond the frame or the channels are dropped
+    pixel, channel = stream_events(stream, 6, 4)
+    assert (pixel < 6).all() and (channel < 4).all()
+
+
+def test_temmeta_frame_access(tmp_path):
+    """Pin the private temmeta API that correct_emd_spectra relies on"""
+    dio = pytest.importorskip("temmeta.data_io")
+    h5py = pytest.importorskip("h5py")
+    rng = np.random.default_rng(1)
+    w, h, channels = 4, 3, 16
+    frames = _frames(rng, 3, w*h, channels)
+    stream, flut = _stream(frames, rng)
+    path = str(tmp_path / "stream.emd")
+    acq = {"bincount": str(channels),
+           "RasterScanDefinition": {"Width": str(w), "Height": str(h)}}
+    with h5py.File(path, "w") as f:
+        group = f.create_group("Data/SpectrumStream/abc")
+        group["Data"] = stream[:, None]
+        group["FrameLocationTable"] = flut[:, None]
+        group["AcquisitionSettings"] = np.array([json.dumps(acq).encode()])
+    with dio.EMDFile(path, "r") as f:
+        uuid = f._get_ds_uuid("SpectrumStream", 0)
+        assert uuid == "abc"
+        assert f._get_spectrum_stream_dim(uuid) == (w, h, channels, 3)
+        np.testing.assert_array_equal(f._get_spectrum_stream_flut(uuid),
+                                      flut)
+        raw = f.get_raw_data("SpectrumStream", uuid)
+        for i, frame in enumerate(frames):
+            ix1, ix2 = dio.EMDFile._get_frame_limits(i, flut)
+            pixel, channel = stream_events(np.asarray(raw[ix1:ix2]), w*h,
+                                           channels)
+            expected = [(p, c) for p, cs in enumerate(frame) for c in cs]
+            assert list(zip(pixel.tolist(), channel.tolist())) == expected
+
+
+def _dense(frame, h, w, channels):
+    """(channels, h, w) counts of the event lists of a frame"""
+    cube = np.zeros((channels, h*w), dtype=np.int64)
+    for pixel, events in enumerate(frame):
+        np.add.at(cube[:, pixel], events, 1)
+    return cube.reshape(channels, h, w)
+
+
+@pytest.mark.parametrize("numba", [True, False])
+def test_scattered_events_match_warped_channels(monkeypatch, numba):
+    if not numba:
+        monkeypatch.setattr(kernels, "HAS_NUMBA", False)
+    rng = np.random.default_rng(2)
+    h, w, channels = 7, 9, 5
+    scale = max(h, w) - 1
+    rows, cols = np.mgrid[0:h, 0:w]
+    out = np.zeros((h*w, channels), dtype=np.uint16)
+    expected = np.zeros((channels, h, w), dtype=np.int64)
+    for frame in _frames(rng, 3, h*w, channels):
+        stream, _ = _stream([frame], rng)
+        pixel, channel = stream_events(stream, h*w, channels)
+        # several pixels read the same source pixel, some none
+        defX = rng.uniform(-1.5, 1.5)*np.sin(rows/2.)/scale
+        defY = rng.uniform(-2.5, 2.5)*np.cos(cols/3.)/scale
+        plan = _get_warp_plan(kernels._get_coordinates(defX, defY))
+        kernels.scatter_events(pixel, channel,
+                               *kernels.inverse_warp_plan(plan), out)
+        expected += kernels.warp_channels(_dense(frame, h, w, channels),
+                                          defX, defY)
+    np.testing.assert_array_equal(out.T.reshape(channels, h, w), expected)
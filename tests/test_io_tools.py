@@ -0,0 +1,21 @@
+import pickle
+import numpy as np
+from jnrr.io_tools import FrameByFrame
+from jnrr.progress import ProgressTracker
+
+
+def _double(index, stack, out):
+    out[index] = 2*stack[index]
+
+
+def test_frame_by_frame_pickles_without_tracker():
+    stack = np.arange(12.).reshape(3, 2, 2)
+    reports = []
+    tracker = ProgressTracker("test", 3, reports.append)
+    func = FrameByFrame(_double, stack, np.zeros_like(stack),
+                        tracker=tracker)
+    copy = pickle.loads(pickle.dumps(func))
+    assert copy.tracker is None and func.tracker is tracker
+    for i in range(3):
+        copy(i)
+    np.testing.assert_array_equal(copy.args[0], 2*stack)
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+from jnrr import kernels
+
+FILL_VALUES = [8.5, 9.5, -0.5, -1.5, 2.5, 300.4, -3.7, 70000.2, 1e12, -1e12]
+DTYPES = [np.uint8, np.int16, np.uint16, np.int32, np.uint32, np.int64,
+          np.float32, np.float64]
+
+
+def _deformation(h, w):
+    """Shift by 2.4 pixels in x and -1.6 pixels in y, partly out of frame"""
+    scale = max(h, w) - 1
+    return np.full((h, w), 2.4/scale), np.full((h, w), -1.6/scale)
+
+
+@pytest.mark.parametrize("dtype", DTYPES)
+@pytest.mark.parametrize("cval", FILL_VALUES)
+def test_warp_image_fill_matches_map_coordinates(dtype, cval):
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 100, (12, 9)).astype(dtype)
+    defX, defY = _deformation(*image.shape)
+    expected = ndimage.map_coordinates(
+        image, kernels._get_coordinates(defX, defY), order=0,
+        mode="constant", cval=cval)
+    result = kernels.warp_image(image, defX, defY, cval=cval)
+    assert result.dtype == image.dtype
+    np.testing.assert_array_equal(result, expected)
+
+
+def test_warp_channels_matches_map_coordinates():
+    rng = np.random.default_rng(1)
+    cube = rng.integers(0, 5, (6, 10, 14)).astype(np.uint16)
+    h, w = cube.shape[1:]
+    scale = max(h, w) - 1
+    rows, cols = np.mgrid[0:h, 0:w]
+    defX = 1.7*np.sin(rows/3.)/scale
+    defY = -2.2*np.cos(cols/4.)/scale
+    coords = kernels._get_coordinates(defX, defY)
+    expected = np.array([ndimage.map_coordinates(i, coords, order=0,
+                                                 mode="constant")
+                         for i in cube])
+    for parallel in (False, True):
+        np.testing.assert_array_equal(
+            kernels.warp_channels(cube, defX, defY, parallel), expected)
+
+
+@pytest.mark.parametrize("amplitude", [0.2, 0.45, 0.55, 1.5])
+def test_identity_matches_map_coordinates(amplitude):
+    rng = np.random.default_rng(2)
+    h, w = 12, 9
+    scale = max(h, w) - 1
+    # every pixel has its own value, so any change is seen
+    image = np.arange(h*w, dtype=np.float64).reshape(h, w)
+    outcomes = set()
+    for n in range(20):
+        defX = rng.uniform(-amplitude, amplitude, (h, w))/scale
+        defY = rng.uniform(-amplitude, amplitude, (h, w))/scale
+        if n % 2:
+            # the border pixels point into the frame
+            defY[0], defY[-1] = abs(defY[0]), -abs(defY[-1])
+            defX[:, 0], defX[:, -1] = abs(defX[:, 0]), -abs(defX[:, -1])
+        warped = ndimage.map_coordinates(
+            image, kernels._get_coordinates(defX, defY), order=0,
+            mode="constant", cval=-1.)
+        stats = kernels.displacement_statistics(defX, defY)
+        assert stats["identity"] == np.array_equal(warped, image)
+        outcomes.add(stats["identity"])
+        lengths = np.hypot(defX, defY)*scale
+        assert np.isclose(stats["max_shift"], lengths.max())
+        assert np.isclose(stats["rms_shift"], np.sqrt((lengths**2).mean()))
+    if amplitude < 0.5:
+        # only the fields that move a border pixel out of the frame
+        assert outcomes == {False, True}
+
+
+def test_displacement_statistics_of_a_translation():
+    h, w = 8, 11
+    scale = max(h, w) - 1
+    stats = kernels.displacement_statistics(np.full((h, w), 3./scale),
+                                            np.full((h, w), -4./scale))
+    assert stats == {"max_shift": 5., "rms_shift": 5., "identity": False}
+    zero = np.zeros((h, w))
+    assert kernels.displacement_statistics(zero, zero)["identity"]
@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+from jnrr import kernels, lazy
+from jnrr.alignment import write_shifts
+from jnrr.io_tools import write_config_file, saveToQ2bz, _getNameCounterFrames
+
+da = pytest.importorskip("dask.array")
+
+SHAPE = (20, 24)
+
+
+def _result_folder(tmp_path, frames=4, shifts=None):
+    """Registration result with random fields, returns it and the fields"""
+    images = tmp_path / "images"
+    images.mkdir()
+    result = tmp_path / "result"
+    config = str(result / "parameter-dump.txt")
+    result.mkdir()
+    write_config_file(config, pathpattern=str(images / "frame_%02d.tiff"),
+                      savedir=str(result), num_frames=frames)
+    if shifts is not None:
+        write_shifts(str(images), shifts)
+    (_, _, _, _, _, bznumber, stage) = _getNameCounterFrames(config)
+    rng = np.random.default_rng(0)
+    fields = rng.integers(-2, 3, (frames, 2) + SHAPE)/(max(SHAPE) - 1)
+    for i in range(frames):
+        folder = result / f"stage{stage}" / (f"{i}" if i == 0 else f"{i}-r")
+        folder.mkdir(parents=True)
+        for j in range(2):
+            saveToQ2bz(str(folder / f"deformation_{bznumber}_{j}.dat.bz2"),
+                       fields[i, j])
+    return str(result), fields
+
+
+def test_deformation_fields_compose_the_rigid_shifts(tmp_path):
+    shifts = np.array([[0, 0], [2, -1], [-3, 4], [1, 1]])
+    result, fields = _result_folder(tmp_path, shifts=shifts)
+    frames, lazy_fields = lazy.deformation_fields(result)
+    assert frames == [0, 1, 2, 3]
+    scale = max(SHAPE) - 1
+    expected = fields + shifts[:, ::-1, None, None]/scale
+    np.testing.assert_allclose(lazy_fields.compute(), expected)
+    _, aligned = lazy.deformation_fields(result, rigid_shifts=False)
+    np.testing.assert_allclose(aligned.compute(), fields)
+
+
+def _fields(rng, frames):
+    return rng.integers(-2, 3, (frames, 2) + SHAPE)/(max(SHAPE) - 1)
+
+
+def test_warp_images_matches_the_kernel():
+    rng = np.random.default_rng(1)
+    stack = rng.integers(0, 1000, (3,) + SHAPE).astype(np.uint16)
+    fields = _fields(rng, 3)
+    corrected = lazy.warp_images(da.from_array(stack, chunks=(2, 10, 12)),
+                                 da.from_array(fields, chunks=1))
+    expected = [kernels.warp_image(frame, *field, cval=frame.mean())
+                for frame, field in zip(stack, fields)]
+    np.testing.assert_array_equal(corrected.compute(), expected)
+    fixed = lazy.warp_images(da.from_array(stack), da.from_array(fields),
+                             cval=7)
+    np.testing.assert_array_equal(
+        fixed.compute()[1], kernels.warp_image(stack[1], *fields[1], cval=7))
+
+
+def test_warp_spectra_and_spectrum_map_match_dense_sums():
+    rng = np.random.default_rng(2)
+    channels = 5
+    spectra = rng.poisson(0.3, (4, channels) + SHAPE).astype(np.uint8)
+    fields = _fields(rng, 4)
+    lazy_spectra = da.from_array(spectra, chunks=(1, 2) + SHAPE)
+    corrected = lazy.warp_spectra(lazy_spectra, da.from_array(fields))
+    expected = np.array([kernels.warp_channels(cube, *field)
+                         for cube, field in zip(spectra, fields)])
+    np.testing.assert_array_equal(corrected.compute(), expected)
+    undeformed = lazy.spectrum_map(lazy_spectra)
+    # 4 frames of uint8 counts need 10 bits
+    assert undeformed.dtype == np.uint16
+    np.testing.assert_array_equal(undeformed.compute(),
+                                  spectra.sum(axis=0, dtype=np.int64))
+    deformed = lazy.spectrum_map(corrected).compute()
+    np.testing.assert_array_equal(deformed,
+                                  expected.sum(axis=0, dtype=np.int64))
+    average = lazy.average(da.from_array(spectra[:, 0])).compute()
+    np.testing.assert_allclose(average, spectra[:, 0].mean(axis=0))
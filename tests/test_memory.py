@@ -0,0 +1,47 @@
+import numpy as np
+from PIL import Image
+from jnrr import cli, memory
+from jnrr.io_tools import write_config_file
+
+
+def _result_folder(root, name, shape=(64, 48), frames=4):
+    """A registered dataset with uint16 frames and its parameter-dump.txt"""
+    images = root / name / "images"
+    images.mkdir(parents=True)
+    for i in range(frames):
+        Image.fromarray(np.full(shape, i, dtype=np.uint16)).save(
+            str(images / f"frame_{i:02d}.tiff"))
+    result = root / name / "result"
+    result.mkdir()
+    write_config_file(str(result / "parameter-dump.txt"),
+                      pathpattern=str(images / "frame_%02d.tiff"),
+                      savedir=str(result), num_frames=frames)
+    return str(result)
+
+
+def test_plan_dataset_reads_the_header(tmp_path):
+    result = _result_folder(tmp_path, "a")
+    plan = memory.plan_dataset(result, memory_limit="1GB", workers=1)
+    expected = memory.plan_correction(64, 48, 4, image_dtype=np.uint16,
+                                      memory_limit="1GB", workers=1)
+    assert plan == expected
+
+
+def test_plan_apply_splits_the_memory_limit(tmp_path):
+    results = [_result_folder(tmp_path, i) for i in "abc"]
+    spectra = [None]*len(results)
+    estimates = memory.plan_dataset(results[0], memory_limit="1GB",
+                                    workers=1)["estimates"]
+    needed = estimates["images"] + estimates["image_frame"]
+    # the budget fits two datasets at the same time
+    limit = int(2.5*needed)
+    concurrent, worker_memory, plans = cli._plan_apply(results, spectra,
+                                                       limit, workers=8)
+    assert concurrent == 2
+    assert worker_memory == limit//2
+    assert sorted(plans) == sorted(results)
+    assert all(p["memory_limit"] == worker_memory and p["fits"]
+               for p in plans.values())
+    concurrent, worker_memory, _ = cli._plan_apply(results, spectra, None,
+                                                   workers=8)
+    assert (concurrent, worker_memory) == (min(3, 8), None)
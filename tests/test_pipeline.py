@@ -0,0 +1,31 @@
+import numpy as np
+from jnrr import cli
+from jnrr.pipeline import ExtractedDataset
+
+
+class Stack(object):
+    """The part of a temmeta image stack that is used"""
+    def __init__(self, data):
+        self.data = data
+
+    def select_frames(self, frames):
+        return Stack(self.data[frames])
+
+
+def _dataset(stack, frames=None):
+    return ExtractedDataset("data.emd", "uuid", "images_000",
+                            "matchSeries_000.par", "nonrigid_results_000",
+                            stack=stack, frames=frames)
+
+
+def test_only_the_exported_frames_are_kept():
+    data = np.arange(5*4*3).reshape(5, 4, 3)
+    dataset = _dataset(Stack(data), frames=[1, 3])
+    np.testing.assert_array_equal(dataset.stack.data, data[[1, 3]])
+    assert _dataset(Stack(data)).stack.data is data
+
+
+def test_keep_stacks_in_the_memory_limit():
+    datasets = [_dataset(Stack(np.zeros((10, 10, 10)))) for _ in range(3)]
+    cli._keep_stacks(datasets, 2*8000 + 100)
+    assert [i.stack is not None for i in datasets] == [True, True, False]
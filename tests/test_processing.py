@@ -0,0 +1,139 @@
+import json
+from types import SimpleNamespace
+import numpy as np
+import pytest
+from scipy import sparse
+from jnrr import kernels, processing
+from jnrr.accumulate import CountAccumulator
+from jnrr.io_tools import saveToQ2bz
+
+DIMENSIONS = (6, 8, 10)
+
+
+def _spectrum_frame(rng, dimensions=DIMENSIONS, density=0.05):
+    """Random (pixels, channels) CSR counts"""
+    channels, h, w = dimensions
+    counts = rng.poisson(2., (h*w, channels))*(
+        rng.random((h*w, channels)) < density)
+    return sparse.csr_matrix(counts.astype(np.uint16))
+
+
+def _dense(frame, dimensions=DIMENSIONS):
+    return frame.toarray().T.reshape(dimensions)
+
+
+def _fields(rng, shape=DIMENSIONS[1:]):
+    scale = max(shape) - 1
+    return (rng.integers(-2, 3, shape)/scale,
+            rng.integers(-2, 3, shape)/scale)
+
+
+def test_spilled_sum_matches_dense_warp(tmp_path):
+    rng = np.random.default_rng(0)
+    # a few hundred bytes, the sum is spilled after every frame in tiles
+    total = processing.SpillingSpectrumSum(str(tmp_path / "sum.dat"),
+                                           DIMENSIONS, memory_limit=400)
+    expected = np.zeros(DIMENSIONS, dtype=np.int64)
+    for _ in range(5):
+        frame = _spectrum_frame(rng)
+        defX, defY = _fields(rng)
+        plan = processing._get_warp_plan(kernels._get_coordinates(defX,
+                                                                  defY))
+        total.add(processing._warp_sparse_frame(frame, plan))
+        assert total._sparse.frames == 0
+        expected += kernels.warp_channels(_dense(frame), defX, defY)
+    result = total.result()
+    assert isinstance(result, np.memmap) and result.shape == DIMENSIONS
+    np.testing.assert_array_equal(result, expected)
+
+
+def test_sum_is_kept_sparse_within_the_budget(tmp_path):
+    rng = np.random.default_rng(1)
+    frames = [_spectrum_frame(rng) for _ in range(3)]
+    total = processing.SpillingSpectrumSum(str(tmp_path / "sum.dat"),
+                                           DIMENSIONS, memory_limit=10**6)
+    for frame in frames:
+        total.add(frame)
+    assert total._sparse.frames == 3 and not total.data.any()
+    np.testing.assert_array_equal(total.result(),
+                                  sum(_dense(i) for i in frames))
+
+
+def test_window_maps_are_channel_range_sums():
+    rng = np.random.default_rng(2)
+    channels = DIMENSIONS[0]
+    # channel i covers 0.5 + [0.1*i, 0.1*(i+1)) keV
+    specstr = SimpleNamespace(spectrum_offset=0.5, dispersion=0.1,
+                              channels=channels)
+    # overlapping windows and one that is clipped to the spectrum
+    windows = [(0.6, 0.8), (0.7, 1.0), (0.45, 0.55), (0.95, 2.)]
+    ranges = processing._get_window_channels(specstr, windows)
+    assert ranges == [(1, 3), (2, 5), (0, 1), (4, 6)]
+    selector, span = processing._get_window_selector(ranges)
+    windows_sum = CountAccumulator(frames=4)
+    spectrum_map = np.zeros(DIMENSIONS, dtype=np.int64)
+    for _ in range(4):
+        frame = _spectrum_frame(rng, density=0.3)
+        windows_sum.add(processing._get_window_maps(frame, selector, span,
+                                                    DIMENSIONS))
+        spectrum_map += _dense(frame)
+    expected = [spectrum_map[c0:c1].sum(axis=0) for c0, c1 in ranges]
+    np.testing.assert_array_equal(windows_sum.result(), expected)
+
+
+def test_invalid_windows_are_rejected():
+    specstr = SimpleNamespace(spectrum_offset=0., dispersion=0.1,
+                              channels=DIMENSIONS[0])
+    with pytest.raises(ValueError):
+        processing._get_window_channels(specstr, [(0.3, 0.2)])
+    with pytest.raises(ValueError):
+        processing._get_window_channels(specstr, [(2., 3.)])
+
+
+def test_displacement_statistics_are_written(tmp_path):
+    rng = np.random.default_rng(3)
+    h, w = 10, 12
+    scale = max(h, w) - 1
+    stage, bznumber = 3, "04"
+    images = rng.random((4, h, w))
+    # no displacement, below half a pixel and a translation by 2 pixels
+    fields = {0: (0., 0.), 1: (0.3, -0.2), 2: (0.3, -0.2), 3: (2., 0.)}
+    for i, (dx, dy) in fields.items():
+        folder = tmp_path / f"stage{stage}" / (f"{i}" if i == 0 else f"{i}-r")
+        folder.mkdir(parents=True)
+        field = np.zeros((2, h, w))
+        # sub-pixel displacements that keep the border inside the frame
+        field[0, :, 1:-1], field[1, 1:-1] = dx, dy
+        for j in range(2):
+            saveToQ2bz(str(folder / f"deformation_{bznumber}_{j}.dat.bz2"),
+                       field[j]/scale)
+    # frame 2 was pre-aligned by one pixel, it has to be warped
+    image_shifts = np.array([[0, 0], [0, 0], [1, 0], [0, 0]])
+    shared, stats = processing._warp_images_shared(
+        images, [0, 1, 2, 3], str(tmp_path), stage, bznumber, image_shifts,
+        True, workers=2)
+    try:
+        deformed = shared["deformed"].array.copy()
+        defX = shared["defX"].array.copy()
+    finally:
+        for array in shared.values():
+            array.close()
+    assert [i["identity"] for i in stats] == [True, True, True, False]
+    assert [i["image_identity"] for i in stats] == [True, True, False, False]
+    np.testing.assert_array_equal(deformed[:2], images[:2])
+    for i in (2, 3):
+        fieldX = defX[i]
+        fieldY = np.zeros_like(fieldX)
+        fieldY[1:-1] = fields[i][1]/scale
+        fieldX, fieldY = processing.compose_shift(fieldX, fieldY,
+                                                  image_shifts[i])
+        np.testing.assert_array_equal(deformed[i], kernels.warp_image(
+            images[i], fieldX, fieldY, cval=images[i].mean()))
+    assert np.isclose(stats[3]["max_shift"], 2.)
+    path = str(tmp_path / "displacement_statistics.json")
+    processing._write_displacement_statistics(dict(enumerate(stats)), path)
+    with open(path) as f:
+        written = json.load(f)
+    assert written["identity_frames"] == [0, 1, 2]
+    assert written["copied_frames"] == [0, 1]
+    assert written["frames"]["3"] == stats[3]
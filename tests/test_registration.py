@@ -0,0 +1,80 @@
+import os
+import numpy as np
+from PIL import Image
+from scipy import ndimage
+from jnrr.io_tools import write_config_file, _getNameCounterFrames
+from jnrr.kernels import _get_coordinates
+from jnrr.processing import load_deformation
+from jnrr.registration import register_stack, register_config
+
+SHAPE = (64, 64)
+
+
+def _reference(rows, cols):
+    return (np.sin(cols/4.) + np.cos(rows/5.) +
+            0.5*np.sin((rows + cols)/7.))
+
+
+def _displacement(rows, cols):
+    """A smooth sinusoidal warp of up to 1.3 pixels, (2, h, w) x and y"""
+    return np.array([1.3*np.sin(rows/11.), -1.3*np.cos(cols/13.)])
+
+
+def _frame(rows, cols):
+    """The frame that matches the reference at x + d(x)"""
+    # solve x + d(x) = y for every pixel y by fixed point iteration
+    x_rows, x_cols = rows.astype(float), cols.astype(float)
+    for _ in range(50):
+        d = _displacement(x_rows, x_cols)
+        x_rows, x_cols = rows - d[1], cols - d[0]
+    return _reference(x_rows, x_cols)
+
+
+def _stack():
+    rows, cols = np.mgrid[0:SHAPE[0], 0:SHAPE[1]].astype(float)
+    return np.array([_reference(rows, cols), _frame(rows, cols)])
+
+
+def test_register_stack_recovers_a_known_deformation():
+    stack = _stack()
+    fields = register_stack(stack, stages=1)
+    assert fields.shape == (2, 2) + SHAPE
+    scale = max(SHAPE) - 1
+    rows, cols = np.mgrid[0:SHAPE[0], 0:SHAPE[1]]
+    inner = (slice(None), slice(8, -8), slice(8, -8))
+    error = np.abs(fields[1]*scale - _displacement(rows, cols))[inner]
+    assert error.mean() < 0.1
+    assert np.abs(fields[0]*scale).max() < 0.1
+    # the frame sampled at the deformations matches the reference
+    warped = ndimage.map_coordinates(
+        stack[1], _get_coordinates(fields[1, 0], fields[1, 1]), order=1)
+    before = np.abs(stack[1] - stack[0])[inner[1:]].mean()
+    after = np.abs(warped - stack[0])[inner[1:]].mean()
+    assert after < 0.1*before
+
+
+def test_register_config_round_trip(tmp_path):
+    stack = _stack()[:, ::2, ::2]
+    stack = np.concatenate([stack, stack[::-1]])
+    for i, frame in enumerate(stack):
+        Image.fromarray(frame.astype(np.float32)).save(
+            str(tmp_path / f"frame_{i:02d}.tiff"))
+    config = str(tmp_path / "matchSeries_000.par")
+    savedir = str(tmp_path / "nonrigid_results_000")
+    write_config_file(config, pathpattern=str(tmp_path / "frame_%02d.tiff"),
+                      savedir=savedir, preclevel=5, num_frames=4,
+                      skipframes=[2], numstag=1, gditer=10)
+    result_folder = register_config(config, levels=2)
+    assert result_folder == savedir
+    assert os.path.isfile(os.path.join(savedir, "parameter-dump.txt"))
+    (_, _, _, _, _, bznumber, stage) = _getNameCounterFrames(config)
+    assert stage == 2
+    indexes = [0, 1, 3]
+    expected = register_stack(stack[indexes].astype(np.float32), levels=2,
+                              stages=2, iterations=10)
+    for pos, i in enumerate(indexes):
+        defX, defY = load_deformation(result_folder, stage, bznumber, i,
+                                      pos == 0)
+        np.testing.assert_allclose(defX, expected[pos, 0], atol=1e-12)
+        np.testing.assert_allclose(defY, expected[pos, 1], atol=1e-12)
+    assert not os.path.isdir(os.path.join(savedir, f"stage{stage}", "2-r"))
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+from jnrr.io_tools import write_config_file, _getNameCounterFrames
+from jnrr.screening import find_bad_frames
+
+
+def _stack(frames=20, shape=(48, 64)):
+    """Noisy frames of one smooth random texture"""
+    rng = np.random.default_rng(0)
+    texture = ndimage.gaussian_filter(rng.random(shape), 3.)
+    texture = 1000.*(texture - texture.min())/np.ptp(texture)
+    return texture + rng.normal(0., 20., (frames,) + shape)
+
+
+def _blank(stack, i):
+    stack[i] = stack[i].mean()
+
+
+def _shift(stack, i):
+    stack[i] = np.roll(stack[i], (9, -13), axis=(0, 1))
+
+
+@pytest.mark.parametrize("spoil", [_blank, _shift])
+def test_only_the_spoiled_frame_is_skipped(tmp_path, spoil):
+    stack = _stack()
+    assert find_bad_frames(stack)[0] == []
+    spoil(stack, 7)
+    bad, stats = find_bad_frames(stack, chunk=6)
+    assert bad == [7]
+    assert len(stats["correlation_z"]) == 20
+    # as extract_emd writes the flagged frames to the config
+    config = str(tmp_path / "matchSeries_000.par")
+    write_config_file(config, pathpattern=str(tmp_path / "frame_%02d.tiff"),
+                      num_frames=20, skipframes=sorted({3} | set(bad)))
+    with open(config) as f:
+        assert "templateSkipNums { 3 7 }" in f.read()
+    assert _getNameCounterFrames(config)[4] == [3, 7]
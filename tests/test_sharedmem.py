@@ -0,0 +1,52 @@
+import os
+import subprocess
+import sys
+import numpy as np
+from jnrr.sharedmem import SharedArray, map_indexes
+
+# a numba kernel before a pool: forked workers inherited the TBB threads
+KERNEL_THEN_POOL = """
+import numpy as np
+from jnrr import kernels
+from jnrr.sharedmem import SharedArray, map_indexes
+
+
+def frame_sum(index, stack):
+    return float(stack[index].sum())
+
+
+if __name__ == "__main__":
+    zero = np.zeros((16, 16))
+    kernels.warp_image(np.ones((16, 16)), zero, zero)
+    with SharedArray.from_array(np.ones((4, 3))) as stack:
+        print(map_indexes(frame_sum, range(4), [stack], workers=2))
+"""
+
+
+def _square(index, stack, out):
+    out[index] = stack[index]**2
+    return index
+
+
+def test_map_indexes_writes_shared_output():
+    stack = np.arange(24.).reshape(4, 2, 3)
+    with SharedArray.from_array(stack) as data, \
+            SharedArray(stack.shape, stack.dtype) as out:
+        result = map_indexes(_square, range(4), [data, out], workers=2)
+        np.testing.assert_array_equal(out.array, stack**2)
+    assert result == [0, 1, 2, 3]
+
+
+def test_pool_after_kernel_exits(tmp_path):
+    script = tmp_path / "kernel_then_pool.py"
+    script.write_text(KERNEL_THEN_POOL)
+    env = dict(os.environ)
+    env.pop("NUMBA_THREADING_LAYER", None)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(
+        [root] + [i for i in [env.get("PYTHONPATH")] if i])
+    done = subprocess.run([sys.executable, str(script)], env=env,
+                          capture_output=True, text=True, timeout=120)
+    assert done.returncode == 0, done.stderr
+    assert done.stdout.strip() == "[3.0, 3.0, 3.0, 3.0]"
+    assert "Error" not in done.stderr
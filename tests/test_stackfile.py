@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+from jnrr.stackfile import StackWriter, read_stack
+
+h5py = pytest.importorskip("h5py")
+
+
+@pytest.mark.parametrize("compression", [None, "gzip"])
+def test_stack_roundtrip(tmp_path, compression):
+    path = str(tmp_path / "stack.h5")
+    frames = np.arange(4*6*5, dtype=np.uint16).reshape(4, 6, 5)
+    with StackWriter(path, 4, (6, 5), np.uint16, pixelsize=0.25,
+                     pixelunit="nm", compression=compression,
+                     attributes={"process": "test"}) as writer:
+        for i, frame in zip((0, 2, 3, 5), frames):
+            writer.write(frame, index=i)
+        with pytest.raises(IndexError):
+            writer.write(frames[0])
+    data, attributes = read_stack(path)
+    # only the uncompressed, contiguous dataset can be memory-mapped
+    assert isinstance(data, np.memmap) == (compression is None)
+    np.testing.assert_array_equal(data, frames)
+    assert attributes["pixelsize"] == 0.25
+    assert attributes["pixelunit"] == "nm"
+    assert attributes["process"] == "test"
+    np.testing.assert_array_equal(attributes["frame_indexes"], [0, 2, 3, 5])
+    data, _ = read_stack(path, memmap=False)
+    assert not isinstance(data, np.memmap)
+    np.testing.assert_array_equal(data, frames)
+
+
+def test_stack_is_closed_after_an_error(tmp_path):
+    path = str(tmp_path / "stack.h5")
+    with pytest.raises(RuntimeError):
+        with StackWriter(path, 3, (2, 2), np.float32) as writer:
+            writer.write(np.ones((2, 2)))
+            raise RuntimeError("frame failed")
+    # the file can be opened again and holds the written frames
+    data, attributes = read_stack(path)
+    np.testing.assert_array_equal(attributes["frame_indexes"], [0])
+    np.testing.assert_array_equal(data[0], 1.)
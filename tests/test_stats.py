@@ -0,0 +1,51 @@
+import numpy as np
+from PIL import Image
+from jnrr import stats
+
+
+def _stack(frames=20, shape=(6, 5)):
+    rng = np.random.default_rng(0)
+    return 100. + rng.normal(0., 1., (frames,) + shape)
+
+
+def test_statistics_match_numpy(tmp_path):
+    stack = _stack()
+    for i, frame in enumerate(stack):
+        Image.fromarray(frame.astype(np.float32)).save(
+            str(tmp_path / f"frame_{i:02d}.tiff"))
+    stack = stack.astype(np.float32).astype(np.float64)
+    for source, chunk in ((stack, None), (str(tmp_path), 3)):
+        result = stats.frame_statistics(source, chunk=chunk)
+        assert result["frames"] == 20
+        np.testing.assert_allclose(result["mean"], stack.mean(axis=0))
+        np.testing.assert_allclose(result["variance"], stack.var(axis=0))
+    # the median is exact in one chunk
+    result = stats.frame_statistics(stack, statistics=("median",))
+    np.testing.assert_array_equal(result["median"], np.median(stack, axis=0))
+
+
+def test_clipped_mean_rejects_an_outlier_frame():
+    stack = _stack()
+    stack[7] += 1000.
+    result = stats.frame_statistics(stack, statistics=("clipped_mean",),
+                                    chunk=6)
+    others = np.delete(stack, 7, axis=0)
+    np.testing.assert_allclose(result["clipped_mean"], others.mean(axis=0))
+    frames = [i for i in range(20) if i != 7]
+    result = stats.frame_statistics(stack, frames=frames, chunk=4)
+    np.testing.assert_allclose(result["mean"], others.mean(axis=0))
+
+
+def test_chunk_medians_are_bounded():
+    levels = []
+    held = 0
+    for i in range(1000):
+        stats._push_median(levels, np.full((2, 2), float(i)))
+        held = max(held, sum(len(level) for level in levels))
+    assert held <= stats._median_frames(1000) - stats.MEDIAN_MERGE
+    median = stats._reduce_medians(levels)
+    assert abs(median[0, 0] - 499.5) < 50
+    stack = _stack(frames=200)
+    result = stats.frame_statistics(stack, statistics=("median",), chunk=1)
+    error = np.abs(result["median"] - np.median(stack, axis=0)).max()
+    assert error < 0.5
@@ -0,0 +1,91 @@
+import json
+import numpy as np
+from PIL import Image
+from jnrr.io_tools import write_config_file, saveToQ2bz, _getNameCounterFrames
+from jnrr.processing import load_deformation
+from jnrr.subseries import split_series, merge_subseries
+from jnrr.workqueue import MemoryQueue, QueueWorker, new_task
+
+SHAPE = (24, 32)
+
+
+def _field(index, offset=(0., 0.)):
+    """
+    Pixel displacement of a frame sampled at x - offset, (2, h, w)
+
+    A translation per frame and a slowly varying sinusoid, the reference
+    frame 0 is not displaced.
+    """
+    rows, cols = np.mgrid[0:SHAPE[0], 0:SHAPE[1]].astype(float)
+    cols = cols - offset[0]
+    rows = rows - offset[1]
+    if index == 0:
+        return np.zeros((2,) + SHAPE)
+    return np.array([0.1*index + 0.3*np.sin(rows/7. + index),
+                     -0.05*index + 0.3*np.cos(cols/9. - index)])
+
+
+def _config(tmp_path, frames):
+    config = str(tmp_path / "matchSeries_000.par")
+    write_config_file(config, pathpattern=str(tmp_path / "frame_%02d.tiff"),
+                      savedir=str(tmp_path / "nonrigid_results_000"),
+                      preclevel=5, num_frames=frames)
+    return config
+
+
+def test_merge_subseries_chains_the_chunk_targets(tmp_path):
+    config = _config(tmp_path, 14)
+    (_, _, _, _, _, bznumber, stage) = _getNameCounterFrames(config)
+    layout_file = split_series(config, chunk_size=6, overlap=2)
+    with open(layout_file) as f:
+        chunks = json.load(f)["chunks"]
+    assert len(chunks) == 3
+    scale = max(SHAPE) - 1
+    # the target of every chunk is displaced by a different translation
+    offsets = [(0., 0.), (1.5, -0.8), (-1.2, 1.1)]
+    for chunk, offset in zip(chunks, offsets):
+        for i in chunk["frames"]:
+            field = _field(i, offset) - np.array(offset)[:, None, None]
+            sub = f"{i}" if i == 0 else f"{i}-r"
+            folder = tmp_path / chunk["savedir"] / f"stage{stage}" / sub
+            folder.mkdir(parents=True)
+            for j in range(2):
+                saveToQ2bz(str(folder / f"deformation_{bznumber}_{j}.dat.bz2"),
+                           field[j]/scale)
+    result_folder = merge_subseries(layout_file)
+    for i in range(14):
+        merged = np.array(load_deformation(result_folder, stage, bznumber,
+                                           i, i == 0))*scale
+        error = np.abs(merged - _field(i)).max()
+        assert error < 0.15, (i, error)
+
+
+def _apply(args):
+    return args["result_folder"], []
+
+
+def test_chunks_are_separate_queue_tasks(tmp_path):
+    config = _config(tmp_path, 10)
+    rows, cols = np.mgrid[0:SHAPE[0], 0:SHAPE[1]]
+    for i in range(10):
+        frame = np.sin((cols - 0.2*i)/3.) + np.cos(rows/4.)
+        Image.fromarray(frame.astype(np.float32)).save(
+            str(tmp_path / f"frame_{i:02d}.tiff"))
+    queue = MemoryQueue()
+    queue.put(new_task("register", {
+        "config_file": config, "image_folder": str(tmp_path),
+        "spectrum_folder": None, "apply_options": {},
+        "options": {"backend": "numpy", "chunk_size": 5, "overlap": 2,
+                    "levels": 1, "iterations": 3}}))
+    QueueWorker(queue, slots=3, handlers={"apply": _apply},
+                poll_interval=0.01, use_processes=False).run(until_idle=True)
+    done = queue.tasks("done")
+    kinds = sorted(i["kind"] for i in done)
+    assert kinds == ["apply", "merge"] + ["register"]*4
+    assert queue.counts()["failed"] == 0
+    (_, _, _, _, _, bznumber, stage) = _getNameCounterFrames(config)
+    result_folder = [i for i in done if i["kind"] == "apply"][0]["result"]
+    assert result_folder == str(tmp_path / "nonrigid_results_000")
+    for i in range(10):
+        defX, _ = load_deformation(result_folder, stage, bznumber, i, i == 0)
+        assert defX.shape == SHAPE
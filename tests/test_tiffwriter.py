@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from PIL import Image
+from jnrr.tiffwriter import RawTiffWriter, write_tiff, write_tiffs
+
+DTYPES = [np.uint8, np.int8, np.uint16, np.int16, np.int32, np.float16,
+          np.float32, np.float64]
+
+
+@pytest.mark.parametrize("dtype", DTYPES)
+@pytest.mark.parametrize("options", [{}, {"compression": "deflate"},
+                                     {"tile": 16}])
+def test_readable_by_pil(tmp_path, dtype, options):
+    frame = (np.arange(20*37).reshape(20, 37) % 97 - 40).astype(dtype)
+    path = str(tmp_path / "frame.tiff")
+    write_tiff(path, frame, **options)
+    with Image.open(path) as img:
+        read = np.asarray(img)
+    np.testing.assert_array_equal(read, frame.astype(np.float32))
+
+
+@pytest.mark.parametrize("dtype", [np.uint32, np.int64, np.uint64])
+def test_refuses_unreadable_types(dtype):
+    with pytest.raises(TypeError):
+        RawTiffWriter((4, 4), dtype)
+
+
+def test_write_tiffs(tmp_path):
+    stack = np.random.default_rng(0).random((3, 8, 5))
+    paths = [str(tmp_path / f"frame_{i}.tiff") for i in range(3)]
+    write_tiffs(stack, paths, workers=2)
+    for frame, path in zip(stack, paths):
+        with Image.open(path) as img:
+            assert img.mode == "F"
+            np.testing.assert_array_equal(np.asarray(img),
+                                          frame.astype(np.float32))
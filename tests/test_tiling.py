@@ -0,0 +1,78 @@
+import json
+import numpy as np
+from jnrr.io_tools import write_config_file, saveToQ2bz, _getNameCounterFrames
+from jnrr.processing import load_deformation
+from jnrr.tiling import tile_layout, stitch_tiles, _blend_weights
+
+HEIGHT, WIDTH, TILE, OVERLAP = 40, 72, 32, 8
+# constant pixel displacement (x, y) of every frame, frame 1 is skipped
+DISPLACEMENTS = {0: (0., 0.), 2: (1.5, -0.7), 3: (-2.25, 3.)}
+
+
+def _layout(tmp_path, tile_field=None):
+    """Tiles with deformation files, tile_field(k, i) overrides the field"""
+    tiles = []
+    for k, (y, x) in enumerate(tile_layout(HEIGHT, WIDTH, TILE, OVERLAP)):
+        savedir = tmp_path / f"nonrigid_results_tile_{k:03d}"
+        savedir.mkdir()
+        config = str(savedir / "parameter-dump.txt")
+        write_config_file(config, pathpattern=str(tmp_path / "f_%02d.tiff"),
+                          savedir=str(savedir), preclevel=5, num_frames=4,
+                          skipframes=[1])
+        (_, _, _, _, _, bznumber, stage) = _getNameCounterFrames(config)
+        for i, shift in DISPLACEMENTS.items():
+            field = np.ones((2, TILE, TILE))*np.array(shift)[:, None, None]
+            if tile_field is not None:
+                field = tile_field(k, i)
+            sub = f"{i}" if i == 0 else f"{i}-r"
+            folder = savedir / f"stage{stage}" / sub
+            folder.mkdir(parents=True)
+            for j in range(2):
+                saveToQ2bz(str(folder / f"deformation_{bznumber}_{j}"
+                                        ".dat.bz2"), field[j]/(TILE - 1))
+        tiles.append({"y": y, "x": x, "config": config,
+                      "savedir": str(savedir)})
+    layout = {"height": HEIGHT, "width": WIDTH, "tile_size": TILE,
+              "overlap": OVERLAP, "pathpattern": str(tmp_path / "f_%02d.tiff"),
+              "result_folder": str(tmp_path / "nonrigid_results"),
+              "num_frames": 4, "skipframes": [1], "numstag": 2,
+              "tiles": tiles}
+    layout_file = str(tmp_path / "tiling.json")
+    with open(layout_file, "w") as f:
+        json.dump(layout, f)
+    return layout_file, len(tiles)
+
+
+def _stitched(result_folder, i):
+    (_, _, _, numframes, skipframes, bznumber,
+        stage) = _getNameCounterFrames(result_folder + "/parameter-dump.txt")
+    assert (numframes, skipframes) == (4, [1])
+    defX, defY = load_deformation(result_folder, stage, bznumber, i, i == 0)
+    assert defX.shape == (HEIGHT, WIDTH)
+    return np.array([defX, defY])*(max(HEIGHT, WIDTH) - 1)
+
+
+def test_constant_tile_deformations_stitch_to_a_constant_field(tmp_path):
+    layout_file, tiles = _layout(tmp_path)
+    # the tiles overlap in both directions
+    assert tiles == 6
+    result_folder = stitch_tiles(layout_file)
+    for i, shift in DISPLACEMENTS.items():
+        np.testing.assert_allclose(
+            _stitched(result_folder, i),
+            np.ones((2, HEIGHT, WIDTH))*np.array(shift)[:, None, None],
+            atol=1e-12)
+
+
+def test_overlaps_blend_between_the_tiles(tmp_path):
+    # every tile is displaced by its own index
+    layout_file, tiles = _layout(
+        tmp_path, lambda k, i: np.full((2, TILE, TILE), float(k)))
+    stitched = _stitched(stitch_tiles(layout_file), 2)
+    assert stitched.min() >= 0 and stitched.max() <= tiles - 1 + 1e-9
+    # only tile 0 covers the top left corner, tiles 0 and 1 blend in the
+    # overlap of the first row
+    assert stitched[0, 0, 0] == 0
+    assert 0 < stitched[0, 0, 28] < 1
+    weights = _blend_weights(TILE, OVERLAP)
+    assert weights[TILE//2, TILE//2] == 1 and weights[0, 0] > 0
@@ -0,0 +1,98 @@
+import json
+import os
+import pytest
+from jnrr.watcher import JOB_FILE, FolderWatcher
+
+
+def _log(folder, stage):
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, "stages.txt"), "a") as f:
+        f.write(stage + "\n")
+
+
+def _extract(path, output_folder, options):
+    _log(output_folder, "extract")
+    # kept stacks are not json serializable
+    return {"output_folder_paths": [output_folder], "datasets": [{1}]}
+
+
+def _register(paths, options):
+    folder = paths["output_folder_paths"][0]
+    _log(folder, "register")
+    return [os.path.join(folder, "result")]
+
+
+def _apply(paths, result_folders, options):
+    _log(paths["output_folder_paths"][0], "apply")
+    return result_folders
+
+
+STAGES = {"extract": _extract, "register": _register, "apply": _apply}
+
+
+def _watcher(tmp_path, **kwargs):
+    options = dict(output_folder=str(tmp_path / "out"), settle_time=0.,
+                   poll_interval=0.01, stages=STAGES, use_processes=False)
+    options.update(kwargs)
+    return FolderWatcher(str(tmp_path / "in"), **options)
+
+
+def _stages(tmp_path, name):
+    with open(tmp_path / "out" / name / "stages.txt") as f:
+        return f.read().split()
+
+
+def _jobs(tmp_path):
+    with open(tmp_path / "out" / JOB_FILE) as f:
+        return json.load(f)
+
+
+@pytest.mark.parametrize("use_processes", [False, True])
+def test_watcher_processes_new_files(tmp_path, use_processes):
+    (tmp_path / "in").mkdir()
+    for name in ("a.emd", "b.emd", "notes.txt"):
+        (tmp_path / "in" / name).write_text(name)
+    watcher = _watcher(tmp_path, use_processes=use_processes)
+    watcher.run(until_idle=True, timeout=60)
+    jobs = _jobs(tmp_path)
+    assert sorted(os.path.basename(i) for i in jobs) == ["a.emd", "b.emd"]
+    for path, job in jobs.items():
+        assert job["state"] == "done" and job["error"] is None
+        assert "datasets" not in job["paths"]
+        name = os.path.splitext(os.path.basename(path))[0]
+        assert job["result_folders"] == [
+            str(tmp_path / "out" / name / "result")]
+        assert _stages(tmp_path, name) == ["extract", "register", "apply"]
+
+
+def test_watcher_restarts_interrupted_jobs(tmp_path):
+    (tmp_path / "in").mkdir()
+    out = tmp_path / "out"
+    jobs = {}
+    for name, state in (("a", "registering"), ("b", "applying"),
+                        ("c", "done")):
+        path = tmp_path / "in" / f"{name}.emd"
+        path.write_text(name)
+        folder = str(out / name)
+        jobs[str(path)] = {
+            "state": state, "output_folder": folder,
+            "paths": {"output_folder_paths": [folder]},
+            "result_folders": (None if state == "registering"
+                               else [os.path.join(folder, "result")]),
+            "error": None}
+    out.mkdir()
+    with open(out / JOB_FILE, "w") as f:
+        json.dump(jobs, f)
+    watcher = _watcher(tmp_path)
+    assert [i["state"] for i in watcher.jobs.values()] == \
+        ["extracted", "registered", "done"]
+    watcher.run(until_idle=True, timeout=60)
+    assert all(i["state"] == "done" for i in _jobs(tmp_path).values())
+    assert _stages(tmp_path, "a") == ["register", "apply"]
+    assert _stages(tmp_path, "b") == ["apply"]
+    assert not (out / "c").exists()
+
+
+def test_watcher_rejects_keep_stacks(tmp_path):
+    with pytest.raises(ValueError):
+        _watcher(tmp_path, options={"extract": {"keep_stacks": True}})
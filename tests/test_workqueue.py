@@ -0,0 +1,178 @@
+import os
+import threading
+import time
+import pytest
+from jnrr.sharedmem import process_context
+from jnrr.workqueue import (FileQueue, MemoryQueue, QueueBroker, QueueWorker,
+                            new_task, open_queue)
+
+mp = process_context()
+
+
+def _extract(args):
+    return args["name"], [("register", {"name": args["name"]})]
+
+
+def _register(args):
+    time.sleep(args.get("sleep", 0.01))
+    return args["name"], [("apply", {"name": args["name"]})]
+
+
+def _apply(args):
+    return args["name"], []
+
+
+def _flaky(args):
+    """Fails until it was called args["fails"] times"""
+    with open(args["counter"], "a") as f:
+        f.write("x")
+    with open(args["counter"]) as f:
+        if len(f.read()) <= args["fails"]:
+            raise RuntimeError("flaky")
+    return "ok", []
+
+
+def _crash(args):
+    """Kills its process, only the first time unless always"""
+    if args.get("always") or not os.path.exists(args["marker"]):
+        open(args["marker"], "w").close()
+        os._exit(1)
+    return "survived", []
+
+
+HANDLERS = {"extract": _extract, "register": _register, "apply": _apply,
+            "flaky": _flaky, "crash": _crash}
+
+
+def _worker(queue, **kwargs):
+    options = dict(slots=2, handlers=HANDLERS, poll_interval=0.01,
+                   heartbeat_interval=0.05, use_processes=False)
+    options.update(kwargs)
+    return QueueWorker(queue, **options)
+
+
+def _work(spec):
+    _worker(open_queue(spec, lease=30.)).run(until_idle=True, timeout=60)
+
+
+def _run_processes(spec, n):
+    processes = [mp.Process(target=_work, args=(spec,)) for _ in range(n)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join(120)
+        assert p.exitcode == 0
+
+
+def _check_chains(queue, names):
+    counts = queue.counts()
+    assert counts == {"pending": 0, "running": 0, "done": 3*len(names),
+                      "failed": 0}
+    done = queue.tasks("done")
+    for kind in ("extract", "register", "apply"):
+        assert sorted(i["result"] for i in done if i["kind"] == kind) == \
+            sorted(names)
+
+
+def test_file_queue_with_several_processes(tmp_path):
+    spec = str(tmp_path / "queue")
+    queue = FileQueue(spec)
+    names = [f"file{i}" for i in range(30)]
+    for name in names:
+        queue.put(new_task("extract", {"name": name}))
+    _run_processes(spec, 4)
+    _check_chains(queue, names)
+
+
+def test_tcp_broker_with_several_processes():
+    broker = QueueBroker(MemoryQueue()).start()
+    try:
+        host, port = broker.address
+        spec = f"tcp://{host}:{port}"
+        queue = open_queue(spec)
+        names = [f"file{i}" for i in range(20)]
+        for name in names:
+            queue.put(new_task("extract", {"name": name}))
+        _run_processes(spec, 3)
+        _check_chains(queue, names)
+    finally:
+        broker.shutdown()
+
+
+@pytest.fixture(params=["file", "memory"])
+def queue(request, tmp_path):
+    if request.param == "file":
+        return FileQueue(str(tmp_path / "queue"), lease=0.2)
+    return MemoryQueue(lease=0.2)
+
+
+def test_duplicate_ids_are_queued_once(queue):
+    assert queue.put(new_task("apply", {"name": "a"}, task_id="x-1")) == \
+        "x-1"
+    queue.put(new_task("apply", {"name": "b"}, task_id="x-1"))
+    assert [i["args"]["name"] for i in queue.tasks("pending")] == ["a"]
+    assert queue.claim("w")["id"] == "x-1"
+
+
+def test_lease_takeover(queue):
+    queue.put(new_task("register", {"name": "a"}))
+    task = queue.claim("dead")
+    time.sleep(0.3)
+    _worker(queue).run(until_idle=True, timeout=30)
+    done = {i["kind"]: i for i in queue.tasks("done")}
+    assert sorted(done) == ["apply", "register"]
+    assert done["register"]["attempts"] == 1
+    assert "expired" in done["register"]["error"]
+    # the lost worker can not renew the lease or complete the task
+    assert not queue.heartbeat(task["id"], "dead")
+    late = new_task("apply", {"name": "late"})
+    assert not queue.complete(task["id"], "late", "dead", [late])
+    assert queue.counts() == {"pending": 0, "running": 0, "done": 2,
+                              "failed": 0}
+
+
+def test_task_taken_over_while_running_queues_followups_once(queue):
+    queue.put(new_task("register", {"name": "a", "sleep": 0.6}))
+    # the first worker does not renew its lease in time
+    first = _worker(queue, slots=1, heartbeat_interval=10., name="first")
+    thread = threading.Thread(target=first.run,
+                              kwargs={"until_idle": True, "timeout": 30})
+    thread.start()
+    time.sleep(0.35)
+    second = _worker(queue, slots=1, name="second")
+    second.run(until_idle=True, timeout=30)
+    thread.join()
+    assert (first.finished, second.finished) == (0, 2)
+    done = queue.tasks("done")
+    assert sorted(i["kind"] for i in done) == ["apply", "register"]
+
+
+def test_retries_up_to_max_attempts(queue, tmp_path):
+    queue.put(new_task("flaky", {"counter": str(tmp_path / "once"),
+                                 "fails": 2}, max_attempts=3))
+    queue.put(new_task("flaky", {"counter": str(tmp_path / "never"),
+                                 "fails": 99}, max_attempts=3))
+    _worker(queue).run(until_idle=True, timeout=30)
+    done, = queue.tasks("done")
+    assert done["attempts"] == 2 and done["result"] == "ok"
+    failed, = queue.tasks("failed")
+    assert failed["attempts"] == 3
+    assert failed["error"] == "RuntimeError: flaky"
+
+
+def test_worker_survives_a_crashed_process(tmp_path):
+    queue = FileQueue(str(tmp_path / "queue"), lease=2.)
+    queue.put(new_task("crash", {"marker": str(tmp_path / "once")}))
+    queue.put(new_task("crash", {"marker": str(tmp_path / "always"),
+                                 "always": True}, max_attempts=2))
+    for i in range(4):
+        queue.put(new_task("apply", {"name": f"a{i}"}))
+    worker = _worker(queue, use_processes=True)
+    worker.run(until_idle=True, timeout=60)
+    counts = queue.counts()
+    assert counts == {"pending": 0, "running": 0, "done": 5, "failed": 1}
+    failed, = queue.tasks("failed")
+    assert failed["args"]["always"] and failed["attempts"] == 2
+    assert failed["error"] == "the worker process died"
+    results = sorted(i["result"] for i in queue.tasks("done"))
+    assert results == ["a0", "a1", "a2", "a3", "survived"]